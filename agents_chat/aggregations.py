@@ -0,0 +1,264 @@
+import logging
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from cache_utils import TTLCache
+from db_agent import get_db
+from entity_resolution import customer_names
+from hubspot_utils import get_all_companies, get_all_deals, get_deal_owner
+from salesforce_utils import get_sf_pool
+
+logger = logging.getLogger(__name__)
+
+# One row per deal, opportunity or invoice of any source.
+COLUMNS = ["source", "id", "name", "customer", "status", "amount", "date", "owner"]
+STATUSES = ["won", "lost", "open", "invoiced"]
+GROUP_FIELDS = ["source", "customer", "status", "owner", "year", "quarter", "month"]
+METRICS = ["sum_amount", "avg_amount", "count", "count_customers"]
+MAX_RESULT_ROWS = 100
+SEPARATE_NOTE = (
+    "Won deals are often invoiced as well, so the deals and the invoices are reported separately. "
+    "Do not add them up."
+)
+
+# Deal stages of the HubSpot pipelines that count as won and lost.
+HUBSPOT_WON_STAGES = set(os.getenv("HUBSPOT_WON_STAGES", "closedwon").split(","))
+HUBSPOT_LOST_STAGES = set(os.getenv("HUBSPOT_LOST_STAGES", "closedlost").split(","))
+OPPORTUNITY_QUERY = (
+    "SELECT Id, Name, Amount, StageName, IsClosed, IsWon, CloseDate, AccountId, Account.Name, Owner.Name "
+    "FROM Opportunity"
+)
+# Query returning the `id`, `company_key`, `company`, `amount` and `date` of
+# the invoices in the SQL database; `company_key` is the key the companies
+# have in ENTITY_SQL_COMPANIES_QUERY.
+AGGREGATION_SQL_INVOICES_QUERY = os.getenv("AGGREGATION_SQL_INVOICES_QUERY")
+
+frames = TTLCache(maxsize=8, default_ttl=int(os.getenv("AGGREGATION_FRAME_TTL", 300)))
+
+
+def _customers(source):
+    try:
+        return customer_names([source])
+    except Exception as err:
+        logger.warning(f"Could not resolve customers, using the names of the sources: {err}")
+        return {}
+
+
+def _frame(columns):
+    frame = pd.DataFrame(columns, columns=COLUMNS)
+    frame["amount"] = pd.to_numeric(frame["amount"], errors="coerce")
+    frame["date"] = pd.to_datetime(frame["date"], errors="coerce", utc=True)
+    return frame
+
+
+def _hubspot_customer(company_ids, customers, company_names):
+    """Returns the customer of the first associated company in the crosswalk,
+    falling back to the name of the first associated company, as the other
+    sources fall back to the names they store."""
+    return next(
+        (customers[("hubspot", company_id)] for company_id in company_ids if ("hubspot", company_id) in customers),
+        next((company_names[company_id] for company_id in company_ids if company_names.get(company_id)), None),
+    )
+
+
+def hubspot_deals_frame():
+    deals = get_all_deals()
+    owners = {owner["id"]: f"{owner['first_name']} {owner['last_name']}" for owner in get_deal_owner()}
+    customers = _customers("hubspot")
+    company_names = {company["id"]: company["name"] for company in get_all_companies()}
+    stages = pd.Series([deal["dealstage"] for deal in deals], dtype=object)
+    return _frame(
+        {
+            "source": "hubspot",
+            "id": [deal["id"] for deal in deals],
+            "name": [deal["dealname"] for deal in deals],
+            "customer": [
+                _hubspot_customer(deal["associations"].get("companies", []), customers, company_names)
+                for deal in deals
+            ],
+            "status": np.select(
+                [stages.isin(HUBSPOT_WON_STAGES), stages.isin(HUBSPOT_LOST_STAGES)], ["won", "lost"], "open"
+            ),
+            "amount": [deal["amount"] for deal in deals],
+            "date": [deal["closedate"] for deal in deals],
+            "owner": [owners.get(deal["hubspot_owner_id"]) for deal in deals],
+        }
+    )
+
+
+def salesforce_opportunities_frame():
+    opportunities = get_sf_pool().call(lambda sf: list(sf.query_all_iter(OPPORTUNITY_QUERY)))
+    customers = _customers("salesforce")
+    is_won = np.array([bool(opportunity["IsWon"]) for opportunity in opportunities])
+    is_closed = np.array([bool(opportunity["IsClosed"]) for opportunity in opportunities])
+    return _frame(
+        {
+            "source": "salesforce",
+            "id": [opportunity["Id"] for opportunity in opportunities],
+            "name": [opportunity["Name"] for opportunity in opportunities],
+            "customer": [
+                customers.get(
+                    ("salesforce", opportunity["AccountId"]),
+                    (opportunity["Account"] or {}).get("Name"),
+                )
+                for opportunity in opportunities
+            ],
+            "status": np.select([is_won, is_closed], ["won", "lost"], "open"),
+            "amount": [opportunity["Amount"] for opportunity in opportunities],
+            "date": [opportunity["CloseDate"] for opportunity in opportunities],
+            "owner": [(opportunity["Owner"] or {}).get("Name") for opportunity in opportunities],
+        }
+    )
+
+
+def sql_invoices_frame():
+    with get_db().engine.connect() as connection:
+        invoices = pd.DataFrame(
+            connection.execute(text(AGGREGATION_SQL_INVOICES_QUERY)).mappings().all(),
+            columns=["id", "company_key", "company", "amount", "date"],
+        )
+    customers = _customers("sql")
+    keys = invoices["company_key"].astype(str)
+    return _frame(
+        {
+            "source": "sql",
+            "id": invoices["id"].astype(str),
+            "name": None,
+            "customer": [customers.get(("sql", key), company) for key, company in zip(keys, invoices["company"])],
+            "status": "invoiced",
+            "amount": invoices["amount"],
+            "date": invoices["date"],
+            "owner": None,
+        }
+    )
+
+
+FRAME_LOADERS = {
+    "hubspot": hubspot_deals_frame,
+    "salesforce": salesforce_opportunities_frame,
+    **({"sql": sql_invoices_frame} if AGGREGATION_SQL_INVOICES_QUERY else {}),
+}
+
+
+def _group_column(frame, field):
+    dates = frame["date"].dt.tz_localize(None)
+    if field == "year":
+        column = dates.dt.year.astype("Int64").astype(str)
+    elif field == "quarter":
+        column = dates.dt.to_period("Q").astype(str)
+    elif field == "month":
+        column = dates.dt.to_period("M").astype(str)
+    else:
+        return frame[field].fillna("unknown")
+    return column.where(frame["date"].notna(), "unknown")
+
+
+def _aggregate(frame, metric):
+    """Computes `metric` over a frame, or over every group of a grouped frame."""
+    if metric == "sum_amount":
+        return frame["amount"].sum()
+    if metric == "avg_amount":
+        return frame["amount"].mean()
+    if metric == "count":
+        return frame["id"].count()
+    return frame["customer"].nunique()
+
+
+def _value(value):
+    if isinstance(value, (np.integer, int)):
+        return int(value)
+    return None if pd.isna(value) else round(float(value), 2)
+
+
+def _parse_date(value):
+    """Returns the start of the day `value` (YYYY-MM-DD) in UTC, or None if it isn't a date."""
+    try:
+        return pd.Timestamp(date.fromisoformat(str(value)), tz="UTC")
+    except ValueError:
+        return None
+
+
+def _summarize(frame, metric, group_by):
+    summary = {
+        "total": _value(_aggregate(frame, metric)),
+        "rows_considered": len(frame),
+        "rows_without_amount": int(frame["amount"].isna().sum()),
+    }
+    if group_by:
+        grouped = frame.groupby([_group_column(frame, field).rename(field) for field in group_by])
+        values = _aggregate(grouped, metric).sort_values(ascending=False)
+        summary["group_count"] = len(values)
+        summary["rows"] = [
+            {
+                **dict(zip(group_by, keys if isinstance(keys, tuple) else (keys,))),
+                metric: _value(value),
+            }
+            for keys, value in values.head(MAX_RESULT_ROWS).items()
+        ]
+    return summary
+
+
+def aggregate_deals(
+    metric="sum_amount",
+    statuses=None,
+    sources=None,
+    group_by=None,
+    date_from=None,
+    date_to=None,
+):
+    """Aggregates the deals of HubSpot, the opportunities of Salesforce and the
+    invoices of the SQL database, returning only the resulting table.
+
+    Amounts and counts of won deals and of invoices are reported separately,
+    as `deals` and `invoices`, since a won deal is often invoiced as well.
+    """
+    if metric not in METRICS:
+        return f"Unknown metric {metric}, use one of {', '.join(METRICS)}."
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by or [])
+    unknown = [field for field in group_by if field not in GROUP_FIELDS]
+    if unknown:
+        return f"Can't group by {', '.join(unknown)}, use some of {', '.join(GROUP_FIELDS)}."
+    first_day = _parse_date(date_from) if date_from else None
+    last_day = _parse_date(date_to) if date_to else None
+    invalid = [value for value, day in ((date_from, first_day), (date_to, last_day)) if value and day is None]
+    if invalid:
+        return f"Invalid dates {', '.join(map(repr, invalid))}, use YYYY-MM-DD."
+
+    loaded = []
+    unavailable = {}
+    for source, load in FRAME_LOADERS.items():
+        if sources and source not in sources:
+            continue
+        try:
+            loaded.append(frames.get_or_load(source, load))
+        except Exception as err:
+            logger.warning(f"Could not load the deals of {source}: {err}")
+            unavailable[source] = str(err)
+    frame = pd.concat(loaded, ignore_index=True) if loaded else _frame({column: [] for column in COLUMNS})
+
+    mask = np.ones(len(frame), dtype=bool)
+    if statuses:
+        mask &= frame["status"].isin(statuses).to_numpy()
+    if first_day is not None:
+        mask &= (frame["date"] >= first_day).to_numpy()
+    if last_day is not None:
+        mask &= (frame["date"] < last_day + pd.Timedelta(days=1)).to_numpy()
+    frame = frame[mask]
+
+    response = {"metric": metric}
+    invoiced = (frame["status"] == "invoiced").to_numpy()
+    # Customers are counted once whatever the sources, so only amounts and counts are split.
+    if metric != "count_customers" and invoiced.any() and (frame["status"] == "won").any():
+        response["note"] = SEPARATE_NOTE
+        response["deals"] = _summarize(frame[~invoiced], metric, group_by)
+        response["invoices"] = _summarize(frame[invoiced], metric, group_by)
+    else:
+        response.update(_summarize(frame, metric, group_by))
+    if unavailable:
+        response["unavailable_sources"] = unavailable
+    return response
+
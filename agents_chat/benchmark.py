@@ -0,0 +1,244 @@
+"""Offline benchmark of the orchestrator.
+
+Replays the questions of a corpus against local stand-ins for OpenAI,
+HubSpot, Salesforce and Postgres, and reports per question the latency of
+every stage, the LLM turns and tokens per agent, the API calls per source and
+the peak memory as JSON:
+
+    python benchmark.py --companies 500 --repeat 3 --output benchmark.json
+
+The LLM answers from the script of each question, so the numbers only move
+when the code between the LLM and the sources changes.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event
+
+# Before any module of the app, and before configure_environment so the
+# settings it points at the stubs win over a local .env.
+load_dotenv()
+
+from benchmark_stubs import HubSpotStub, LLMStub, SalesforceStub, load_database, salesforce_stub_login, synthetic_portal
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_questions.json")
+
+
+class StageTimer:
+    """Accumulates the calls and seconds spent per stage of the current question."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+
+    def wrap(self, stage, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started_at)
+
+        return timed
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage]["calls"] += 1
+            self.stages[stage]["seconds"] += seconds
+
+    def take(self):
+        with self._lock:
+            stages, self.stages = dict(self.stages), defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+        return {stage: {"calls": value["calls"], "seconds": round(value["seconds"], 4)} for stage, value in stages.items()}
+
+
+def configure_environment(workdir, llm, hubspot, db_url):
+    """Points the settings read on import at the stubs and at `workdir`, so
+    nothing of a local .env or of earlier runs is used."""
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "benchmark",
+            "OPENAI_API_BASE": f"{llm.url}/v1",
+            "HUB_API": "benchmark",
+            "HUBSPOT_API_HOST": hubspot.url,
+            # The stubs have no rate limit worth waiting for.
+            "HUBSPOT_REQUESTS_PER_SECOND": "1000",
+            "HUBSPOT_BURST": "1000",
+            "HUBSPOT_SEARCH_REQUESTS_PER_SECOND": "1000",
+            "HUBSPOT_MIRROR_PATH": os.path.join(workdir, "hubspot_mirror.sqlite3"),
+            "DB_URL": db_url,
+            "DB_SCHEMA_SNAPSHOT_PATH": os.path.join(workdir, "db_schema_snapshot.json"),
+            "ENTITY_INDEX_PATH": os.path.join(workdir, "entity_index.sqlite3"),
+            "ENTITY_SQL_COMPANIES_QUERY": "SELECT id AS key, name FROM customers",
+            "AGGREGATION_SQL_INVOICES_QUERY": (
+                "SELECT invoices.id AS id, customer_id AS company_key, customers.name AS company, amount, "
+                "issued_at AS date FROM invoices JOIN customers ON customers.id = invoices.customer_id"
+            ),
+            "RESULT_FILES_DIR": os.path.join(workdir, "results"),
+            "LLM_CACHE_URL": "none",
+            "EMBEDDING_CACHE_URL": "memory://",
+            # The stub serves no Bulk API.
+            "SALESFORCE_BULK_THRESHOLD": str(10**9),
+        }
+    )
+
+
+def instrument(timer):
+    """Imports the application and wraps its stages with `timer`."""
+    import openai
+
+    import hubspot_agent
+    import orchestrator
+    import salesforce_utils
+    from db_agent import get_db
+
+    openai.ChatCompletion.create = timer.wrap("llm", openai.ChatCompletion.create)
+    openai.Embedding.create = timer.wrap("embeddings", openai.Embedding.create)
+    orchestrator.route_question = timer.wrap("route", orchestrator.route_question)
+    for name, function in list(orchestrator.available_functions.items()):
+        orchestrator.available_functions[name] = timer.wrap(f"agent.{name}", function)
+    call_function = hubspot_agent.call_function
+    hubspot_agent.call_function = lambda available_functions, function_name, *args: timer.wrap(
+        f"tool.{function_name}", call_function
+    )(available_functions, function_name, *args)
+
+    sql_statements = defaultdict(int)
+
+    @event.listens_for(get_db().engine, "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        sql_statements["statements"] += 1
+
+    return orchestrator, salesforce_utils, sql_statements
+
+
+def summarize(runs):
+    seconds = sorted(run["seconds"] for run in runs)
+    totals = defaultdict(int)
+    for run in runs:
+        for usage in run["llm"].values():
+            totals["llm_requests"] += usage.get("requests", 0)
+            totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            totals["completion_tokens"] += usage.get("completion_tokens", 0)
+        for source, calls in run["api_calls"].items():
+            totals[f"{source}_calls"] += sum(calls.values()) if isinstance(calls, dict) else calls
+    return {
+        "runs": len(runs),
+        "errors": sum(1 for run in runs if run.get("error")),
+        "seconds_total": round(sum(seconds), 4),
+        "seconds_p50": round(statistics.median(seconds), 4) if seconds else None,
+        "seconds_p95": round(seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))], 4) if seconds else None,
+        "peak_memory_bytes": max((run.get("peak_memory_bytes") or 0 for run in runs), default=0),
+        **totals,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--companies", type=int, default=100, help="customers of the synthetic portals")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--questions", default=QUESTIONS_PATH, help="JSON corpus of scripted questions")
+    parser.add_argument("--repeat", type=int, default=1, help="passes over the corpus, the first one cold")
+    parser.add_argument("--db-url", help="database to load the invoices into, a temporary SQLite by default")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds added to every LLM call")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds added to every API call")
+    parser.add_argument("--no-memory", action="store_true", help="don't trace allocations, which slows runs down")
+    parser.add_argument("--output", help="file to write the report to, stdout by default")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    portal = synthetic_portal(args.companies, args.seed)
+    db_url = args.db_url or f"sqlite:///{os.path.join(workdir, 'invoices.sqlite3')}"
+    load_database(create_engine(db_url), portal)
+    llm = LLMStub(args.llm_latency)
+    hubspot = HubSpotStub(portal, args.api_latency)
+    salesforce = SalesforceStub(portal, args.api_latency)
+    configure_environment(workdir, llm, hubspot, db_url)
+
+    timer = StageTimer()
+    orchestrator, salesforce_utils, sql_statements = instrument(timer)
+    from message_log import MessageLog
+    from salesforce_client import SalesforcePool
+
+    salesforce_utils._sf_pool.factory = lambda: SalesforcePool(
+        salesforce_stub_login(salesforce), size=salesforce_utils.SALESFORCE_POOL_SIZE
+    ).warm_up()
+
+    with open(args.questions) as f:
+        questions = json.load(f)
+    if not args.no_memory:
+        tracemalloc.start()
+    runs = []
+    for repetition in range(args.repeat):
+        for question in questions:
+            llm.script = question["script"]
+            for stub in (llm, hubspot, salesforce):
+                stub.take_calls()
+            llm.take_usage()
+            timer.take()
+            sql_statements.clear()
+            if not args.no_memory:
+                tracemalloc.reset_peak()
+            run = {"id": question["id"], "repetition": repetition}
+            started_at = time.perf_counter()
+            try:
+                answer, _ = orchestrator.get_response(question["question"], MessageLog())
+                run["answer_chars"] = len(answer or "")
+            except Exception as err:
+                run["error"] = f"{type(err).__name__}: {err}"
+            run["seconds"] = round(time.perf_counter() - started_at, 4)
+            run["stages"] = timer.take()
+            run["llm"] = llm.take_usage()
+            run["api_calls"] = {
+                "hubspot": hubspot.take_calls(),
+                "salesforce": salesforce.take_calls(),
+                "sql": sql_statements.get("statements", 0),
+                "openai": llm.take_calls(),
+            }
+            if not args.no_memory:
+                run["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            runs.append(run)
+
+    report = {
+        "config": {
+            "companies": args.companies,
+            "seed": args.seed,
+            "questions": len(questions),
+            "repeat": args.repeat,
+            "database": create_engine(db_url).dialect.name,
+            "llm_latency": args.llm_latency,
+            "api_latency": args.api_latency,
+            "python": platform.python_version(),
+        },
+        "summary": summarize(runs),
+        "summary_by_repetition": {
+            repetition: summarize([run for run in runs if run["repetition"] == repetition])
+            for repetition in range(args.repeat)
+        },
+        # Kilobytes on Linux.
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "runs": runs,
+    }
+    for stub in (llm, hubspot, salesforce):
+        stub.stop()
+    content = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(content)
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,844 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from requests.adapters import HTTPAdapter
+from simple_salesforce import Salesforce
+from sqlalchemy import Boolean, Column, Float, Integer, MetaData, String, Table
+
+from token_budget import count_message_tokens, count_prompt_tokens
+
+logger = logging.getLogger(__name__)
+
+COMPANY_WORDS = [
+    "Acme", "Globex", "Initech", "Umbrella", "Hooli", "Stark", "Wayne", "Wonka", "Tyrell", "Cyberdyne",
+    "Soylent", "Vandelay", "Aperture", "Oscorp", "Monarch", "Nakatomi", "Gringotts", "Zorg", "Virtucon",
+    "Massive",
+]
+COMPANY_KINDS = ["Dynamics", "Systems", "Labs", "Foods", "Logistics", "Energy", "Media", "Health", "Capital"]
+LEGAL_FORMS = ["Inc", "Ltd", "GmbH", "LLC", "Corp"]
+FIRST_NAMES = ["Ann", "Bo", "Carla", "Dev", "Eve", "Farid", "Gina", "Hugo", "Ines", "Jon", "Kim", "Lars"]
+LAST_NAMES = ["Lee", "Ng", "Ortiz", "Patel", "Quinn", "Rossi", "Silva", "Tanaka", "Urban", "Vogel"]
+DEAL_KINDS = ["Renewal", "Expansion", "Pilot"]
+PRODUCTS = [("Platform license", 12000), ("Support plan", 3000), ("Onboarding", 5000), ("Add-on seats", 800)]
+HUBSPOT_STAGES = [
+    "appointmentscheduled", "qualifiedtobuy", "presentationscheduled", "decisionmakerboughtin",
+    "contractsent", "closedwon", "closedlost",
+]
+SALESFORCE_STAGES = [
+    ("Prospecting", False, False), ("Qualification", False, False), ("Negotiation/Review", False, False),
+    ("Closed Won", True, True), ("Closed Lost", True, False),
+]
+ACTIVITY_TYPES = ["tasks", "notes", "calls", "meetings"]
+# Singular names HubSpot uses in association types, e.g. deal_to_company.
+SINGULAR = {
+    "companies": "company", "contacts": "contact", "deals": "deal", "line_items": "line_item",
+    "tasks": "task", "notes": "note", "calls": "call", "meetings": "meeting_event", "tickets": "ticket",
+}
+PLURAL = {singular: plural for plural, singular in SINGULAR.items()}
+
+
+def company_name(index):
+    word = COMPANY_WORDS[index % len(COMPANY_WORDS)]
+    name = f"{word} {COMPANY_KINDS[index // len(COMPANY_WORDS) % len(COMPANY_KINDS)]}"
+    generation = index // (len(COMPANY_WORDS) * len(COMPANY_KINDS))
+    return f"{name} {generation + 1}" if generation else name
+
+
+def synthetic_portal(companies=100, seed=0):
+    """Generates the HubSpot portal, Salesforce org and invoice database of a
+    company with `companies` customers. About two thirds of the customers are
+    also Salesforce accounts and invoiced in the database, under slightly
+    different names, so that entity resolution has work to do."""
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+
+    def moment(days=730):
+        return start + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))
+
+    def iso(value):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+
+    hubspot = {object_type: {} for object_type in SINGULAR}
+    associations = defaultdict(lambda: defaultdict(list))
+
+    def add(object_type, properties):
+        # The n-th company is 10000000 + n, the n-th contact 20000000 + n, and so on.
+        object_id = str(len(hubspot[object_type]) + 1 + 10_000_000 * (list(SINGULAR).index(object_type) + 1))
+        properties["hs_lastmodifieddate"] = properties["lastmodifieddate"] = iso(moment())
+        hubspot[object_type][object_id] = {"properties": properties, "created_at": iso(start)}
+        return object_id
+
+    def link(from_type, from_id, to_type, to_id):
+        associations[(from_type, from_id)][to_type].append(to_id)
+        associations[(to_type, to_id)][from_type].append(from_id)
+
+    owners = [
+        {
+            "id": str(100 + index),
+            "firstName": FIRST_NAMES[index % len(FIRST_NAMES)],
+            "lastName": LAST_NAMES[index % len(LAST_NAMES)],
+            "email": f"owner{index}@example.com",
+        }
+        for index in range(max(3, companies // 25))
+    ]
+    accounts, opportunities, sf_contacts = [], [], []
+    customers, invoices = [], []
+    for index in range(companies):
+        name = company_name(index)
+        domain = re.sub(r"[^a-z0-9]", "", name.lower()) + ".com"
+        company_id = add("companies", {"name": name, "domain": domain})
+        for position in range(2):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            contact_id = add(
+                "contacts",
+                {"firstname": first, "lastname": last, "email": f"{first}.{last}{position}@{domain}".lower()},
+            )
+            link("companies", company_id, "contacts", contact_id)
+        for kind in DEAL_KINDS:
+            product, price = rng.choice(PRODUCTS)
+            quantity = rng.randint(1, 5)
+            deal_id = add(
+                "deals",
+                {
+                    "dealname": f"{name} {kind}",
+                    "dealstage": rng.choice(HUBSPOT_STAGES),
+                    "amount": str(price * quantity),
+                    "closedate": iso(moment()),
+                    "createdate": iso(start),
+                    "hubspot_owner_id": rng.choice(owners)["id"],
+                },
+            )
+            link("deals", deal_id, "companies", company_id)
+            for contact_id in associations[("companies", company_id)]["contacts"]:
+                link("deals", deal_id, "contacts", contact_id)
+            link(
+                "deals",
+                deal_id,
+                "line_items",
+                add("line_items", {"name": product, "quantity": str(quantity), "amount": str(price * quantity)}),
+            )
+            for activity_type in rng.sample(ACTIVITY_TYPES, 2):
+                activity_id = add(
+                    activity_type,
+                    {
+                        "hubspot_owner_id": rng.choice(owners)["id"],
+                        "hs_task_subject": f"Follow up on {name} {kind}",
+                        "hs_task_status": rng.choice(["NOT_STARTED", "COMPLETED"]),
+                        "hs_task_priority": "MEDIUM",
+                        "hs_task_type": "TODO",
+                        "hs_task_body": "Send the proposal.",
+                        "hs_note_body": f"Talked to {name} about the {kind.lower()}.",
+                        "hs_call_title": f"Call with {name}",
+                        "hs_call_body": "Discussed pricing.",
+                        "hs_call_direction": "OUTBOUND",
+                        "hs_call_disposition": "connected",
+                        "hs_call_duration": str(rng.randrange(60_000, 1_800_000)),
+                        "hs_call_status": "COMPLETED",
+                        "hs_meeting_title": f"{name} {kind} review",
+                        "hs_meeting_body": "Agenda: next steps.",
+                        "hs_meeting_location": "Zoom",
+                    },
+                )
+                link("deals", deal_id, activity_type, activity_id)
+
+        if index % 3 == 2:
+            continue
+        account_id = f"001{index:015d}"
+        accounts.append(
+            {
+                "Id": account_id,
+                "Name": f"{name} {rng.choice(LEGAL_FORMS)}",
+                "Website": f"https://www.{domain}" if index % 2 else None,
+                "Industry": rng.choice(["Retail", "Technology", "Healthcare", "Energy"]),
+                "SystemModstamp": iso(moment()).replace("Z", "+0000"),
+            }
+        )
+        for position in range(2):
+            stage, is_closed, is_won = rng.choice(SALESFORCE_STAGES)
+            owner = rng.choice(owners)
+            opportunities.append(
+                {
+                    "Id": f"006{index:012d}{position:03d}",
+                    "Name": f"{name} {DEAL_KINDS[position]}",
+                    "Amount": float(rng.choice(PRODUCTS)[1] * rng.randint(1, 5)),
+                    "StageName": stage,
+                    "IsClosed": is_closed,
+                    "IsWon": is_won,
+                    "CloseDate": moment().date().isoformat(),
+                    "AccountId": account_id,
+                    "Account": {"Name": accounts[-1]["Name"]},
+                    "OwnerId": f"005{owners.index(owner):015d}",
+                    "Owner": {"Name": f"{owner['firstName']} {owner['lastName']}"},
+                    "SystemModstamp": iso(moment()).replace("Z", "+0000"),
+                }
+            )
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        sf_contacts.append(
+            {
+                "Id": f"003{index:015d}",
+                "FirstName": first,
+                "LastName": last,
+                "Email": f"{first}.{last}@{domain}".lower(),
+                "AccountId": account_id,
+                "Account": {"Name": accounts[-1]["Name"]},
+            }
+        )
+        customer_id = len(customers) + 1
+        customers.append(
+            {"id": customer_id, "name": name.upper(), "country": rng.choice(["US", "DE", "FR", "UK"])}
+        )
+        for _ in range(rng.randint(1, 4)):
+            invoices.append(
+                {
+                    "id": len(invoices) + 1,
+                    "customer_id": customer_id,
+                    "amount": float(rng.choice(PRODUCTS)[1]),
+                    "issued_at": moment().date().isoformat(),
+                    "paid": rng.random() < 0.8,
+                }
+            )
+
+    for (object_type, object_id), linked in associations.items():
+        hubspot[object_type][object_id]["associations"] = linked
+    return {
+        "hubspot": {"objects": hubspot, "owners": owners},
+        "salesforce": {"Account": accounts, "Opportunity": opportunities, "Contact": sf_contacts},
+        "sql": {"customers": customers, "invoices": invoices},
+    }
+
+
+def load_database(engine, portal):
+    """Creates the invoice tables of `portal` in the database of `engine`,
+    replacing existing ones."""
+    metadata = MetaData()
+    customers = Table(
+        "customers",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(200)),
+        Column("country", String(2)),
+    )
+    invoices = Table(
+        "invoices",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("customer_id", Integer),
+        Column("amount", Float),
+        Column("issued_at", String(10)),
+        Column("paid", Boolean),
+    )
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(customers.insert(), portal["sql"]["customers"])
+        connection.execute(invoices.insert(), portal["sql"]["invoices"])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, method):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        if self.server.stub.latency:
+            time.sleep(self.server.stub.latency)
+        try:
+            label, status, payload, headers = self.server.stub.handle(
+                method, parsed.path, parse_qs(parsed.query), body
+            )
+        except Exception as err:
+            logger.exception(f"Stub failed to serve {method} {self.path}")
+            label, status, payload, headers = "error", 500, {"message": str(err)}, {}
+        self.server.stub.count(label)
+        if isinstance(payload, list) and payload and isinstance(payload[0], bytes):
+            # Server-sent events.
+            self.send_response(status)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for event in payload:
+                self.wfile.write(event)
+            return
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_POST(self):
+        self._serve("POST")
+
+
+class Stub:
+    """Local HTTP server standing in for a remote API, counting the requests
+    it serves per endpoint. `latency` seconds are added to every response."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+
+    def count(self, label):
+        with self._lock:
+            self.calls[label] += 1
+
+    def take_calls(self):
+        """Returns the calls counted since the previous call and resets them."""
+        with self._lock:
+            calls, self.calls = dict(self.calls), Counter()
+        return calls
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, path, query, body):
+        """Returns the endpoint label, status, JSON payload and headers."""
+        raise NotImplementedError
+
+
+def _comparable(value):
+    """Makes numbers, millisecond timestamps and ISO dates comparable."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp() * 1000
+    except ValueError:
+        return str(value).lower()
+
+
+class HubSpotStub(Stub):
+    """Serves the CRM objects, batch read, batch associations, search and
+    owners endpoints of the HubSpot API from a synthetic portal."""
+
+    def __init__(self, portal, latency=0.0):
+        self.objects = portal["hubspot"]["objects"]
+        self.owners = portal["hubspot"]["owners"]
+        super().__init__(latency)
+
+    def handle(self, method, path, query, body):
+        parts = path.strip("/").split("/")
+        if parts[:3] == ["crm", "v3", "owners"]:
+            return "owners", 200, self._page([self._owner(owner) for owner in self.owners], query), {}
+        if parts[:3] == ["crm", "v4", "associations"] and parts[5:] == ["batch", "read"]:
+            return f"associations {parts[3]} {parts[4]}", 200, self._associations(parts[3], parts[4], body), {}
+        if parts[:3] != ["crm", "v3", "objects"] or len(parts) < 4 or parts[3] not in self.objects:
+            return "unknown", 404, {"status": "error", "message": f"Unknown endpoint {path}"}, {}
+        object_type = parts[3]
+        if method == "POST" and parts[4:] == ["search"]:
+            return f"search {object_type}", 200, self._search(object_type, body), {}
+        if method == "POST" and parts[4:] == ["batch", "read"]:
+            records = [
+                self._object(object_type, item["id"], body.get("properties") or [], [])
+                for item in body["inputs"]
+                if item["id"] in self.objects[object_type]
+            ]
+            return f"batch read {object_type}", 200, self._batch(records), {}
+        properties = [name for value in query.get("properties", []) for name in value.split(",")]
+        associations = [name for value in query.get("associations", []) for name in value.split(",")]
+        if len(parts) == 5:
+            if parts[4] not in self.objects[object_type]:
+                return f"get {object_type}", 404, {"status": "error", "message": "Object not found"}, {}
+            return f"get {object_type}", 200, self._object(object_type, parts[4], properties, associations), {}
+        records = [
+            self._object(object_type, object_id, properties, associations)
+            for object_id in self.objects[object_type]
+        ]
+        return f"list {object_type}", 200, self._page(records, query), {}
+
+    def _batch(self, results):
+        return {
+            "status": "COMPLETE",
+            "results": results,
+            "startedAt": "2024-01-01T00:00:00.000Z",
+            "completedAt": "2024-01-01T00:00:00.000Z",
+        }
+
+    def _associations(self, object_type, to_type, body):
+        results = []
+        for item in body["inputs"]:
+            record = self.objects.get(object_type, {}).get(item["id"])
+            to_ids = (record or {}).get("associations", {}).get(to_type)
+            if to_ids:
+                results.append(
+                    {
+                        "from": {"id": item["id"]},
+                        "to": [
+                            {
+                                "toObjectId": int(to_id),
+                                "associationTypes": [{"category": "HUBSPOT_DEFINED", "typeId": 1, "label": None}],
+                            }
+                            for to_id in to_ids
+                        ],
+                    }
+                )
+        return self._batch(results)
+
+    def _page(self, results, query):
+        limit = int(query.get("limit", ["100"])[0])
+        after = int(query.get("after", ["0"])[0])
+        page = {"results": results[after:after + limit]}
+        if after + limit < len(results):
+            page["paging"] = {"next": {"after": str(after + limit)}}
+        return page
+
+    def _owner(self, owner):
+        return {
+            **owner,
+            "userId": int(owner["id"]),
+            "createdAt": "2023-01-01T00:00:00.000Z",
+            "updatedAt": "2023-01-01T00:00:00.000Z",
+            "archived": False,
+        }
+
+    def _object(self, object_type, object_id, properties, associations):
+        record = self.objects[object_type][object_id]
+        result = {
+            "id": object_id,
+            "properties": {name: record["properties"].get(name) for name in properties},
+            "createdAt": record["created_at"],
+            "updatedAt": record["properties"]["hs_lastmodifieddate"],
+            "archived": False,
+        }
+        linked = record.get("associations", {})
+        if associations:
+            result["associations"] = {
+                to_type: {
+                    "results": [
+                        {"id": to_id, "type": f"{SINGULAR[object_type]}_to_{SINGULAR[to_type]}"}
+                        for to_id in linked[to_type]
+                    ]
+                }
+                for to_type in associations
+                if linked.get(to_type)
+            }
+        return result
+
+    def _matches(self, record, filters):
+        for condition in filters:
+            name, operator = condition["propertyName"], condition["operator"]
+            if name.startswith("associations."):
+                linked = record.get("associations", {}).get(PLURAL[name.split(".")[1]], [])
+                if condition.get("value") not in linked:
+                    return False
+                continue
+            value = record["properties"].get(name)
+            if operator == "HAS_PROPERTY":
+                matched = value is not None
+            elif operator == "NOT_HAS_PROPERTY":
+                matched = value is None
+            elif operator == "IN":
+                matched = value in condition.get("values", [])
+            elif operator == "CONTAINS_TOKEN":
+                matched = str(condition["value"]).strip("*").lower() in str(value or "").lower()
+            else:
+                left, right = _comparable(value), _comparable(condition["value"])
+                if left is None or type(left) is not type(right):
+                    return False
+                matched = {
+                    "EQ": left == right,
+                    "NEQ": left != right,
+                    "GT": left > right,
+                    "GTE": left >= right,
+                    "LT": left < right,
+                    "LTE": left <= right,
+                }[operator]
+            if not matched:
+                return False
+        return True
+
+    def _search(self, object_type, body):
+        groups = body.get("filterGroups") or [{"filters": []}]
+        matches = [
+            object_id
+            for object_id, record in self.objects[object_type].items()
+            if any(self._matches(record, group.get("filters", [])) for group in groups)
+        ]
+        records = self.objects[object_type]
+        for sort in reversed(body.get("sorts") or []):
+            matches.sort(
+                key=lambda object_id: _comparable(records[object_id]["properties"].get(sort["propertyName"])) or 0,
+                reverse=sort.get("direction") == "DESCENDING",
+            )
+        after = int(body.get("after") or 0)
+        limit = int(body.get("limit") or 10)
+        page = {
+            "total": len(matches),
+            "results": [
+                self._object(object_type, object_id, body.get("properties") or [], [])
+                for object_id in matches[after:after + limit]
+            ],
+        }
+        if after + limit < len(matches):
+            page["paging"] = {"next": {"after": str(after + limit)}}
+        return page
+
+
+SOQL = re.compile(
+    r"^\s*select\s+(?P<fields>.+?)\s+from\s+(?P<object>\w+)"
+    r"(?:\s+where\s+(?P<where>.+?))?(?:\s+group\s+by\s+(?P<group>.+?))?"
+    r"(?:\s+order\s+by\s+(?P<order>.+?))?(?:\s+limit\s+(?P<limit>\d+))?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+SOQL_CONDITION = re.compile(
+    r"^\s*([\w.]+)\s*(=|!=|<>|<=|>=|<|>|\blike\b|\bnot in\b|\bin\b)\s*(.+?)\s*$", re.IGNORECASE
+)
+SOQL_AGGREGATE = re.compile(
+    r"^(count|count_distinct|sum|avg|min|max)\(\s*([\w.]*)\s*\)(?:\s+(\w+))?$", re.IGNORECASE
+)
+SOSL = re.compile(r"find\s+\{(?P<term>[^}]*)\}(?:.*?returning\s+(?P<returning>.+))?", re.IGNORECASE | re.DOTALL)
+
+
+def _soql_literal(text):
+    text = text.strip()
+    if text.startswith("("):
+        return [_soql_literal(item) for item in re.findall(r"'[^']*'|[^,()\s]+", text)]
+    if text.startswith("'"):
+        return text[1:-1]
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    if text.lower() == "null":
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _soql_value(record, field):
+    value = record
+    for part in field.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def _soql_matches(record, where):
+    for condition in re.split(r"\s+and\s+", where or "", flags=re.IGNORECASE):
+        if not condition.strip():
+            continue
+        match = SOQL_CONDITION.match(condition)
+        if match is None:
+            raise ValueError(f"Unsupported condition: {condition}")
+        field, operator, literal = match.group(1), match.group(2).lower(), _soql_literal(match.group(3))
+        value = _soql_value(record, field)
+        if operator == "like":
+            pattern = re.escape(literal).replace("%", ".*").replace("_", ".")
+            matched = value is not None and re.fullmatch(pattern, str(value), re.IGNORECASE) is not None
+        elif operator in ("in", "not in"):
+            matched = (value in literal) == (operator == "in")
+        elif operator in ("=", "!=", "<>"):
+            if isinstance(literal, str) and isinstance(value, str) and re.match(r"\d{4}-\d{2}-\d{2}", literal):
+                value, literal = value[:len(literal.rstrip("Z"))], literal.rstrip("Z")
+            matched = (value == literal) == (operator == "=")
+        else:
+            if value is None:
+                return False
+            if isinstance(literal, str):
+                # Dates and datetimes compare as strings of the same precision.
+                value, literal = str(value)[:19], literal.rstrip("Z")[:19]
+            matched = {
+                "<": value < literal,
+                ">": value > literal,
+                "<=": value <= literal,
+                ">=": value >= literal,
+            }[operator]
+        if not matched:
+            return False
+    return True
+
+
+class SalesforceStub(Stub):
+    """Serves the query and search endpoints of the Salesforce REST API from a
+    synthetic org. SOQL is supported as far as plain fields, relationship
+    fields, AND-ed conditions, GROUP BY with aggregates, ORDER BY and LIMIT go."""
+
+    PAGE_SIZE = 2000
+
+    def __init__(self, portal, latency=0.0):
+        self.records = portal["salesforce"]
+        self._cursors = {}
+        self._api_calls = 0
+        super().__init__(latency)
+
+    def handle(self, method, path, query, body):
+        with self._lock:
+            self._api_calls += 1
+            headers = {"Sforce-Limit-Info": f"api-usage={self._api_calls}/100000"}
+        match = re.match(r"^/services/data/v[\d.]+/(query|queryAll|search)/?(.*)$", path)
+        if match is None:
+            return "unknown", 404, [{"errorCode": "NOT_FOUND", "message": f"Unknown endpoint {path}"}], headers
+        endpoint, locator = match.groups()
+        try:
+            if endpoint == "search":
+                return "search", 200, self._search(query["q"][0]), headers
+            if locator:
+                return "query_more", 200, self._page(locator), headers
+            return "query", 200, self._query(query["q"][0]), headers
+        except (KeyError, ValueError) as err:
+            return endpoint, 400, [{"errorCode": "MALFORMED_QUERY", "message": str(err)}], headers
+
+    def _query(self, soql):
+        match = SOQL.match(soql)
+        if match is None or match.group("object") not in self.records:
+            raise ValueError(f"Unsupported query: {soql}")
+        object_name = match.group("object")
+        fields = [field.strip() for field in match.group("fields").split(",")]
+        rows = [record for record in self.records[object_name] if _soql_matches(record, match.group("where"))]
+        if fields == ["COUNT()"] or fields == ["count()"]:
+            return {"totalSize": len(rows), "done": True, "records": []}
+        if match.group("group") or any(SOQL_AGGREGATE.match(field) for field in fields):
+            records = self._aggregate(rows, fields, match.group("group"))
+        else:
+            records = [self._record(object_name, record, fields) for record in rows]
+        if match.group("order"):
+            for clause in reversed(match.group("order").split(",")):
+                field, _, direction = clause.strip().partition(" ")
+                records.sort(
+                    key=lambda record: (_soql_value(record, field) is None, _soql_value(record, field) or 0),
+                    reverse=direction.strip().lower().startswith("desc"),
+                )
+        if match.group("limit"):
+            records = records[:int(match.group("limit"))]
+        locator = f"01g{len(self._cursors):015d}"
+        self._cursors[locator] = records
+        return self._page(f"{locator}-0")
+
+    def _page(self, locator):
+        cursor, _, offset = locator.partition("-")
+        records = self._cursors[cursor]
+        offset = int(offset)
+        end = offset + self.PAGE_SIZE
+        page = {"totalSize": len(records), "done": end >= len(records), "records": records[offset:end]}
+        if not page["done"]:
+            page["nextRecordsUrl"] = f"/services/data/v57.0/query/{cursor}-{end}"
+        else:
+            del self._cursors[cursor]
+        return page
+
+    def _record(self, object_name, record, fields):
+        result = {
+            "attributes": {
+                "type": object_name,
+                "url": f"/services/data/v57.0/sobjects/{object_name}/{record['Id']}",
+            }
+        }
+        for field in fields:
+            target, parts = result, field.split(".")
+            for part in parts[:-1]:
+                target = target.setdefault(part, {"attributes": {"type": part}})
+            target[parts[-1]] = _soql_value(record, field)
+        return result
+
+    def _aggregate(self, rows, fields, group):
+        group_fields = [field.strip() for field in (group or "").split(",") if field.strip()]
+        groups = defaultdict(list)
+        for row in rows:
+            groups[tuple(_soql_value(row, field) for field in group_fields)].append(row)
+        records = []
+        for key, members in groups.items():
+            record = {"attributes": {"type": "AggregateResult"}}
+            expression = 0
+            for field in fields:
+                aggregate = SOQL_AGGREGATE.match(field)
+                if aggregate is None:
+                    record[field.split(".")[-1]] = key[group_fields.index(field)]
+                    continue
+                function, argument, alias = aggregate.group(1).lower(), aggregate.group(2), aggregate.group(3)
+                values = [_soql_value(member, argument) for member in members]
+                values = [value for value in values if value is not None]
+                if alias is None:
+                    alias, expression = f"expr{expression}", expression + 1
+                if function == "count":
+                    record[alias] = len(values) if argument else len(members)
+                elif function == "count_distinct":
+                    record[alias] = len(set(values))
+                elif not values:
+                    record[alias] = None
+                elif function == "avg":
+                    record[alias] = sum(values) / len(values)
+                else:
+                    record[alias] = {"sum": sum, "min": min, "max": max}[function](values)
+            records.append(record)
+        return records
+
+    def _search(self, sosl):
+        match = SOSL.search(sosl)
+        if match is None:
+            raise ValueError(f"Unsupported search: {sosl}")
+        term = match.group("term").strip("*\"' ").lower()
+        returning = {}
+        for object_name, field_list in re.findall(r"(\w+)\s*(?:\(([^)]*)\))?", match.group("returning") or ""):
+            if object_name in self.records:
+                fields = [field.strip() for field in field_list.split(",") if field.strip()]
+                returning[object_name] = fields or ["Id"]
+        results = []
+        for object_name, fields in (returning or {name: ["Id"] for name in self.records}).items():
+            for record in self.records[object_name]:
+                text = " ".join(str(value) for value in record.values() if isinstance(value, str)).lower()
+                if term in text:
+                    results.append(self._record(object_name, record, fields))
+        return {"searchRecords": results}
+
+
+class _StubAdapter(HTTPAdapter):
+    """Sends the requests of a client logged in to `https://salesforce.stub`
+    to a local stub; simple_salesforce only speaks https."""
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+
+    def send(self, request, **kwargs):
+        request.url = request.url.replace("https://salesforce.stub", self.url, 1)
+        return super().send(request, **kwargs)
+
+
+def salesforce_stub_login(stub):
+    """Returns a `login(session)` for SalesforcePool that connects to `stub`."""
+
+    def login(session):
+        session.mount("https://salesforce.stub", _StubAdapter(stub.url))
+        return Salesforce(instance_url="https://salesforce.stub", session_id="benchmark", session=session)
+
+    return login
+
+
+def embedding(text, dimensions=256):
+    """Deterministic bag-of-words embedding, so that questions sharing words are similar."""
+    vector = np.zeros(dimensions)
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % dimensions] += 1
+    norm = np.linalg.norm(vector)
+    return list(vector / norm if norm else vector)
+
+
+class LLMStub(Stub):
+    """OpenAI-compatible chat completions and embeddings server answering
+    from a script.
+
+    `script` maps an agent to its steps: `orchestrator`, `hubspot` and
+    `salesforce` to a list whose n-th item answers the n-th LLM turn after the
+    user prompt, either a list of `{"name", "arguments"}` tool calls or the
+    final answer; `sql` to `{"query", "answer"}` for the two steps of the SQL
+    chain. Turns past the end of a script get a canned answer.
+    """
+
+    # A tool only offered to the agent, identifying the agent calling.
+    AGENT_TOOLS = {
+        "get_unified_customers": "orchestrator",
+        "get_all_deals": "hubspot",
+        "execute_soql": "salesforce",
+    }
+    FINAL_ANSWER = "That is all the data I found."
+
+    def __init__(self, latency=0.0):
+        self.script = {}
+        self.usage = defaultdict(Counter)
+        self._tool_calls = 0
+        super().__init__(latency)
+
+    def take_usage(self):
+        with self._lock:
+            usage, self.usage = {agent: dict(counts) for agent, counts in self.usage.items()}, defaultdict(Counter)
+        return usage
+
+    def handle(self, method, path, query, body):
+        if path.endswith("/embeddings"):
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            return "embeddings", 200, {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": embedding(text)}
+                    for index, text in enumerate(texts)
+                ],
+                "model": body["model"],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }, {}
+        if not path.endswith("/chat/completions"):
+            return "unknown", 404, {"error": {"message": f"Unknown endpoint {path}"}}, {}
+        tools = body.get("tools") or [{"function": function} for function in body.get("functions") or []]
+        tool_names = {tool["function"]["name"] for tool in tools}
+        agent = next((agent for name, agent in self.AGENT_TOOLS.items() if name in tool_names), "sql")
+        message = self._reply(agent, body["messages"])
+        prompt_tokens = count_prompt_tokens(body["messages"], tools or None)
+        completion_tokens = count_message_tokens(message)
+        with self._lock:
+            self.usage[agent]["requests"] += 1
+            self.usage[agent]["prompt_tokens"] += prompt_tokens
+            self.usage[agent]["completion_tokens"] += completion_tokens
+        finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+        if body.get("stream"):
+            delta = dict(message)
+            if delta.get("tool_calls"):
+                delta["tool_calls"] = [
+                    {**tool_call, "index": index} for index, tool_call in enumerate(delta["tool_calls"])
+                ]
+            chunks = [
+                {"choices": [{"index": 0, "delta": delta, "finish_reason": None}]},
+                {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]},
+            ]
+            events = [f"data: {json.dumps(chunk)}\n\n".encode() for chunk in chunks] + [b"data: [DONE]\n\n"]
+            return f"chat {agent}", 200, events, {}
+        return f"chat {agent}", 200, {
+            "id": f"chatcmpl-{self._tool_calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }, {}
+
+    def _reply(self, agent, messages):
+        if agent == "sql":
+            sql = self.script.get("sql", {})
+            if messages[-1]["content"].rstrip().endswith("Answer:"):
+                return {"role": "assistant", "content": sql.get("answer", self.FINAL_ANSWER)}
+            return {"role": "assistant", "content": sql.get("query", "SELECT 1")}
+        prompt_index = max(index for index, message in enumerate(messages) if message["role"] == "user")
+        turn = sum(1 for message in messages[prompt_index:] if message["role"] == "assistant")
+        steps = self.script.get(agent, [])
+        step = steps[turn] if turn < len(steps) else self.FINAL_ANSWER
+        if isinstance(step, str):
+            return {"role": "assistant", "content": step}
+        tool_calls = []
+        with self._lock:
+            for call in step:
+                self._tool_calls += 1
+                tool_calls.append(
+                    {
+                        "id": f"call_{self._tool_calls}",
+                        "type": "function",
+                        "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))},
+                    }
+                )
+        return {"role": "assistant", "content": None, "tool_calls": tool_calls}
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe in-memory cache with per-entry TTL and LRU eviction.
+
+    Concurrent misses for the same key are coalesced: only the first caller
+    runs the loader, the others wait for its result.
+    """
+
+    def __init__(self, maxsize=128, default_ttl=300):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Returns the cached value for `key`, calling `loader()` on a miss."""
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                is_loader = False
+            else:
+                is_loader = True
+                future = Future()
+                self._in_flight[key] = future
+                generation = self._generation
+                self.loads += 1
+        if not is_loader:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as err:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(err)
+            raise
+        with self._lock:
+            self._in_flight.pop(key, None)
+            # Don't store values loaded before an invalidation happened.
+            if generation == self._generation:
+                self._store(key, value, ttl)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, predicate=None):
+        """Drops all entries, or only the ones whose key matches `predicate`."""
+        with self._lock:
+            self._generation += 1
+            if predicate is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -1,5 +1,11 @@
+from dotenv import load_dotenv
+
+# Before any module of the app: they read their settings on import.
+load_dotenv()
+
 import pandas as pd
 import streamlit as st
+from message_log import MessageLog
 from orchestrator import get_response, SYSTEM_PROMPT
 import psycopg2
 
@@ -11,7 +17,7 @@ def main():
     query = st.text_input("Enter your query:")
     if query:
         try:
-            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            messages = MessageLog([{"role": "system", "content": SYSTEM_PROMPT}])
             response = get_response(query, messages)
             format_response(response)
         except psycopg2.OperationalError:
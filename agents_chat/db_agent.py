@@ -1,11 +1,17 @@
+import logging
 import os
 
-from langchain import SQLDatabase
 from langchain.chat_models import ChatOpenAI
 from langchain_experimental.sql import SQLDatabaseChain
+from sqlalchemy import create_engine
 
-from dotenv import load_dotenv
-load_dotenv()
+from cache_utils import TTLCache
+from resources import Lazy, ResourceUnavailable
+from schema_snapshot import SnapshotSQLDatabase
+from sql_plan_cache import SQLPlanCache
+from tracing import current_span, traced
+
+logger = logging.getLogger(__name__)
 
 API_KEY = os.getenv('OPENAI_API_KEY')
 DB_USER = os.getenv('DB_USER')
@@ -13,19 +19,67 @@ DB_PASS = os.getenv('DB_PASS')
 DB_HOST = os.getenv('DB_HOST')
 DB_NAME = os.getenv('DB_NAME')
 hub_api = os.getenv("HUB_API")
+SQL_PLAN_CACHE_SIZE = int(os.getenv("SQL_PLAN_CACHE_SIZE", 256))
+# Seconds between checks of the database schema for changes.
+SCHEMA_CHECK_INTERVAL = int(os.getenv("SCHEMA_CHECK_INTERVAL", 300))
+DB_SCHEMA_SNAPSHOT_PATH = os.getenv("DB_SCHEMA_SNAPSHOT_PATH", "db_schema_snapshot.json")
+# SQLAlchemy URL replacing the Postgres settings above, e.g. sqlite:///bench.sqlite3
+DB_URL = os.getenv("DB_URL") or f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}:5432/{DB_NAME}"
 
 
-db = SQLDatabase.from_uri(
-    f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}:5432/{DB_NAME}",
-    engine_args={"pool_pre_ping": True},
+_db = Lazy(
+    "Postgres",
+    lambda: SnapshotSQLDatabase(
+        create_engine(DB_URL, pool_pre_ping=True),
+        DB_SCHEMA_SNAPSHOT_PATH,
+    ),
+)
+_db_chain = Lazy(
+    "Postgres SQL chain",
+    lambda: SQLDatabaseChain.from_llm(
+        ChatOpenAI(temperature=0.00000001, openai_api_key=API_KEY, model_name='gpt-3.5-turbo-16k'),
+        get_db(),
+        top_k=100,
+        verbose=True,
+        return_intermediate_steps=True,
+    ),
 )
-llm = ChatOpenAI(temperature=0.00000001, openai_api_key=API_KEY, model_name='gpt-3.5-turbo-16k')
-db_chain = SQLDatabaseChain.from_llm(llm, db, top_k=100, verbose=True)
+sql_plans = SQLPlanCache(maxsize=SQL_PLAN_CACHE_SIZE)
+_schema_fingerprints = TTLCache(maxsize=1, default_ttl=SCHEMA_CHECK_INTERVAL)
+
+
+def get_db():
+    """Returns the database, loading its schema snapshot on first use."""
+    return _db.get()
+
+
+def get_db_chain():
+    return _db_chain.get()
+
+
+def current_schema_fingerprint():
+    """Returns the catalog hash of the schema snapshot, refreshing the snapshot
+    at most every SCHEMA_CHECK_INTERVAL seconds."""
+    return _schema_fingerprints.get_or_load("schema", lambda: get_db().refresh())
+
+
+def answer_from_sql(query, sql):
+    """Runs `sql` and lets the LLM phrase the answer, like the second step of
+    the SQL chain. The schema is left out, the query and its result are enough."""
+    db_chain = get_db_chain()
+    result = db_chain.database.run(sql)
+    return db_chain.llm_chain.predict(
+        input=f"{query}\nSQLQuery:{sql}\nSQLResult: {result}\nAnswer:",
+        top_k=str(db_chain.top_k),
+        dialect=db_chain.database.dialect,
+        table_info="",
+        stop=["\nSQLResult:"],
+    ).strip()
 
 
+@traced("sql.ask_db_agent")
 def ask_db_agent(question):
-    print("querying sql chain")
-    print(question)
+    logger.info(f"Querying the SQL chain:\n {question}")
     sql_agent_prompt = """
     For any given input question, perform the following tasks:
     1. Construct a syntactically correct PostgreSQL query to address the question.
@@ -39,7 +93,28 @@ def ask_db_agent(question):
     SQLResult: Result of the SQLQuery
     Answer: Result of the SQLQuery  
     """
-    return db_chain.run(sql_agent_prompt.format(question=question))
+    query = sql_agent_prompt.format(question=question)
+    try:
+        fingerprint = current_schema_fingerprint()
+    except ResourceUnavailable as err:
+        return str(err)
+    sql = sql_plans.lookup(question, fingerprint)
+    current_span().set(plan_cache_hit=sql is not None)
+    if sql is not None:
+        logger.info(f"Answering from cached SQL plan:\n {sql}")
+        try:
+            return answer_from_sql(query, sql)
+        except Exception as err:
+            logger.warning(f"Cached SQL plan failed, generating a new one: {err}")
+            sql_plans.discard(question)
+    outputs = get_db_chain()(
+        {"query": query, "table_names_to_use": get_db().relevant_table_names(question)}
+    )
+    for step in outputs["intermediate_steps"]:
+        if isinstance(step, dict) and "sql_cmd" in step:
+            # The chain raises if the query fails, so this SQL ran successfully.
+            sql_plans.store(question, step["sql_cmd"], fingerprint)
+    return outputs["result"]
 
 
 # if __name__ == "__main__":
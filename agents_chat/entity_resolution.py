@@ -0,0 +1,339 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import text
+
+from db_agent import get_db
+from hubspot_utils import iter_objects, sync_mirror
+from resources import Lazy
+from salesforce_utils import get_sf_pool
+
+logger = logging.getLogger(__name__)
+
+# Words dropped from the end of company names before matching.
+LEGAL_SUFFIXES = {
+    "ab", "ag", "as", "bv", "co", "company", "corp", "corporation", "gmbh", "inc", "incorporated",
+    "kg", "limited", "llc", "llp", "lp", "ltd", "nv", "oy", "plc", "pty", "sa", "sarl", "sas", "spa",
+    "srl",
+}
+# Cosine similarity of the character trigrams of two normalized names above
+# which they are considered the same company.
+MATCH_THRESHOLD = float(os.getenv("ENTITY_MATCH_THRESHOLD", 0.85))
+# Order in which sources provide the display name of a company.
+NAME_PRIORITY = ["hubspot", "salesforce", "sql"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    name TEXT,
+    domain TEXT,
+    normalized_name TEXT NOT NULL,
+    block TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    PRIMARY KEY (source, key)
+);
+CREATE INDEX IF NOT EXISTS records_block ON records (block);
+CREATE INDEX IF NOT EXISTS records_domain ON records (domain);
+CREATE TABLE IF NOT EXISTS source_state (
+    source TEXT PRIMARY KEY,
+    watermark TEXT,
+    last_full_refresh REAL NOT NULL,
+    last_refresh REAL NOT NULL
+);
+"""
+
+
+def normalize_name(name):
+    name = unicodedata.normalize("NFKD", name or "").encode("ascii", "ignore").decode().lower()
+    words = re.findall(r"[a-z0-9]+", name.replace("&", " and "))
+    while len(words) > 1 and words[-1] in LEGAL_SUFFIXES:
+        words.pop()
+    if len(words) > 1 and words[0] == "the":
+        words.pop(0)
+    return " ".join(words)
+
+
+def normalize_domain(value):
+    """Returns the host of a domain, website or email address without www."""
+    value = (value or "").strip().lower()
+    value = value.rsplit("@", 1)[-1]
+    value = re.sub(r"^[a-z]+://", "", value).split("/")[0].split(":")[0]
+    if value.startswith("www."):
+        value = value[4:]
+    return value if "." in value else ""
+
+
+def blocking_key(normalized_name):
+    """Only names sharing their first three letters are compared."""
+    return normalized_name.replace(" ", "")[:3]
+
+
+def trigram_vectors(names):
+    """Returns the L2-normalized character trigram counts of `names`, one row
+    per name, so that their dot products are cosine similarities."""
+    grams = [Counter(f"  {name} "[i:i + 3] for i in range(len(name) + 1)) for name in names]
+    vocabulary = {gram: column for column, gram in enumerate({gram for counts in grams for gram in counts})}
+    vectors = np.zeros((len(names), len(vocabulary)))
+    for row, counts in enumerate(grams):
+        for gram, count in counts.items():
+            vectors[row, vocabulary[gram]] = count
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class CompanyIndex:
+    """Persistent crosswalk of the companies of several sources.
+
+    `sources` maps a source name to `load(watermark)`, returning the source's
+    companies as dicts with `key`, `name` and `domain`, and a new watermark.
+    With a None watermark a loader returns all companies; otherwise only the
+    ones changed since and companies missing from the result are kept.
+
+    Records of a source are linked to an entity when they share a domain or
+    when their names are similar enough; only changed records are matched
+    again on a refresh, against the records of their blocking key.
+    """
+
+    def __init__(self, path, sources, full_refresh_interval=24 * 3600):
+        self.sources = sources
+        self.full_refresh_interval = full_refresh_interval
+        self.unavailable = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, max_age=0, sources=None):
+        """Loads the changes of every source, or only of `sources`, refreshed
+        more than `max_age` seconds ago. Sources that fail are skipped and
+        reported as unavailable."""
+        with self._refresh_lock:
+            for source, load in self.sources.items():
+                if sources is not None and source not in sources:
+                    continue
+                with self._lock:
+                    state = self._conn.execute(
+                        "SELECT watermark, last_full_refresh, last_refresh FROM source_state WHERE source = ?",
+                        (source,),
+                    ).fetchone()
+                now = time.time()
+                if state is not None and now - state[2] < max_age:
+                    continue
+                full = state is None or state[0] is None or now - state[1] > self.full_refresh_interval
+                try:
+                    records, watermark = load(None if full else state[0])
+                except Exception as err:
+                    logger.warning(f"Could not load companies of {source}: {err}")
+                    self.unavailable[source] = str(err)
+                    continue
+                self.unavailable.pop(source, None)
+                changed = self._apply(source, records, full)
+                with self._lock, self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO source_state VALUES (?, ?, ?, ?)",
+                        (source, watermark, now if full else state[1], now),
+                    )
+                logger.info(f"Refreshed {len(records)} companies of {source}, {changed} changed")
+
+    def _apply(self, source, records, full):
+        with self._lock:
+            existing = {
+                key: (name, domain)
+                for key, name, domain in self._conn.execute(
+                    "SELECT key, name, domain FROM records WHERE source = ?", (source,)
+                )
+            }
+        changed = []
+        for record in records:
+            key, name, domain = str(record["key"]), record.get("name"), normalize_domain(record.get("domain"))
+            if existing.get(key) != (name, domain):
+                changed.append({"source": source, "key": key, "name": name, "domain": domain})
+        with self._lock, self._conn:
+            if full:
+                keys = {str(record["key"]) for record in records}
+                self._conn.executemany(
+                    "DELETE FROM records WHERE source = ? AND key = ?",
+                    [(source, key) for key in existing if key not in keys],
+                )
+            self._conn.executemany(
+                "DELETE FROM records WHERE source = ? AND key = ?",
+                [(source, record["key"]) for record in changed],
+            )
+        self._resolve(changed)
+        return len(changed)
+
+    def _resolve(self, records):
+        blocks = defaultdict(list)
+        for record in records:
+            record["normalized_name"] = normalize_name(record["name"])
+            record["block"] = blocking_key(record["normalized_name"])
+            blocks[record["block"]].append(record)
+        for block, block_records in blocks.items():
+            with self._lock:
+                members = [
+                    {"normalized_name": normalized_name, "entity_id": entity_id}
+                    for normalized_name, entity_id in self._conn.execute(
+                        "SELECT normalized_name, entity_id FROM records WHERE block = ? AND block != ''",
+                        (block,),
+                    )
+                ]
+            candidates = members + block_records
+            # One vocabulary for all names, so that the vectors are comparable.
+            vectors = trigram_vectors([candidate["normalized_name"] for candidate in candidates])
+            similarities = vectors[len(members):] @ vectors.T
+            for row, record in enumerate(block_records):
+                # Members and the records of this batch resolved before this one.
+                resolved = len(members) + row
+                record["entity_id"] = self._entity_of_domain(record["domain"])
+                if record["entity_id"] is None and block and resolved:
+                    best = int(np.argmax(similarities[row, :resolved]))
+                    if similarities[row, best] >= MATCH_THRESHOLD:
+                        record["entity_id"] = candidates[best]["entity_id"]
+                if record["entity_id"] is None:
+                    record["entity_id"] = f"company-{uuid.uuid4().hex[:12]}"
+                with self._lock, self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            record["source"],
+                            record["key"],
+                            record["name"],
+                            record["domain"],
+                            record["normalized_name"],
+                            record["block"],
+                            record["entity_id"],
+                        ),
+                    )
+
+    def _entity_of_domain(self, domain):
+        if not domain:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT entity_id FROM records WHERE domain = ? LIMIT 1", (domain,)).fetchone()
+        return row[0] if row else None
+
+    def entities(self, sources=None, searched_sources=None):
+        """Returns the resolved companies, only the ones found in all of
+        `sources` if given, with the keys they have in every source. Only the
+        records of `searched_sources` are read if given."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entity_id, source, key, name, domain FROM records ORDER BY entity_id"
+            ).fetchall()
+        entities = {}
+        for entity_id, source, key, name, domain in rows:
+            if searched_sources is not None and source not in searched_sources:
+                continue
+            entity = entities.setdefault(entity_id, {"names": {}, "domain": None, "ids": defaultdict(list)})
+            entity["names"].setdefault(source, name)
+            entity["domain"] = entity["domain"] or domain or None
+            entity["ids"][source].append(key)
+        results = []
+        for entity in entities.values():
+            if sources and not all(source in entity["ids"] for source in sources):
+                continue
+            name = next(
+                (entity["names"][source] for source in NAME_PRIORITY if entity["names"].get(source)),
+                next(iter(entity["names"].values())),
+            )
+            results.append({"name": name, "domain": entity["domain"], "ids": dict(entity["ids"])})
+        return sorted(results, key=lambda entity: (entity["name"] or "").lower())
+
+
+def load_hubspot_companies(watermark):
+    # Read from the local mirror, which syncs incrementally.
+    sync_mirror("companies")
+    records = [
+        {"key": raw.id, "name": raw.properties.get("name"), "domain": raw.properties.get("domain")}
+        for raw in iter_objects("companies")
+    ]
+    return records, None
+
+
+def load_salesforce_accounts(watermark):
+    query = "SELECT Id, Name, Website, SystemModstamp FROM Account"
+    if watermark:
+        query += f" WHERE SystemModstamp >= {watermark}"
+    accounts = get_sf_pool().call(lambda sf: list(sf.query_all_iter(query)))
+    records = [{"key": account["Id"], "name": account["Name"], "domain": account["Website"]} for account in accounts]
+    if not accounts:
+        return records, watermark
+    newest = max(
+        datetime.strptime(account["SystemModstamp"], "%Y-%m-%dT%H:%M:%S.%f%z") for account in accounts
+    )
+    return records, newest.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# Query returning the `key`, `name` and optionally `domain` of the invoiced
+# companies in the SQL database, e.g.
+# SELECT DISTINCT customer_id AS key, customer_name AS name FROM invoices
+ENTITY_SQL_COMPANIES_QUERY = os.getenv("ENTITY_SQL_COMPANIES_QUERY")
+
+
+def load_sql_companies(watermark):
+    with get_db().engine.connect() as connection:
+        rows = connection.execute(text(ENTITY_SQL_COMPANIES_QUERY)).mappings().all()
+    return [{"key": row["key"], "name": row["name"], "domain": row.get("domain")} for row in rows], None
+
+
+ENTITY_INDEX_PATH = os.getenv("ENTITY_INDEX_PATH", "entity_index.sqlite3")
+# Seconds the crosswalk may lag behind the sources.
+ENTITY_REFRESH_INTERVAL = int(os.getenv("ENTITY_REFRESH_INTERVAL", 300))
+_customer_index = Lazy(
+    "Customer index",
+    lambda: CompanyIndex(
+        ENTITY_INDEX_PATH,
+        {
+            "hubspot": load_hubspot_companies,
+            "salesforce": load_salesforce_accounts,
+            **({"sql": load_sql_companies} if ENTITY_SQL_COMPANIES_QUERY else {}),
+        },
+    ),
+)
+
+
+def get_unified_customers(sources=None, searched_sources=None):
+    """Returns the customers of all sources, or of `searched_sources`, with
+    duplicates merged, along with their ids in every source. Sources outside
+    `searched_sources` aren't queried."""
+    index = _customer_index.get()
+    index.refresh(max_age=ENTITY_REFRESH_INTERVAL, sources=searched_sources)
+    customers = index.entities(sources, searched_sources)
+    by_source = Counter(source for customer in customers for source in customer["ids"])
+    response = {
+        "customer_count": len(customers),
+        "customers_per_source": dict(by_source),
+        "results": customers,
+    }
+    unavailable = {
+        source: error
+        for source, error in index.unavailable.items()
+        if searched_sources is None or source in searched_sources
+    }
+    if unavailable:
+        response["unavailable_sources"] = unavailable
+    return response
+
+
+def customer_names(sources=None):
+    """Maps the (source, key) of every company record to its customer's name,
+    refreshing only the companies of `sources` if given."""
+    index = _customer_index.get()
+    index.refresh(max_age=ENTITY_REFRESH_INTERVAL, sources=sources)
+    return {
+        (source, key): customer["name"]
+        for customer in index.entities()
+        for source, keys in customer["ids"].items()
+        for key in keys
+    }
@@ -1,10 +1,27 @@
-from flask import Flask, render_template, request, session, redirect, url_for
+from dotenv import load_dotenv
+
+# Before any module of the app: they read their settings on import.
+load_dotenv()
+
+from resources import RESOURCES, resource_status, warm_up
+from flask import Flask, Response, jsonify, render_template, request, session, redirect, url_for
 from orchestrator import get_response, SYSTEM_PROMPT
+from db_agent import sql_plans
+from hubspot_agent import llm_cache
+from hubspot_utils import cache_stats, hubspot_api_stats
+from message_log import MessageLog
+from router import routing_stats
+from salesforce_utils import salesforce_stats
+from session_store import create_session_store
+from tracing import recent_traces, trace_metrics
 import psycopg2
 import uuid
 import secrets
 import os
+import json
 import logging
+import queue
+import threading
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -12,75 +29,183 @@ logging.basicConfig(level=logging.INFO)
 app = Flask(__name__)
 app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_TYPE"] = "filesystem"
-app.secret_key = secrets.token_hex(16)
+# All workers must share the key to read each other's session cookies.
+app.secret_key = os.getenv("FLASK_SECRET_KEY") or secrets.token_hex(16)
 
 HISTORY_TOKEN_LIMIT = 6_000
 MAX_CONVERSATIONS = 5
 MAX_RETRIES = 3
-CONVERSATIONS = {}
-MESSAGES = {}
+# Use e.g. sqlite:///var/lib/chatbot/sessions.sqlite3 to share sessions between workers.
+SESSION_STORE = create_session_store(os.getenv("SESSION_STORE_URL") or "memory://")
+# Clients of the data sources are created on first use; warming them up in
+# the background spares the first queries the login and schema reflection.
+if os.getenv("WARM_UP_CLIENTS", "true").lower() == "true":
+    warm_up()
+
+
+def new_session_state():
+    return {"conversations": [], "messages": MessageLog([{"role": "system", "content": SYSTEM_PROMPT}])}
+
+
+def load_session_state(session_id):
+    state = SESSION_STORE.load(session_id) or new_session_state()
+    # Stores serializing to JSON return the log as a plain list.
+    if not isinstance(state["messages"], MessageLog):
+        state["messages"] = MessageLog(state["messages"])
+    return state
 
 
 def trim_history(messages):
-    messages.pop(1)
-    while messages[1]["role"] != "user" and len(messages) > 1:
-        messages.pop(1)
+    """Drops the oldest turns until the history fits into HISTORY_TOKEN_LIMIT."""
+    tokens = messages.drop_oldest_turns(HISTORY_TOKEN_LIMIT)
+    logger.info(f"Conversation history has {tokens} tokens")
 
 
-def handle_query(query, session_id):
+def handle_query(query, session_id, on_token=None, on_progress=None, on_plan=None):
     response = ""
     if query:
-        retries = 0
-        while retries < MAX_RETRIES:
-            try:
-                response, total_tokens = get_response(query, MESSAGES[session_id])
-                logger.info(f"Whole conversation has {total_tokens=}")
-                if total_tokens > HISTORY_TOKEN_LIMIT:
-                    trim_history(MESSAGES[session_id])
-                    logger.info(f"Conversation was longer that {HISTORY_TOKEN_LIMIT}. Trimmed it down")
-                break
-            except psycopg2.OperationalError:
-                response = "Database connection error. Please try again."
-                logger.exception("DataBase error")
-                retries += 1
-                if retries == MAX_RETRIES:
-                    response += " Max retries reached. Please ask your question again."
-            except Exception as e:
-                response = "An error occurred. Please ask your question again or rephrase your question."
-                logger.exception("Exception error")
-                break
+        with SESSION_STORE.lock(session_id):
+            state = load_session_state(session_id)
+            response = answer_query(query, state, on_token, on_progress, on_plan)
+            SESSION_STORE.save(session_id, state)
+    return response
 
-        if not response:
-            response = "An error occurred. Please ask your question again."
 
-        CONVERSATIONS[session_id].append((query, response))
-        if len(CONVERSATIONS[session_id]) > MAX_CONVERSATIONS:
-            CONVERSATIONS[session_id].pop(0)  # Remove the oldest conversation
+def answer_query(query, state, on_token=None, on_progress=None, on_plan=None):
+    response = ""
+    retries = 0
+    while retries < MAX_RETRIES:
+        try:
+            trim_history(state["messages"])
+            response, total_tokens = get_response(
+                query, state["messages"], on_token=on_token, on_progress=on_progress, on_plan=on_plan
+            )
+            logger.info(f"Whole conversation has {total_tokens=}")
+            break
+        except psycopg2.OperationalError:
+            response = "Database connection error. Please try again."
+            logger.exception("DataBase error")
+            retries += 1
+            if retries == MAX_RETRIES:
+                response += " Max retries reached. Please ask your question again."
+        except Exception as e:
+            response = "An error occurred. Please ask your question again or rephrase your question."
+            logger.exception("Exception error")
+            break
+
+    if not response:
+        response = "An error occurred. Please ask your question again."
+
+    state["conversations"].append((query, response))
+    if len(state["conversations"]) > MAX_CONVERSATIONS:
+        state["conversations"].pop(0)  # Remove the oldest conversation
+    return response
+
+
+def get_session_id():
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    return session['session_id']
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    if 'session_id' not in session:
-        session_id = str(uuid.uuid4())
-        session['session_id'] = session_id
-        CONVERSATIONS[session_id] = []
-        MESSAGES[session_id] = [{"role": "system", "content": SYSTEM_PROMPT}]
-    session_id = session['session_id']
+    session_id = get_session_id()
 
     if request.method == 'POST':
         query = request.form.get('query')
         handle_query(query, session_id)
 
-    return render_template('index.html', conversations=CONVERSATIONS[session_id])
+    state = SESSION_STORE.load(session_id) or new_session_state()
+    return render_template('index.html', conversations=state["conversations"])
+
+
+@app.route('/stream')
+def stream():
+    """Answers the `query` parameter as Server-Sent Events: `progress` events
+    while sources are queried, `token` events with the answer as it is
+    generated and a final `done` event with the whole answer.
+
+    The LLM may write a plan before querying the sources, streamed as `token`
+    events as well since it can't be told apart until the sources are
+    queried. A `plan` event with its text follows, and clients drop the
+    tokens received since the previous `plan` event from the answer."""
+    session_id = get_session_id()
+    query = request.args.get('query')
+    events = queue.Queue()
+
+    def run():
+        try:
+            response = handle_query(
+                query,
+                session_id,
+                on_token=lambda token: events.put(sse_event("token", token)),
+                on_progress=lambda message: events.put(sse_event("progress", message)),
+                on_plan=lambda plan: events.put(sse_event("plan", plan)),
+            )
+            events.put(sse_event("done", response))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield event
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route('/clear_session', methods=['POST'])
 def clear_session():
-    session_id = session.pop("session_id")
-    CONVERSATIONS.pop(session_id)
-    MESSAGES.pop(session_id)
+    session_id = session.pop("session_id", None)
+    if session_id:
+        SESSION_STORE.delete(session_id)
     return redirect(url_for('index'))
 
 
+@app.route('/health')
+def health():
+    """Reports the state of the client of every data source."""
+    return jsonify(resource_status())
+
+
+@app.route('/metrics')
+def metrics():
+    """Reports the spans aggregated per name since start, e.g. the calls,
+    seconds and tokens of every agent, the statistics of the caches and the
+    throughput and throttling of the HubSpot API."""
+    caches = {"hubspot": cache_stats(), "sql_plans": sql_plans.stats()}
+    if llm_cache is not None:
+        caches["llm"] = llm_cache.stats()
+    report = {
+        "spans": trace_metrics(),
+        "caches": caches,
+        "routing": routing_stats(),
+        "hubspot_api": hubspot_api_stats(),
+    }
+    # Don't log in to Salesforce just to report on the pool.
+    if RESOURCES["Salesforce"].status() == "ready":
+        report["salesforce_pool"] = salesforce_stats()
+    return jsonify(report)
+
+
+@app.route('/traces')
+def traces():
+    """Returns the span trees of the latest answered queries."""
+    return jsonify(recent_traces())
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=os.environ['SRV_PORT'], host='0.0.0.0')
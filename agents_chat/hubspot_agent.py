@@ -1,7 +1,7 @@
 import json
 import logging
 import os
-import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import openai
 
@@ -12,21 +12,38 @@ from hubspot_utils import (
     get_deal_owner,
     get_products,
     get_activities,
+    get_company_deals,
+    get_deal_activities,
+    get_deal_details,
     match_activities_to_deals,
+    search_companies,
+    search_contacts,
+    search_deals,
 )
 
-from dotenv import load_dotenv
-
-load_dotenv()
+from llm_cache import completion_cache_key, create_llm_cache
+from message_log import MessageLog
+from resources import ResourceUnavailable
+from result_store import RESULT_FUNCTION_SCHEMAS, RESULT_FUNCTIONS, encode_result
+from token_budget import count_message_tokens, count_prompt_tokens, fit_to_budget
+from tracing import in_current_context, span
 
 logger = logging.getLogger(__name__)
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+MAX_PARALLEL_TOOL_CALLS = int(os.getenv("MAX_PARALLEL_TOOL_CALLS", 4))
+MODEL = "gpt-4-1106-preview"
+TEMPERATURE = 0.00000001
+# Answers are deterministic at this temperature, so whole chat() runs are
+# cached by their input and the data versions of the sources.
+# Off unless LLM_CACHE_URL is set, e.g. to memory://.
+llm_cache = create_llm_cache(os.getenv("LLM_CACHE_URL") or "none")
+
 
-def call_function(available_functions, response_message, messages):
-    function_name = response_message["function_call"]["name"]
-    arguments = response_message["function_call"]["arguments"]
+def call_function(available_functions, function_name, arguments, context=None):
+    """Runs a tool call of the LLM. Within a query `context` a tool called
+    again with the same arguments returns the result of the first call."""
     logger.info(
         f"LLM wants to call {function_name} function with arguments: {arguments}"
     )
@@ -35,62 +52,196 @@ def call_function(available_functions, response_message, messages):
         logger.error(
             f"LLM wanted to call function {function_name} that is not available"
         )
+        return f"There is no function such: {function_name}. Available functions are: {','.join(available_functions.keys())}"
+    function_args = json.loads(arguments or "{}")
+
+    def run():
+        try:
+            return encode_result(function_name, function_to_call(**function_args))
+        except ResourceUnavailable as err:
+            # Let the LLM answer from the other sources.
+            tool_span.set(unavailable=True)
+            return str(err)
+
+    with span(f"tool.{function_name}") as tool_span:
+        if context is None:
+            function_response = run()
+        else:
+            function_response, memoized = context.memoize(function_name, function_args, run)
+            tool_span.set(memoized=memoized)
+        tool_span.set(payload_bytes=len(function_response.encode()))
+    # Payloads can be megabytes, so they are only logged in full when debugging.
+    logger.info(f"{function_name} returned {tool_span.attributes['payload_bytes']} bytes")
+    logger.debug("%s for arguments %s returned %s", function_name, arguments, function_response)
+    return function_response
+
+
+def call_tools(available_functions, tool_calls, messages, context=None):
+    """Runs all tool calls of a single LLM turn concurrently and appends their
+    results to `messages` in the order the LLM requested them."""
+    max_workers = min(len(tool_calls), MAX_PARALLEL_TOOL_CALLS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                in_current_context(call_function),
+                available_functions,
+                tool_call["function"]["name"],
+                tool_call["function"]["arguments"],
+                context,
+            )
+            for tool_call in tool_calls
+        ]
+    for tool_call, future in zip(tool_calls, futures):
         messages.append(
             {
-                "role": "user",
-                "content": f"There is no function such: {function_name}. Available functions are: {','.join(available_functions.keys())}",
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "name": tool_call["function"]["name"],
+                "content": future.result(),
             }
         )
-        return
-    function_args = json.loads(response_message["function_call"]["arguments"])
-    function_response = function_to_call(**function_args)
-    function_response = json.dumps(function_response)
-    messages.append(
-        {
-            "role": "function",
-            "name": function_name,
-            "content": function_response,
-        }
-    )
-    logger.info(
-        f"{function_name} for arguments {arguments} returned {function_response}"
-    )
+
+
+def stream_completion(on_token, **kwargs):
+    """Streams a chat completion, passing content deltas to `on_token`, and
+    returns it shaped like a non-streamed response."""
+    message = {"role": "assistant", "content": None}
+    tool_calls = {}
+    for chunk in openai.ChatCompletion.create(stream=True, **kwargs):
+        if not chunk["choices"]:
+            continue
+        delta = chunk["choices"][0]["delta"]
+        if delta.get("content"):
+            message["content"] = (message["content"] or "") + delta["content"]
+            on_token(delta["content"])
+        for part in delta.get("tool_calls") or []:
+            tool_call = tool_calls.setdefault(
+                part["index"],
+                {"id": None, "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if part.get("id"):
+                tool_call["id"] = part["id"]
+            function = part.get("function") or {}
+            tool_call["function"]["name"] += function.get("name") or ""
+            tool_call["function"]["arguments"] += function.get("arguments") or ""
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    # Streamed responses carry no usage, so count the tokens locally.
+    prompt_tokens = count_prompt_tokens(kwargs["messages"], kwargs.get("tools"))
+    completion_tokens = count_message_tokens(message)
+    return {
+        "choices": [{"message": message}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
 
 
 def chat(
-    prompt, messages, available_functions, functions, max_turns=15, agent_name="agent"
+    prompt,
+    messages,
+    available_functions,
+    functions,
+    max_turns=15,
+    agent_name="agent",
+    on_token=None,
+    on_plan=None,
+    on_tool_call=None,
+    context=None,
+    data_sources=None,
 ):
-    logger.info(f"Entering chat function for {agent_name} and prompt:\n {prompt}")
-    messages_new = copy.deepcopy(messages)
-    messages_new.append({"role": "user", "content": prompt})
-    turns = 0
-    while True:
-        response = openai.ChatCompletion.create(
-            model="gpt-4-1106-preview",
-            messages=messages_new,
-            functions=functions,
-            function_call="auto",
-            temperature=0.00000001,
-        )
-        response_message = response["choices"][0]["message"]
-        message_content = response["choices"][0]["message"]["content"]
-        if message_content:
-            logger.info(f"LLM responded with message: {message_content}\n")
-        messages_new.append(response_message)
-        if response_message.get("function_call"):
-            call_function(available_functions, response_message, messages_new)
-        else:
-            logger.info(f"chat function for {agent_name} returned:\n {message_content}")
-            break
-        turns += 1
-        if turns > max_turns:
-            raise Exception("Reached max number of turns to LLM for single user query")
-    messages[:] = messages_new
-    return (
-        response["choices"][0]["message"]["content"],
-        response["usage"]["total_tokens"],
-    )
+    """Runs the LLM conversation loop for a single user prompt.
+
+    When `on_token` is given, completions are streamed and every content delta
+    is passed to it. Whether a completion is the answer is only known once it
+    ends: when it calls tools instead, its content was a plan and is passed to
+    `on_plan`. `on_tool_call(name, arguments)` is called for every tool call
+    before it runs. Tool results are shared through the `QueryContext` of
+    the user query if given.
 
+    Runs are cached only when `data_sources`, the sources the tools read, all
+    have a registered data version.
+
+    The messages of the turn are appended to the `MessageLog` `messages` and
+    committed once the answer is complete, or rolled back if the turn fails.
+    """
+    with span(f"chat.{agent_name}") as chat_span, messages.turn():
+        logger.info(f"Entering chat function for {agent_name} and prompt:\n {prompt}")
+        messages.append({"role": "user", "content": prompt})
+        tools = [{"type": "function", "function": function} for function in functions]
+        cache_key = None
+        if llm_cache is not None and data_sources is not None:
+            cache_key = completion_cache_key(
+                data_sources, model=MODEL, messages=messages, tools=tools, temperature=TEMPERATURE
+            )
+            cached = llm_cache.get(cache_key) if cache_key else None
+            chat_span.set(cache_hit=cached is not None)
+            if cached is not None:
+                logger.info(f"chat function for {agent_name} answered from the LLM cache")
+                if on_token and cached["content"]:
+                    on_token(cached["content"])
+                messages.extend(cached["messages"])
+                return cached["content"], cached["total_tokens"]
+        turns = 0
+        while True:
+            # Trimming to the budget only shortens this request, not the history.
+            request_messages = messages.snapshot()
+            prompt_tokens = fit_to_budget(request_messages, tools)
+            logger.info(f"Sending {prompt_tokens} prompt tokens to LLM for {agent_name}")
+            completion_args = dict(
+                model=MODEL,
+                messages=request_messages,
+                tools=tools,
+                tool_choice="auto",
+                temperature=TEMPERATURE,
+            )
+            with span(f"llm.{agent_name}") as llm_span:
+                if on_token:
+                    response = stream_completion(on_token, **completion_args)
+                else:
+                    response = openai.ChatCompletion.create(**completion_args)
+                llm_span.set(
+                    prompt_tokens=response["usage"].get("prompt_tokens", prompt_tokens),
+                    completion_tokens=response["usage"].get("completion_tokens", 0),
+                )
+            chat_span.add("llm_turns")
+            response_message = response["choices"][0]["message"]
+            message_content = response["choices"][0]["message"]["content"]
+            if message_content:
+                logger.info(f"LLM responded with message: {message_content}\n")
+            messages.append(response_message)
+            if response_message.get("tool_calls"):
+                if on_token and on_plan and message_content:
+                    on_plan(message_content)
+                if on_tool_call:
+                    for tool_call in response_message["tool_calls"]:
+                        on_tool_call(tool_call["function"]["name"], tool_call["function"]["arguments"])
+                call_tools(available_functions, response_message["tool_calls"], messages, context)
+            else:
+                logger.info(f"chat function for {agent_name} returned:\n {message_content}")
+                break
+            turns += 1
+            if turns > max_turns:
+                raise Exception("Reached max number of turns to LLM for single user query")
+        if cache_key:
+            llm_cache.set(
+                cache_key,
+                json.loads(
+                    json.dumps(
+                        {
+                            "messages": messages.pending()[1:],
+                            "content": response["choices"][0]["message"]["content"],
+                            "total_tokens": response["usage"]["total_tokens"],
+                        }
+                    )
+                ),
+            )
+        return (
+            response["choices"][0]["message"]["content"],
+            response["usage"]["total_tokens"],
+        )
 
 class HubspotAgent:
     SYSTEM_PROMPT = """
@@ -99,8 +250,8 @@ class HubspotAgent:
     Hubspot contains various entities, interconnected through associations.
     Your primary role is to exploit these associations for precise data filtration and aggregation.
     Avoid generating new code; instead, utilize pre-existing functions.
-    When tasked with filtering data from Hubspot, first retrieve the complete dataset and then extract the specific 
-    segments as instructed by the user.
+    When tasked with filtering data from Hubspot, use the search functions with filters and request only the
+    properties you need. Retrieve the complete dataset only when the search functions cannot express the filter.
     Please note that, closewon to the deal stage is the only closed and successful deal, the others remain open and 
     should not be taken into final consideration in regards revenue. 
     ALL OPEN DEALS are important to predict forecast revenue!!! 
@@ -132,6 +283,13 @@ class HubspotAgent:
             "get_products": get_products,
             "get_activities": get_activities,
             "match_activities_to_deals": match_activities_to_deals,
+            "search_deals": search_deals,
+            "search_companies": search_companies,
+            "search_contacts": search_contacts,
+            "get_deal_activities": get_deal_activities,
+            "get_deal_details": get_deal_details,
+            "get_company_deals": get_company_deals,
+            **RESULT_FUNCTIONS,
         }
         self.functions = [
             {
@@ -190,17 +348,133 @@ class HubspotAgent:
             },
             {
                 "name": "match_activities_to_deals",
-                "description": "Matches activities to specific deals and returns the mapped results.",
+                "description": "Matches activities to all the deals and returns them keyed by deal id. "
+                "Prefer get_deal_activities when asked about specific deals.",
                 "parameters": {
                     "type": "object",
                     "properties": {},
                     "required": [],
                 },
             },
+            {
+                "name": "search_deals",
+                "description": "Searches Hubspot deals matching all the given filters and returns only the "
+                "requested properties, the number of returned deals and the total number of matches.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "dealstage": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Internal deal stage names, e.g. closedwon, closedlost, "
+                            "appointmentscheduled.",
+                        },
+                        "closedate_from": {
+                            "type": "string",
+                            "description": "Earliest close date, ISO format e.g. 2024-01-01.",
+                        },
+                        "closedate_to": {
+                            "type": "string",
+                            "description": "Latest close date (inclusive), ISO format e.g. 2024-03-31.",
+                        },
+                        "owner_id": {"type": "string", "description": "Hubspot owner id of the deal."},
+                        "amount_min": {"type": "number", "description": "Minimum deal amount."},
+                        "amount_max": {"type": "number", "description": "Maximum deal amount."},
+                        "company_id": {
+                            "type": "string",
+                            "description": "Id of the Hubspot company associated with the deal.",
+                        },
+                        "properties": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Deal properties to return. Defaults to dealname, dealstage, "
+                            "amount, closedate and hubspot_owner_id.",
+                        },
+                        "limit": {"type": "integer", "description": "Maximum number of deals to return."},
+                    },
+                    "required": [],
+                },
+            },
+            {
+                "name": "search_companies",
+                "description": "Searches Hubspot companies by name or domain and returns only the requested "
+                "properties.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string", "description": "Word contained in the company name."},
+                        "domain": {"type": "string", "description": "Company domain, e.g. example.com."},
+                        "properties": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Company properties to return. Defaults to name and domain.",
+                        },
+                        "limit": {"type": "integer", "description": "Maximum number of companies to return."},
+                    },
+                    "required": [],
+                },
+            },
+            {
+                "name": "search_contacts",
+                "description": "Searches Hubspot contacts by company or email and returns only the requested "
+                "properties.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "company_id": {
+                            "type": "string",
+                            "description": "Id of the Hubspot company associated with the contact.",
+                        },
+                        "email": {"type": "string", "description": "Contact email address."},
+                        "properties": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Contact properties to return. Defaults to email, firstname "
+                            "and lastname.",
+                        },
+                        "limit": {"type": "integer", "description": "Maximum number of contacts to return."},
+                    },
+                    "required": [],
+                },
+            },
+            {
+                "name": "get_deal_activities",
+                "description": "Returns the tasks, notes, calls and meetings associated with a single deal.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "deal_id": {"type": "string", "description": "Id of the Hubspot deal."},
+                    },
+                    "required": ["deal_id"],
+                },
+            },
+            {
+                "name": "get_deal_details",
+                "description": "Returns a single deal with its associated companies and contacts.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "deal_id": {"type": "string", "description": "Id of the Hubspot deal."},
+                    },
+                    "required": ["deal_id"],
+                },
+            },
+            {
+                "name": "get_company_deals",
+                "description": "Returns a single company with its associated deals.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "company_id": {"type": "string", "description": "Id of the Hubspot company."},
+                    },
+                    "required": ["company_id"],
+                },
+            },
+            *RESULT_FUNCTION_SCHEMAS,
         ]
-        self.messages = [{"role": "system", "content": self.SYSTEM_PROMPT}]
+        self.messages = MessageLog([{"role": "system", "content": self.SYSTEM_PROMPT}])
 
-    def chat(self, query):
+    def chat(self, query, context=None):
         prompt = self.PROMPT_TEMPLATE.format(query)
         response, _ = chat(
             prompt,
@@ -208,13 +482,17 @@ class HubspotAgent:
             self.available_functions,
             self.functions,
             agent_name="hubspot_agent",
+            context=context,
+            data_sources=["hubspot"],
         )
         return response
 
 
-def ask_hubspot_agent(query):
+def ask_hubspot_agent(query, context=None):
     print("asking Hubspot Agent")
-    return HubspotAgent().chat(query)
+    if context is None:
+        return HubspotAgent().chat(query)
+    return context.ask("hubspot_agent", HubspotAgent, query)
 
 
 # if __name__ == "__main__":
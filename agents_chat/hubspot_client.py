@@ -0,0 +1,271 @@
+import functools
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+
+from hubspot import HubSpot
+from hubspot.crm.associations.v4 import (
+    BatchInputPublicFetchAssociationsBatchRequest,
+    PublicFetchAssociationsBatchRequest,
+)
+from hubspot.crm.objects import BatchReadInputSimplePublicObjectId, SimplePublicObjectId
+from hubspot.discovery.discovery_base import DiscoveryBase
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Requests per second of the per-10-second limit of private apps, per portal
+# tier; the API limit increase add-on raises it to 250 per 10 seconds.
+TIER_REQUESTS_PER_SECOND = {
+    "free": 10,
+    "starter": 10,
+    "professional": 19,
+    "enterprise": 19,
+    "api_add_on": 25,
+}
+# The CRM search endpoints have their own, lower limit per portal.
+SEARCH_REQUESTS_PER_SECOND = 5
+# Status codes of transient failures, retried with backoff.
+RETRY_STATUSES = {429, 502, 503, 504}
+# Objects per batch read and batch associations request, HubSpot's maximum.
+BATCH_SIZE = 100
+# Singular names HubSpot uses in association types, e.g. deal_to_company.
+SINGULAR_NAMES = {
+    "companies": "company",
+    "contacts": "contact",
+    "deals": "deal",
+    "line_items": "line_item",
+    "tasks": "task",
+    "notes": "note",
+    "calls": "call",
+    "meetings": "meeting_event",
+    "tickets": "ticket",
+}
+
+# Associations shaped like the ones of the HubSpot client models, so the
+# flatten_* helpers in hubspot_utils work on hydrated and mirrored records.
+Association = namedtuple("Association", ["id", "type"])
+AssociationList = namedtuple("AssociationList", ["results"])
+
+
+class TokenBucket:
+    """Blocking token bucket shared by all threads issuing HubSpot requests."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.acquired += 1
+                    if waited:
+                        self.waits += 1
+                        self.wait_seconds += waited
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "capacity": self.capacity,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 3),
+            }
+
+
+class PooledApiFactory:
+    """`api_factory` for the HubSpot client that reuses a single ApiClient, and
+    so a single keep-alive connection pool, per API package.
+
+    Every request first takes a token from `rate_limiter`, and search requests
+    also one from `search_rate_limiter`. Responses with status 429 and
+    gateway errors are retried with exponential backoff and full jitter, so
+    that throttled workers don't retry in lockstep, honouring Retry-After.
+    `host` replaces https://api.hubapi.com, e.g. with a local stub.
+    """
+
+    def __init__(
+        self,
+        rate_limiter,
+        search_rate_limiter=None,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=30.0,
+        host=None,
+    ):
+        self.rate_limiter = rate_limiter
+        self.search_rate_limiter = search_rate_limiter
+        self.host = host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._api_clients = {}
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+
+    def __call__(self, api_client_package, api_name, config):
+        with self._lock:
+            api_client = self._api_clients.get(api_client_package.__name__)
+            if api_client is None:
+                api = DiscoveryBase._default_api_factory(api_client_package, api_name, config)
+                api_client = api.api_client
+                if self.host:
+                    api_client.configuration.host = self.host
+                api_client.request = self._throttled(api_client.request)
+                self._api_clients[api_client_package.__name__] = api_client
+                return api
+        return getattr(api_client_package, api_name)(api_client=api_client)
+
+    def _throttled(self, request):
+        @functools.wraps(request)
+        def wrapper(method, url, *args, **kwargs):
+            attempt = 0
+            while True:
+                self.rate_limiter.acquire()
+                if self.search_rate_limiter is not None and url.endswith("/search"):
+                    self.search_rate_limiter.acquire()
+                with self._lock:
+                    self.requests += 1
+                try:
+                    return request(method, url, *args, **kwargs)
+                except Exception as err:
+                    # Every HubSpot API package defines its own ApiException.
+                    status = getattr(err, "status", None)
+                    with self._lock:
+                        self.throttled += status == 429
+                        retry = status in RETRY_STATUSES and attempt < self.max_retries
+                        self.retries += retry
+                        self.failures += not retry
+                    if not retry:
+                        raise
+                    delay = self._retry_delay(err, attempt)
+                    attempt += 1
+                    logger.warning(f"HubSpot responded {status}, retry {attempt} in {delay:.1f}s")
+                    time.sleep(delay)
+
+        return wrapper
+
+    def _retry_delay(self, err, attempt):
+        retry_after = (err.headers or {}).get("Retry-After")
+        if retry_after:
+            return float(retry_after)
+        return random.uniform(0, min(self.backoff * 2**attempt, self.max_backoff))
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at
+            stats = {
+                "requests": self.requests,
+                "requests_per_second": round(self.requests / elapsed, 3) if elapsed else 0.0,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "failures": self.failures,
+            }
+        stats["rate_limiter"] = self.rate_limiter.stats()
+        if self.search_rate_limiter is not None:
+            stats["search_rate_limiter"] = self.search_rate_limiter.stats()
+        return stats
+
+
+def create_client(access_token, api_factory):
+    return HubSpot(
+        access_token=access_token,
+        # Leave 429s to PooledApiFactory so that retries also go through the
+        # rate limiter; urllib3 only retries connection errors.
+        retry=Retry(total=3, respect_retry_after_header=False),
+        api_factory=api_factory,
+    )
+
+
+def _chunks(ids):
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start:start + BATCH_SIZE]
+
+
+def batch_read(client, object_type, ids, properties):
+    """Returns the `object_type` records with the given ids, reading BATCH_SIZE
+    records per request instead of one."""
+    records = []
+    for chunk in _chunks(list(ids)):
+        response = client.crm.objects.batch_api.read(
+            object_type,
+            batch_read_input_simple_public_object_id=BatchReadInputSimplePublicObjectId(
+                properties=properties,
+                inputs=[SimplePublicObjectId(id=object_id) for object_id in chunk],
+            ),
+        )
+        records.extend(response.results)
+    return records
+
+
+def batch_associations(client, object_type, ids, to_type):
+    """Returns the ids of the `to_type` records associated with every one of
+    the `object_type` records `ids`, BATCH_SIZE records per request."""
+    associated = {}
+    for chunk in _chunks(list(ids)):
+        inputs = [PublicFetchAssociationsBatchRequest(id=object_id) for object_id in chunk]
+        while inputs:
+            response = client.crm.associations.v4.batch_api.get_page(
+                object_type,
+                to_type,
+                batch_input_public_fetch_associations_batch_request=BatchInputPublicFetchAssociationsBatchRequest(
+                    inputs=inputs
+                ),
+            )
+            inputs = []
+            for result in response.results:
+                object_id = str(result._from.id)
+                associated.setdefault(object_id, []).extend(str(to.to_object_id) for to in result.to)
+                if result.paging is not None and result.paging.next is not None:
+                    # More associations than fit into one page.
+                    inputs.append(
+                        PublicFetchAssociationsBatchRequest(id=object_id, after=result.paging.next.after)
+                    )
+    return associated
+
+
+def hydrate_associations(client, object_type, records, to_types):
+    """Sets the `associations` of `records` to their associations with the
+    `to_types`, fetched with one batch request per type and BATCH_SIZE records.
+    Unlike listing records with their associations, this isn't truncated and
+    costs a request per hundred records and type rather than per record page."""
+    associations = {record.id: {} for record in records}
+    for to_type in to_types:
+        association_type = f"{SINGULAR_NAMES[object_type]}_to_{SINGULAR_NAMES[to_type]}"
+        for object_id, to_ids in batch_associations(client, object_type, associations, to_type).items():
+            if object_id in associations:
+                associations[object_id][to_type] = AssociationList(
+                    [Association(to_id, association_type) for to_id in dict.fromkeys(to_ids)]
+                )
+    for record in records:
+        record.associations = associations[record.id]
+    return records
+
+
+def get_all_hydrated(client, object_type, properties, to_types):
+    """Returns all `object_type` records with their associations with `to_types`."""
+    records = client.crm.objects.get_all(object_type, properties=properties)
+    return hydrate_associations(client, object_type, records, to_types)
@@ -0,0 +1,310 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from hubspot.crm.objects import PublicObjectSearchRequest
+
+from hubspot_client import Association, AssociationList, batch_read, get_all_hydrated, hydrate_associations
+
+logger = logging.getLogger(__name__)
+
+# Mirrored objects expose the same attributes as the HubSpot client models,
+# so the flatten_* helpers in hubspot_utils work on both.
+MirrorRecord = namedtuple("MirrorRecord", ["id", "properties", "associations"])
+
+SEARCH_PAGE_SIZE = 100
+# HubSpot search can page through at most 10k results of a single query.
+SEARCH_RESULT_LIMIT = 10_000
+# Maximum number of ids bound to a single SQLite `IN (...)` lookup.
+ID_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    object_type TEXT NOT NULL,
+    id TEXT NOT NULL,
+    properties TEXT NOT NULL,
+    modified_at TEXT,
+    PRIMARY KEY (object_type, id)
+);
+CREATE TABLE IF NOT EXISTS associations (
+    from_type TEXT NOT NULL,
+    from_id TEXT NOT NULL,
+    to_type TEXT NOT NULL,
+    to_id TEXT NOT NULL,
+    association_type TEXT NOT NULL,
+    PRIMARY KEY (from_type, from_id, to_type, to_id, association_type)
+);
+CREATE INDEX IF NOT EXISTS associations_reverse ON associations (to_type, to_id, from_type);
+CREATE TABLE IF NOT EXISTS sync_state (
+    object_type TEXT PRIMARY KEY,
+    watermark TEXT,
+    last_full_sync REAL NOT NULL,
+    last_sync REAL NOT NULL
+);
+"""
+
+
+def _to_millis(timestamp):
+    return str(int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp() * 1000))
+
+
+class HubspotMirror:
+    """Local SQLite mirror of HubSpot CRM objects and their associations.
+
+    The first sync of an object type pages through all of its records. Later
+    syncs only pull records modified since the stored watermark, found with
+    the CRM search API. Archived records are not returned by search, so a
+    full reload still runs every `full_sync_interval` seconds.
+
+    `specs` maps an object type to the `properties` and `associations` to
+    mirror and to the `modified_property` holding its last modification date.
+    `on_change(object_type)` is called after a sync wrote any records.
+    """
+
+    def __init__(self, path, client, specs, full_sync_interval=24 * 3600, on_change=None):
+        self.client = client
+        self.specs = specs
+        self.full_sync_interval = full_sync_interval
+        self.on_change = on_change
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._sync_locks = {object_type: threading.Lock() for object_type in specs}
+
+    def sync(self, object_type, max_age=0):
+        """Brings the mirror of `object_type` up to date with HubSpot, unless it
+        was synced less than `max_age` seconds ago."""
+        with self._sync_locks[object_type]:
+            state = self.sync_state(object_type)
+            if state is not None and time.time() - state["last_sync"] < max_age:
+                return
+            if (
+                state is None
+                or state["watermark"] is None
+                or time.time() - state["last_full_sync"] > self.full_sync_interval
+            ):
+                self._full_sync(object_type)
+            else:
+                self._incremental_sync(object_type, state["watermark"])
+
+    def sync_state(self, object_type):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT watermark, last_full_sync, last_sync FROM sync_state WHERE object_type = ?",
+                (object_type,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"watermark": row[0], "last_full_sync": row[1], "last_sync": row[2]}
+
+    def data_version(self):
+        """Returns the newest modification date seen per object type."""
+        with self._lock:
+            rows = self._conn.execute("SELECT object_type, watermark FROM sync_state").fetchall()
+        return dict(sorted(rows))
+
+    def records(self, object_type, ids=None):
+        """Returns the mirrored records of `object_type`, all or only `ids`."""
+        if ids is None:
+            return self._records(object_type)
+        records = []
+        ids = list(ids)
+        for start in range(0, len(ids), ID_CHUNK_SIZE):
+            records.extend(self._records(object_type, ids[start:start + ID_CHUNK_SIZE]))
+        return records
+
+    def related_ids(self, object_type, object_id, related_type):
+        """Returns ids of `related_type` records associated with the given record.
+
+        Associations are looked up from both sides, so they are found as soon
+        as either of the two associated records has been synced.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT to_id FROM associations WHERE from_type = ? AND from_id = ? AND to_type = ?
+                UNION
+                SELECT from_id FROM associations WHERE to_type = ? AND to_id = ? AND from_type = ?
+                """,
+                (object_type, object_id, related_type, object_type, object_id, related_type),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _records(self, object_type, ids=None):
+        object_filter = association_filter = ""
+        if ids is not None:
+            placeholders = ",".join("?" * len(ids))
+            object_filter = f" AND id IN ({placeholders})"
+            association_filter = f" AND from_id IN ({placeholders})"
+        params = (object_type, *(ids or ()))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, properties FROM objects WHERE object_type = ?{object_filter} ORDER BY id",
+                params,
+            ).fetchall()
+            association_rows = self._conn.execute(
+                "SELECT from_id, to_type, to_id, association_type FROM associations "
+                f"WHERE from_type = ?{association_filter}",
+                params,
+            ).fetchall()
+        associations = {}
+        for from_id, to_type, to_id, association_type in association_rows:
+            associations.setdefault(from_id, {}).setdefault(to_type, []).append(
+                Association(to_id, association_type)
+            )
+        return [
+            MirrorRecord(
+                object_id,
+                json.loads(properties),
+                {
+                    to_type: AssociationList(results)
+                    for to_type, results in associations.get(object_id, {}).items()
+                },
+            )
+            for object_id, properties in rows
+        ]
+
+    def _full_sync(self, object_type):
+        spec = self.specs[object_type]
+        started_at = time.time()
+        raw_objects = get_all_hydrated(self.client, object_type, spec["properties"], spec["associations"])
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM objects WHERE object_type = ?", (object_type,))
+            self._conn.execute("DELETE FROM associations WHERE from_type = ?", (object_type,))
+            watermark = self._upsert(object_type, raw_objects)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                (object_type, watermark, started_at, started_at),
+            )
+        logger.info(f"Full HubSpot sync of {object_type} loaded {len(raw_objects)} records")
+        if self.on_change:
+            self.on_change(object_type)
+
+    def _incremental_sync(self, object_type, watermark):
+        spec = self.specs[object_type]
+        started_at = time.time()
+        modified = self._search_modified_since(object_type, watermark)
+        # The search includes the records modified at the watermark itself,
+        # which are mirrored already unless they were modified again.
+        stored = self._stored_modified_at(object_type, list(modified))
+        changed_ids = [
+            object_id for object_id, modified_at in modified.items() if stored.get(object_id) != modified_at
+        ]
+        if len(changed_ids) <= len(spec["associations"]):
+            # Reading a few records one by one takes fewer requests than
+            # hydrating them with a batch request per association type.
+            raw_objects = [
+                self.client.crm.objects.basic_api.get_by_id(
+                    object_type,
+                    object_id,
+                    properties=spec["properties"],
+                    associations=spec["associations"],
+                )
+                for object_id in changed_ids
+            ]
+        else:
+            raw_objects = hydrate_associations(
+                self.client,
+                object_type,
+                batch_read(self.client, object_type, changed_ids, spec["properties"]),
+                spec["associations"],
+            )
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM associations WHERE from_type = ? AND from_id = ?",
+                [(object_type, raw_object.id) for raw_object in raw_objects],
+            )
+            new_watermark = self._upsert(object_type, raw_objects)
+            self._conn.execute(
+                "UPDATE sync_state SET watermark = ?, last_sync = ? WHERE object_type = ?",
+                (max(watermark, new_watermark or watermark), started_at, object_type),
+            )
+        logger.info(f"Incremental HubSpot sync of {object_type} updated {len(raw_objects)} records")
+        if raw_objects and self.on_change:
+            self.on_change(object_type)
+
+    def _search_modified_since(self, object_type, watermark):
+        """Returns the ids of the records modified since `watermark`, mapped to
+        their modification dates."""
+        modified_property = self.specs[object_type]["modified_property"]
+        modified = {}
+        since, after = watermark, 0
+        while True:
+            request = PublicObjectSearchRequest(
+                filter_groups=[
+                    {
+                        "filters": [
+                            {
+                                "propertyName": modified_property,
+                                "operator": "GTE",
+                                "value": _to_millis(since),
+                            }
+                        ]
+                    }
+                ],
+                sorts=[{"propertyName": modified_property, "direction": "ASCENDING"}],
+                properties=[modified_property],
+                limit=SEARCH_PAGE_SIZE,
+                after=after,
+            )
+            page = self.client.crm.objects.search_api.do_search(
+                object_type, public_object_search_request=request
+            )
+            for result in page.results:
+                modified[result.id] = result.properties.get(modified_property)
+            if page.paging is None:
+                break
+            after = int(page.paging.next.after)
+            if after + SEARCH_PAGE_SIZE > SEARCH_RESULT_LIMIT:
+                # Restart the search from the newest modification date seen so far.
+                newest = page.results[-1].properties[modified_property]
+                if newest == since:
+                    logger.warning(
+                        f"More than {SEARCH_RESULT_LIMIT} {object_type} modified at {since}, "
+                        f"the rest is picked up by the next full sync"
+                    )
+                    break
+                since, after = newest, 0
+        return modified
+
+    def _stored_modified_at(self, object_type, ids):
+        """Returns the modification dates of the mirrored records among `ids`."""
+        stored = {}
+        for start in range(0, len(ids), ID_CHUNK_SIZE):
+            chunk = ids[start:start + ID_CHUNK_SIZE]
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, modified_at FROM objects "
+                    f"WHERE object_type = ? AND id IN ({','.join('?' * len(chunk))})",
+                    (object_type, *chunk),
+                ).fetchall()
+            stored.update(rows)
+        return stored
+
+    def _upsert(self, object_type, raw_objects):
+        """Writes `raw_objects` to the mirror and returns their newest modification date."""
+        modified_property = self.specs[object_type]["modified_property"]
+        watermark = None
+        object_rows = []
+        association_rows = []
+        for raw_object in raw_objects:
+            modified_at = raw_object.properties.get(modified_property)
+            if modified_at and (watermark is None or modified_at > watermark):
+                watermark = modified_at
+            object_rows.append(
+                (object_type, raw_object.id, json.dumps(raw_object.properties), modified_at)
+            )
+            for to_type, collection in (raw_object.associations or {}).items():
+                for association in collection.results:
+                    association_rows.append(
+                        (object_type, raw_object.id, to_type, association.id, association.type)
+                    )
+        self._conn.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", object_rows)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO associations VALUES (?, ?, ?, ?, ?)", association_rows
+        )
+        return watermark
@@ -1,7 +1,25 @@
+import functools
 import os
-
-from dotenv import load_dotenv
-from hubspot import HubSpot
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from hubspot.crm.objects import PublicObjectSearchRequest
+
+from cache_utils import TTLCache
+from hubspot_client import (
+    SEARCH_REQUESTS_PER_SECOND,
+    TIER_REQUESTS_PER_SECOND,
+    PooledApiFactory,
+    TokenBucket,
+    create_client,
+    get_all_hydrated,
+)
+from hubspot_sync import SEARCH_PAGE_SIZE, HubspotMirror
+from llm_cache import register_data_version
+from records import record_type
+from resources import Lazy
+from tracing import in_current_context, span, traced
 
 SUPPORTED_ASSOCIATIONS = [
     "deal_to_company",
@@ -21,235 +39,564 @@ SUPPORTED_ASSOCIATIONS = [
     "task_to_deal",
 ]
 
-load_dotenv()
+# Properties and associations fetched per CRM object type, along with the
+# property holding the date of the last modification.
+OBJECT_SPECS = {
+    "deals": {
+        "properties": [
+            "hubspot_owner_id",
+            "amount",
+            "dealname",
+            "dealstage",
+            "closedate",
+            "createdate",
+            "hs_lastmodifieddate",
+        ],
+        "associations": [
+            "companies",
+            "contacts",
+            "line_items",
+            "calls",
+            "meetings",
+            "tasks",
+            "notes",
+            "tickets",
+        ],
+        "modified_property": "hs_lastmodifieddate",
+    },
+    "companies": {
+        "properties": ["domain", "name", "hs_lastmodifieddate"],
+        "associations": ["contacts", "deals"],
+        "modified_property": "hs_lastmodifieddate",
+    },
+    "contacts": {
+        "properties": ["email", "firstname", "lastname", "lastmodifieddate"],
+        "associations": ["companies", "deals"],
+        "modified_property": "lastmodifieddate",
+    },
+    "line_items": {
+        "properties": ["name", "quantity", "amount", "hs_lastmodifieddate"],
+        "associations": [],
+        "modified_property": "hs_lastmodifieddate",
+    },
+    "tasks": {
+        "properties": [
+            "hubspot_owner_id",
+            "hs_task_subject",
+            "hs_task_status",
+            "hs_task_priority",
+            "hs_task_type",
+            "hs_task_body",
+            "hs_lastmodifieddate",
+        ],
+        "associations": ["deals"],
+        "modified_property": "hs_lastmodifieddate",
+    },
+    "notes": {
+        "properties": ["hs_note_body", "hubspot_owner_id", "hs_lastmodifieddate"],
+        "associations": ["deals"],
+        "modified_property": "hs_lastmodifieddate",
+    },
+    "calls": {
+        "properties": [
+            "hs_call_body",
+            "hs_call_direction",
+            "hs_call_disposition",
+            "hs_call_duration",
+            "hs_call_status",
+            "hs_call_title",
+            "hs_lastmodifieddate",
+        ],
+        "associations": ["deals"],
+        "modified_property": "hs_lastmodifieddate",
+    },
+    "meetings": {
+        "properties": [
+            "hs_meeting_title",
+            "hs_meeting_body",
+            "hs_meeting_location",
+            "hs_lastmodifieddate",
+        ],
+        "associations": ["deals"],
+        "modified_property": "hs_lastmodifieddate",
+    },
+}
+
 hub_api = os.getenv("HUB_API")
-hs_client = HubSpot(access_token=hub_api)
+# Request budget shared by every HubSpot call in the process, by default the
+# private app limit of the portal's HUBSPOT_TIER, e.g. professional.
+HUBSPOT_TIER = os.getenv("HUBSPOT_TIER", "free")
+HUBSPOT_REQUESTS_PER_SECOND = float(
+    os.getenv("HUBSPOT_REQUESTS_PER_SECOND") or TIER_REQUESTS_PER_SECOND[HUBSPOT_TIER]
+)
+HUBSPOT_BURST = int(os.getenv("HUBSPOT_BURST", 10))
+HUBSPOT_SEARCH_REQUESTS_PER_SECOND = float(
+    os.getenv("HUBSPOT_SEARCH_REQUESTS_PER_SECOND", SEARCH_REQUESTS_PER_SECOND)
+)
+HUBSPOT_MAX_WORKERS = int(os.getenv("HUBSPOT_MAX_WORKERS", 4))
+hubspot_rate_limiter = TokenBucket(HUBSPOT_REQUESTS_PER_SECOND, HUBSPOT_BURST)
+hubspot_search_rate_limiter = TokenBucket(HUBSPOT_SEARCH_REQUESTS_PER_SECOND, HUBSPOT_SEARCH_REQUESTS_PER_SECOND)
+# Base URL of the HubSpot API, only set to point the client at a stub.
+HUBSPOT_API_HOST = os.getenv("HUBSPOT_API_HOST")
+hubspot_api = PooledApiFactory(
+    hubspot_rate_limiter, search_rate_limiter=hubspot_search_rate_limiter, host=HUBSPOT_API_HOST
+)
+_hs_client = Lazy("HubSpot", lambda: create_client(hub_api, hubspot_api))
+
+# Local SQLite mirror the fetchers read from; set HUBSPOT_MIRROR_PATH to an
+# empty string to always read straight from the HubSpot API.
+HUBSPOT_MIRROR_PATH = os.getenv("HUBSPOT_MIRROR_PATH", "hubspot_mirror.sqlite3")
+HUBSPOT_FULL_SYNC_INTERVAL = int(os.getenv("HUBSPOT_FULL_SYNC_INTERVAL", 24 * 3600))
+# Seconds the mirror may lag behind HubSpot when serving the fetchers and
+# index lookups.
+INDEX_MAX_AGE = int(os.getenv("HUBSPOT_INDEX_MAX_AGE", 60))
+_hubspot_mirror = Lazy(
+    "HubSpot mirror",
+    lambda: HubspotMirror(
+        HUBSPOT_MIRROR_PATH,
+        get_hs_client(),
+        OBJECT_SPECS,
+        HUBSPOT_FULL_SYNC_INTERVAL,
+        on_change=lambda object_type: invalidate_cache(CACHE_GROUPS[object_type]),
+    ),
+)
+
+
+def get_hs_client():
+    return _hs_client.get()
+
+
+def get_hubspot_mirror():
+    """Returns the local mirror, or None if it's disabled."""
+    return _hubspot_mirror.get() if HUBSPOT_MIRROR_PATH else None
+
+
+# Seconds a fetched object type stays fresh in the shared cache.
+CACHE_TTLS = {
+    "deals": 300,
+    "companies": 900,
+    "contacts": 900,
+    "owners": 3600,
+    "products": 1800,
+    "activities": 300,
+}
+# Cached fetcher group reading each mirrored object type.
+CACHE_GROUPS = {
+    "deals": "deals",
+    "companies": "companies",
+    "contacts": "contacts",
+    "line_items": "products",
+    "tasks": "activities",
+    "notes": "activities",
+    "calls": "activities",
+    "meetings": "activities",
+}
+# Mirrored object types read by each cached fetcher group.
+MIRRORED_TYPES = {
+    group: [object_type for object_type, type_group in CACHE_GROUPS.items() if type_group == group]
+    for group in set(CACHE_GROUPS.values())
+}
+hubspot_cache = TTLCache(maxsize=int(os.getenv("HUBSPOT_CACHE_SIZE", 64)))
+
+
+def cached(object_type):
+    """Serves the decorated fetcher from the process-wide HubSpot cache."""
+
+    def decorator(fetch):
+        @functools.wraps(fetch)
+        def wrapper(*args, **kwargs):
+            key = (object_type, fetch.__name__, args, tuple(sorted(kwargs.items())))
+            loaded = []
+
+            def load():
+                loaded.append(True)
+                return fetch(*args, **kwargs)
+
+            with span(f"hubspot.{fetch.__name__}") as fetch_span:
+                # A sync that finds changes invalidates the cache, so it runs
+                # before the lookup; in the loader it would discard the load.
+                sync_mirror(*MIRRORED_TYPES.get(object_type, ()))
+                result = hubspot_cache.get_or_load(key, load, ttl=CACHE_TTLS[object_type])
+                fetch_span.set(cache_hit=not loaded)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate_cache(object_type=None):
+    """Drops cached results of the given object type, or everything."""
+    if object_type is None:
+        hubspot_cache.invalidate()
+    else:
+        hubspot_cache.invalidate(lambda key: key[0] == object_type)
+
+
+def cache_stats():
+    return hubspot_cache.stats()
+
+
+def hubspot_api_stats():
+    return hubspot_api.stats()
 
 
 def extract_associations(raw_associations):
     associations = {}
     for entity_type in raw_associations:
-        associations[entity_type] = []
-        for association_data in raw_associations[entity_type].results:
-            if association_data.type not in SUPPORTED_ASSOCIATIONS:
-                continue
-            associations[entity_type].append(association_data.id)
+        # Tuples, as the records are read-only, and every empty one is the same object.
+        associations[entity_type] = tuple(
+            association_data.id
+            for association_data in raw_associations[entity_type].results
+            if association_data.type in SUPPORTED_ASSOCIATIONS
+        )
     return associations
 
 
+# Full pulls hold every record of a portal, so the flattened records live in
+# slots rather than a dict each.
+Contact = record_type("Contact", ["id", "email", "firstname", "lastname", "associations"])
+Company = record_type("Company", ["id", "domain", "name", "associations"])
+Deal = record_type(
+    "Deal",
+    [
+        "id",
+        "dealname",
+        "dealstage",
+        "amount",
+        "closedate",
+        "createdate",
+        "lastmodifeddate",
+        "hubspot_owner_id",
+        "associations",
+    ],
+    shared=["dealstage", "hubspot_owner_id"],
+)
+Owner = record_type("Owner", ["id", "first_name", "last_name", "email"])
+Product = record_type("Product", ["id", "name", "quantity", "amount"], shared=["name"])
+Task = record_type(
+    "Task",
+    ["id", "owner_id", "subject", "status", "priority", "type", "body"],
+    shared=["owner_id", "status", "priority", "type"],
+)
+Note = record_type("Note", ["id", "body", "owner_id"], shared=["owner_id"])
+Call = record_type(
+    "Call",
+    ["id", "body", "direction", "disposition", "duration", "status", "title"],
+    shared=["direction", "disposition", "status"],
+)
+Meeting = record_type("Meeting", ["id", "title", "body", "location"], shared=["location"])
+
+
 def flatten_contact(raw_response):
-    return {
-        "id": raw_response.id,
-        "email": raw_response.properties["email"],
-        "firstname": raw_response.properties["firstname"],
-        "lastname": raw_response.properties["lastname"],
-        "associations": extract_associations(raw_response.associations),
-    }
+    return Contact(
+        id=raw_response.id,
+        email=raw_response.properties["email"],
+        firstname=raw_response.properties["firstname"],
+        lastname=raw_response.properties["lastname"],
+        associations=extract_associations(raw_response.associations),
+    )
 
 
 def flatten_company(raw_response):
-    return {
-        "id": raw_response.id,
-        "domain": raw_response.properties["domain"],
-        "name": raw_response.properties["name"],
-        "associations": extract_associations(raw_response.associations),
-    }
+    return Company(
+        id=raw_response.id,
+        domain=raw_response.properties["domain"],
+        name=raw_response.properties["name"],
+        associations=extract_associations(raw_response.associations),
+    )
 
 
 def flatten_deal(raw_response):
-    return {
-        "id": raw_response.id,
-        "dealname": raw_response.properties["dealname"],
-        "dealstage": raw_response.properties["dealstage"],
-        "amount": raw_response.properties["amount"],
-        "closedate": raw_response.properties["closedate"],
-        "createdate": raw_response.properties["createdate"],
-        "lastmodifeddate": raw_response.properties["hs_lastmodifieddate"],
-        "hubspot_owner_id": raw_response.properties["hubspot_owner_id"],
-        "associations": extract_associations(raw_response.associations),
-    }
+    return Deal(
+        id=raw_response.id,
+        dealname=raw_response.properties["dealname"],
+        dealstage=raw_response.properties["dealstage"],
+        amount=raw_response.properties["amount"],
+        closedate=raw_response.properties["closedate"],
+        createdate=raw_response.properties["createdate"],
+        lastmodifeddate=raw_response.properties["hs_lastmodifieddate"],
+        hubspot_owner_id=raw_response.properties["hubspot_owner_id"],
+        associations=extract_associations(raw_response.associations),
+    )
 
 
 def flatten_owner(raw_response):
-    return {
-        "id": raw_response.id,
-        "first_name": raw_response.first_name,
-        "last_name": raw_response.last_name,
-        "email": raw_response.email,
-    }
+    return Owner(
+        id=raw_response.id,
+        first_name=raw_response.first_name,
+        last_name=raw_response.last_name,
+        email=raw_response.email,
+    )
 
 
 def flatten_products(raw_response):
-    return {
-        "id": raw_response.id,
-        "name": raw_response.properties["name"],
-        "quantity": raw_response.properties["quantity"],
-        "amount": raw_response.properties["amount"],
-    }
+    return Product(
+        id=raw_response.id,
+        name=raw_response.properties["name"],
+        quantity=raw_response.properties["quantity"],
+        amount=raw_response.properties["amount"],
+    )
 
 
 def flatten_task(raw_task):
     # Assuming a task has properties like a title, status, body, etc.
     # You can modify this as per the actual structure of a task object
-    return {
-        "id": raw_task.id,
-        "owner_id": raw_task.properties["hubspot_owner_id"],
-        "subject": raw_task.properties["hs_task_subject"],
-        "status": raw_task.properties["hs_task_status"],
-        "priority": raw_task.properties["hs_task_priority"],
-        "type": raw_task.properties["hs_task_type"],
-        "body": raw_task.properties["hs_task_body"]
-    }
+    return Task(
+        id=raw_task.id,
+        owner_id=raw_task.properties["hubspot_owner_id"],
+        subject=raw_task.properties["hs_task_subject"],
+        status=raw_task.properties["hs_task_status"],
+        priority=raw_task.properties["hs_task_priority"],
+        type=raw_task.properties["hs_task_type"],
+        body=raw_task.properties["hs_task_body"]
+    )
 
 
 def flatten_note(raw_note):
     # Modify based on actual structure of a note object
-    return {
-        "id": raw_note.id,
-        "body": raw_note.properties["hs_note_body"],
-        "owner_id": raw_note.properties["hubspot_owner_id"]
-    }
+    return Note(
+        id=raw_note.id,
+        body=raw_note.properties["hs_note_body"],
+        owner_id=raw_note.properties["hubspot_owner_id"]
+    )
 
 
 def flatten_call(raw_call):
     # Modify based on actual structure of a call object
-    return {
-        "id": raw_call.id,
-        "body": raw_call.properties["hs_call_body"],
-        "direction": raw_call.properties["hs_call_direction"],
-        "disposition": raw_call.properties["hs_call_disposition"],
-        "duration": raw_call.properties["hs_call_duration"],
-        "status": raw_call.properties["hs_call_status"],
-        "title": raw_call.properties["hs_call_title"]
-    }
+    return Call(
+        id=raw_call.id,
+        body=raw_call.properties["hs_call_body"],
+        direction=raw_call.properties["hs_call_direction"],
+        disposition=raw_call.properties["hs_call_disposition"],
+        duration=raw_call.properties["hs_call_duration"],
+        status=raw_call.properties["hs_call_status"],
+        title=raw_call.properties["hs_call_title"]
+    )
 
 
 def flatten_meeting(raw_meeting):
     # Modify based on actual structure of a meeting object
-    return {
-        "id": raw_meeting.id,
-        "title": raw_meeting.properties["hs_meeting_title"],
-        "body": raw_meeting.properties["hs_meeting_body"],
-        "location": raw_meeting.properties["hs_meeting_location"]
-    }
+    return Meeting(
+        id=raw_meeting.id,
+        title=raw_meeting.properties["hs_meeting_title"],
+        body=raw_meeting.properties["hs_meeting_body"],
+        location=raw_meeting.properties["hs_meeting_location"]
+    )
+
+
+def sync_mirror(*object_types):
+    """Brings the mirror of the object types up to date, unless it's disabled
+    or they were synced less than INDEX_MAX_AGE seconds ago."""
+    mirror = get_hubspot_mirror()
+    if mirror is None or not object_types:
+        return
+    fetch_concurrently(
+        {
+            object_type: functools.partial(mirror.sync, object_type, max_age=INDEX_MAX_AGE)
+            for object_type in object_types
+        }
+    )
 
 
-def get_activities():
-    # print("listing activities")
+def iter_objects(object_type):
+    """Yields raw `object_type` records, read from the local mirror when enabled.
+    The mirror isn't synced here, see sync_mirror."""
+    mirror = get_hubspot_mirror()
+    if mirror is not None:
+        return mirror.records(object_type)
+    spec = OBJECT_SPECS[object_type]
+    return get_all_hydrated(get_hs_client(), object_type, spec["properties"], spec["associations"])
 
-    tasks = [
-        flatten_task(task)
-        for task in hs_client.crm.objects.get_all(
-            object_type="tasks",
-            associations=["deals"],
-            properties=[
-                "hubspot_owner_id",
-                "hs_task_subject",
-                "hs_task_status",
-                "hs_task_priority",
-                "hs_task_type",
-                "hs_task_body",
-            ],
-        )
-    ]
 
-    notes = [
-        flatten_note(note)
-        for note in hs_client.crm.objects.get_all(
-            object_type="notes",
-            associations=["deals"],
-            properties=["hs_note_body", "hubspot_owner_id"],
-        )
-    ]
+def fetch_concurrently(fetches):
+    """Runs the `name -> callable` fetches in parallel and returns `name -> result`."""
+    with ThreadPoolExecutor(max_workers=min(len(fetches), HUBSPOT_MAX_WORKERS)) as executor:
+        futures = {name: executor.submit(in_current_context(fetch)) for name, fetch in fetches.items()}
+    return {name: future.result() for name, future in futures.items()}
 
-    calls = [
-        flatten_call(call)
-        for call in hs_client.crm.objects.get_all(
-            object_type="calls",
-            associations=["deals"],
-            properties=[
-                "hs_call_body",
-                "hs_call_direction",
-                "hs_call_disposition",
-                "hs_call_duration",
-                "hs_call_status",
-                "hs_call_title",
-            ],
-        )
-    ]
 
-    meetings = [
-        flatten_meeting(meeting)
-        for meeting in hs_client.crm.objects.get_all(
-            object_type="meetings",
-            associations=["deals"],
-            properties=["hs_meeting_title", "hs_meeting_body", "hs_meeting_location"],
-        )
-    ]
+ACTIVITY_FLATTENERS = {
+    "tasks": flatten_task,
+    "notes": flatten_note,
+    "calls": flatten_call,
+    "meetings": flatten_meeting,
+}
 
-    return {"tasks": tasks, "notes": notes, "calls": calls, "meetings": meetings}
+
+@cached("activities")
+def get_activities():
+    # print("listing activities")
+    raw_activities = fetch_concurrently(
+        {
+            activity_type: functools.partial(iter_objects, activity_type)
+            for activity_type in ACTIVITY_FLATTENERS
+        }
+    )
+    return {
+        activity_type: [ACTIVITY_FLATTENERS[activity_type](raw) for raw in raw_activities[activity_type]]
+        for activity_type in ACTIVITY_FLATTENERS
+    }
 
 
+@cached("contacts")
 def get_all_contacts():
     # print("listing contacts")
     response = []
-    for raw_response in hs_client.crm.contacts.get_all(
-            associations=["companies", "deals"]
-    ):
+    for raw_response in iter_objects("contacts"):
         response.append(flatten_contact(raw_response))
     return response
 
 
+@cached("companies")
 def get_all_companies():
     # print("listing companies")
     response = []
-    for raw_response in hs_client.crm.companies.get_all(
-            associations=["contacts", "deals"]
-    ):
+    for raw_response in iter_objects("companies"):
         response.append(flatten_company(raw_response))
     return response
 
 
+@cached("products")
 def get_products():
     response = []
-    for raw_response in hs_client.crm.line_items.get_all(
-            properties=["name", "quantity", "amount"]
-    ):
+    for raw_response in iter_objects("line_items"):
         response.append(flatten_products(raw_response))
     return response
 
 
+@cached("owners")
 def get_deal_owner():
     # print("listing owners")
     response = []
-    for raw_response in hs_client.crm.owners.get_all():
+    for raw_response in get_hs_client().crm.owners.get_all():
         response.append(flatten_owner(raw_response))
     return response
 
 
+@cached("deals")
 def get_all_deals():
     # print("listing deals")
     response = []
-    for raw_response in hs_client.crm.deals.get_all(
-            associations=[
-                "companies",
-                "contacts",
-                "line_items",
-                "calls",
-                "meetings",
-                "tasks",
-                "notes",
-                "tickets",
-            ],
-            properties=["hubspot_owner_id", "amount", "dealname", "dealstage", "closedate"],
-    ):
+    for raw_response in iter_objects("deals"):
         response.append(flatten_deal(raw_response))
     return response
 
 
+# Default and maximum number of records a single search tool call returns.
+SEARCH_RESULT_CAP = 100
+MAX_SEARCH_RESULTS = 1000
+
+DEAL_SEARCH_PROPERTIES = ["dealname", "dealstage", "amount", "closedate", "hubspot_owner_id"]
+COMPANY_SEARCH_PROPERTIES = ["name", "domain"]
+CONTACT_SEARCH_PROPERTIES = ["email", "firstname", "lastname"]
+
+
+def _date_to_millis(value, end_of_day=False):
+    """Returns an ISO date or timestamp in epoch milliseconds, or None if it isn't one."""
+    try:
+        moment = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    if end_of_day and len(str(value)) == 10:
+        moment += timedelta(days=1, milliseconds=-1)
+    return str(int(moment.timestamp() * 1000))
+
+
+@traced("hubspot.search_objects")
+def search_objects(object_type, filters, properties, limit=SEARCH_RESULT_CAP):
+    """Runs a HubSpot CRM search and returns only the requested properties
+    of at most `limit` matching records, along with the total match count."""
+    limit = max(1, min(int(limit), MAX_SEARCH_RESULTS))
+    results = []
+    total = 0
+    after = None
+    while len(results) < limit:
+        request = PublicObjectSearchRequest(
+            filter_groups=[{"filters": filters}] if filters else [],
+            properties=properties,
+            limit=min(SEARCH_PAGE_SIZE, limit - len(results)),
+            after=after,
+        )
+        page = get_hs_client().crm.objects.search_api.do_search(
+            object_type, public_object_search_request=request
+        )
+        total = page.total
+        for raw_response in page.results:
+            record = {"id": raw_response.id}
+            record.update({name: raw_response.properties.get(name) for name in properties})
+            results.append(record)
+        if page.paging is None:
+            break
+        after = page.paging.next.after
+    return {"total": total, "returned": len(results), "results": results}
+
+
+def search_deals(
+    dealstage=None,
+    closedate_from=None,
+    closedate_to=None,
+    owner_id=None,
+    amount_min=None,
+    amount_max=None,
+    company_id=None,
+    properties=None,
+    limit=SEARCH_RESULT_CAP,
+):
+    closedate_from_millis = _date_to_millis(closedate_from) if closedate_from else None
+    closedate_to_millis = _date_to_millis(closedate_to, end_of_day=True) if closedate_to else None
+    invalid = [
+        value
+        for value, millis in ((closedate_from, closedate_from_millis), (closedate_to, closedate_to_millis))
+        if value and millis is None
+    ]
+    if invalid:
+        return f"Invalid dates {', '.join(map(repr, invalid))}, use YYYY-MM-DD."
+    filters = []
+    if dealstage:
+        if isinstance(dealstage, list):
+            filters.append({"propertyName": "dealstage", "operator": "IN", "values": dealstage})
+        else:
+            filters.append({"propertyName": "dealstage", "operator": "EQ", "value": dealstage})
+    if closedate_from_millis:
+        filters.append({"propertyName": "closedate", "operator": "GTE", "value": closedate_from_millis})
+    if closedate_to_millis:
+        filters.append({"propertyName": "closedate", "operator": "LTE", "value": closedate_to_millis})
+    if owner_id:
+        filters.append({"propertyName": "hubspot_owner_id", "operator": "EQ", "value": owner_id})
+    if amount_min is not None:
+        filters.append({"propertyName": "amount", "operator": "GTE", "value": str(amount_min)})
+    if amount_max is not None:
+        filters.append({"propertyName": "amount", "operator": "LTE", "value": str(amount_max)})
+    if company_id:
+        filters.append({"propertyName": "associations.company", "operator": "EQ", "value": company_id})
+    return search_objects("deals", filters, properties or DEAL_SEARCH_PROPERTIES, limit)
+
+
+def search_companies(name=None, domain=None, properties=None, limit=SEARCH_RESULT_CAP):
+    filters = []
+    if name:
+        filters.append({"propertyName": "name", "operator": "CONTAINS_TOKEN", "value": name})
+    if domain:
+        filters.append({"propertyName": "domain", "operator": "EQ", "value": domain})
+    return search_objects("companies", filters, properties or COMPANY_SEARCH_PROPERTIES, limit)
+
+
+def search_contacts(company_id=None, email=None, properties=None, limit=SEARCH_RESULT_CAP):
+    filters = []
+    if company_id:
+        filters.append({"propertyName": "associations.company", "operator": "EQ", "value": company_id})
+    if email:
+        filters.append({"propertyName": "email", "operator": "EQ", "value": email})
+    return search_objects("contacts", filters, properties or CONTACT_SEARCH_PROPERTIES, limit)
+
+
 def match_activities_to_deals():
-    deals = get_all_deals()
-    activities = get_activities()
+    fetched = fetch_concurrently({"deals": get_all_deals, "activities": get_activities})
+    deals = fetched["deals"]
+    activities = fetched["activities"]
 
     activity_map = {}
     for activity_type, activity_list in activities.items():
@@ -259,7 +606,7 @@ def match_activities_to_deals():
     deal_activities = {}
 
     for deal in deals:
-        if not isinstance(deal, dict):
+        if not isinstance(deal, Mapping):
             print(f"Unexpected item in deals: {deal}")
             continue
 
@@ -280,6 +627,70 @@ def match_activities_to_deals():
                     activity_type, activity_data = activity_map[associated_id]
                     matched_activities[activity_type].append(activity_data)
 
-        deal_activities[dealname] = matched_activities
+        deal_activities[deal_id] = {'dealname': dealname, **matched_activities}
 
     return deal_activities
+
+
+MIRROR_REQUIRED = "This function requires the local Hubspot mirror, set HUBSPOT_MIRROR_PATH to enable it."
+
+
+def _related(object_type, object_id, related_type, flatten):
+    mirror = get_hubspot_mirror()
+    mirror.sync(related_type, max_age=INDEX_MAX_AGE)
+    related_ids = mirror.related_ids(object_type, object_id, related_type)
+    return [flatten(raw_response) for raw_response in mirror.records(related_type, related_ids)]
+
+
+def _mirrored(object_type, object_id, flatten):
+    mirror = get_hubspot_mirror()
+    mirror.sync(object_type, max_age=INDEX_MAX_AGE)
+    records = mirror.records(object_type, [object_id])
+    return flatten(records[0]) if records else None
+
+
+@traced("hubspot.get_deal_activities")
+def get_deal_activities(deal_id):
+    """Returns the tasks, notes, calls and meetings associated with one deal."""
+    if not HUBSPOT_MIRROR_PATH:
+        return match_activities_to_deals().get(deal_id, {})
+    deal = _mirrored("deals", deal_id, flatten_deal)
+    activities = fetch_concurrently(
+        {
+            activity_type: functools.partial(_related, "deals", deal_id, activity_type, flatten)
+            for activity_type, flatten in ACTIVITY_FLATTENERS.items()
+        }
+    )
+    return {"dealname": deal["dealname"] if deal else None, **activities}
+
+
+@traced("hubspot.get_deal_details")
+def get_deal_details(deal_id):
+    """Returns one deal along with its associated companies and contacts."""
+    if not HUBSPOT_MIRROR_PATH:
+        return MIRROR_REQUIRED
+    return {
+        "deal": _mirrored("deals", deal_id, flatten_deal),
+        "companies": _related("deals", deal_id, "companies", flatten_company),
+        "contacts": _related("deals", deal_id, "contacts", flatten_contact),
+    }
+
+
+@traced("hubspot.get_company_deals")
+def get_company_deals(company_id):
+    """Returns one company along with its associated deals."""
+    if not HUBSPOT_MIRROR_PATH:
+        return MIRROR_REQUIRED
+    return {
+        "company": _mirrored("companies", company_id, flatten_company),
+        "deals": _related("companies", company_id, "deals", flatten_deal),
+    }
+
+
+def hubspot_data_version():
+    # The stored watermarks, as of the last sync of the tools.
+    return get_hubspot_mirror().data_version()
+
+
+if HUBSPOT_MIRROR_PATH:
+    register_data_version("hubspot", hubspot_data_version)
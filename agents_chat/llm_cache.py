@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+from cache_utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_data_versions = {}
+
+
+def register_data_version(source, version):
+    """Registers `version()`, returning a JSON-serializable value that changes
+    whenever the data of `source` changes. Cached answers are only reused
+    while the versions of all sources are the same."""
+    _data_versions[source] = version
+
+
+def data_versions(sources):
+    """Returns the data versions of `sources`, or None if one of them has no
+    registered version."""
+    if any(source not in _data_versions for source in sources):
+        return None
+    return {source: _data_versions[source]() for source in sorted(sources)}
+
+
+def completion_cache_key(sources, **request):
+    """Returns a hash of the completion request and the current data versions
+    of the `sources` it reads, or None if a data version is unknown."""
+    try:
+        versions = data_versions(sources)
+    except Exception as err:
+        logger.warning(f"Could not determine data versions, bypassing the LLM cache: {err}")
+        return None
+    if versions is None:
+        return None
+    canonical = json.dumps(
+        {"request": request, "data_versions": versions},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class SQLiteLLMCache:
+    """Disk-backed cache shared by the processes of a host, evicting expired
+    and least recently used entries above `maxsize`."""
+
+    def __init__(self, path, maxsize=10_000, ttl=600):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at);
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM completions WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + (self.ttl if ttl is None else ttl), now),
+            )
+            conn.execute("DELETE FROM completions WHERE expires_at <= ?", (now,))
+            conn.execute(
+                """
+                DELETE FROM completions WHERE key NOT IN (
+                    SELECT key FROM completions ORDER BY accessed_at DESC LIMIT ?
+                )
+                """,
+                (self.maxsize,),
+            )
+
+    def stats(self):
+        with self._connect() as conn:
+            size = conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def create_llm_cache(url):
+    """Creates a cache from a URL such as `memory://?maxsize=512&ttl=600` or
+    `sqlite:///var/lib/chatbot/llm_cache.sqlite3?ttl=600`; `none` disables it."""
+    parsed = urlparse(url)
+    options = {key: int(values[-1]) for key, values in parse_qs(parsed.query).items()}
+    if url == "none":
+        return None
+    if parsed.scheme == "memory":
+        return TTLCache(maxsize=options.get("maxsize", 512), default_ttl=options.get("ttl", 600))
+    if parsed.scheme == "sqlite":
+        return SQLiteLLMCache(parsed.path, **options)
+    raise ValueError(f"Unsupported LLM cache: {url}")
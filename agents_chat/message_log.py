@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+
+from token_budget import drop_oldest_turns
+
+
+class MessageLog(list):
+    """Conversation history that only grows by appending messages.
+
+    The messages of a turn in progress follow the `committed` offset until the
+    turn is committed, or are dropped if it fails. Messages are never modified
+    once appended, so logs and prompts built from them share the message dicts
+    instead of copying them. Being a list, a log serializes to JSON as one.
+    """
+
+    def __init__(self, messages=()):
+        super().__init__(messages)
+        self.committed = len(self)
+
+    def pending(self):
+        """Returns the messages appended since the last commit."""
+        return self[self.committed:]
+
+    def commit(self):
+        self.committed = len(self)
+
+    def rollback(self):
+        del self[self.committed:]
+
+    @contextmanager
+    def turn(self):
+        """Commits the messages appended in the block, or drops them if it raises."""
+        self.rollback()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def snapshot(self):
+        """Returns the messages as a plain list sharing them, e.g. for a prompt
+        that is trimmed to the token budget without touching the history."""
+        return list(self)
+
+    def drop_oldest_turns(self, budget):
+        """Drops the oldest committed turns until the log fits into `budget`
+        tokens and returns its token count."""
+        self.rollback()
+        tokens = drop_oldest_turns(self, budget)
+        self.commit()
+        return tokens
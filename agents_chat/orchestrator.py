@@ -1,3 +1,4 @@
+import functools
 import os
 import logging
 
@@ -6,10 +7,11 @@ import openai
 from salesforce_agent import ask_salesforce_agent
 from hubspot_agent import ask_hubspot_agent, chat
 from db_agent import ask_db_agent
-
-
-from dotenv import load_dotenv
-load_dotenv()
+from entity_resolution import get_unified_customers
+from aggregations import aggregate_deals
+from query_context import QueryContext
+from router import SOURCES, route_question
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -24,18 +26,22 @@ SYSTEM_PROMPT = """
         'customers'. Provide company details when asked.
         Salesforce agent: 'Accounts' in Salesforce refer to Companies and 'Opportunities' refer to Deals.
         
-        ***NOTE: HubSpot, SQL and Salesforce have different identifiers. Always cross-reference and combine data from 
-        all the sources for answers.***
+        ***NOTE: HubSpot, SQL and Salesforce have different identifiers. Cross-reference and combine the data of the 
+        sources for answers. When the problem says that only some sources hold relevant data, query only those - 
+        this takes precedence over every rule below.***
         
         Operations:
         1. For companies with past purchases and new sales opportunities, match "closed won" deals in HubSpot and 
         Salesforce with  invoiced companies in SQL. Check HubSpot and Salesforce for new deals/ opportunities.
         2. For companies with past purchases but no new opportunities, match "closed won" deals in HubSpot and 
         Salesforce with invoiced companies in SQL. 
-        3. To list customers, show unique companies from SQL, HubSpot and Salesforce combined together.
+        3. To list customers, show unique companies from SQL, HubSpot and Salesforce combined together - 
+        get_unified_customers returns them already matched across the sources, with their ids in every source.
         4. ***For customer count -  count all the unique companies/ accounts, tally unique companies from the sources***
+        - use the customer_count of get_unified_customers.
         5. For revenue calculations, consider SQL invoice amounts/dates and HubSpot's "closed won" deal amounts/dates 
-        and Salesforce "closed won" opportunities. 
+        and Salesforce "closed won" opportunities - aggregate_deals with statuses won and invoiced reports the
+        won deals and the invoices separately. Won deals are often invoiced as well, never add the two up.
         6. For "list my deals", provide all deals from both HubSpot and Salesforce plus invoices from SQL.
         7. For successful deals, match "closed won" deals in HubSpot and Salesforce with invoiced companies in SQL.
         8. When querying revenue or details from a specific criterion (e.g., country, product type): 
@@ -53,12 +59,13 @@ SYSTEM_PROMPT = """
         - When the user asks about customers - count unique companies from database, Hubspot and Salesforce- check 
         unique companies from all sources.
         - Execute after planning. DO NOT PROVIDE THE PLAN HOW TO SOLVE THE PROBLEM!!
-        - ALWAYS COMBINE DATA FROM ALL THE SOURCES.
+        - ALWAYS COMBINE DATA FROM ALL THE SOURCES YOU ARE ALLOWED TO QUERY.
         - *** Company representative in database is the same as CONTACT from Hubspot and CONTACT from Salesforce*** 
-        - WHILE PERFORMING MATH - BE CAREFUL! Better just leave the amounts without performing math!
+        - DO NOT PERFORM MATH YOURSELF - use aggregate_deals for sums, averages and counts of deals, opportunities 
+        and invoices.
         - If I ask - count my customers - count unique COMPANIES from all the sources!
-        - To calculate the forecast revenue - check open deals (all the deals besides closed won or closed lost deals) 
-        and sum the prices.
+        - To calculate the forecast revenue - sum the open deals (all the deals besides closed won or closed lost deals) 
+        with aggregate_deals and status open.
         - To count my customers check companies in database, salesforce and hubspot - list them all, do not repeat, 
         take unique companies from all the sources.
         - To list deal owners, match them with deals from Hubspot and Salesforce
@@ -110,12 +117,66 @@ functions = [
             "required": [],
         }
     },
+    {
+        "name": "get_unified_customers",
+        "description": "Returns the unique companies of HubSpot, Salesforce and the SQL database, matched across "
+        "the sources by domain and name, with their ids in every source and the customer count",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "sources": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": ["hubspot", "salesforce", "sql"]},
+                    "description": "only return the companies present in all of these sources"
+                }
+            },
+            "required": [],
+        }
+    },
+    {
+        "name": "aggregate_deals",
+        "description": "Computes the sum, average or count of the HubSpot deals, Salesforce opportunities and SQL "
+        "invoices, or the number of their customers, e.g. revenue (statuses won and invoiced, sum_amount, reported "
+        "separately for deals and invoices) or forecast (status open, sum_amount), optionally grouped and limited "
+        "to a range of close/invoice dates",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "metric": {
+                    "type": "string",
+                    "enum": ["sum_amount", "avg_amount", "count", "count_customers"]
+                },
+                "statuses": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": ["won", "lost", "open", "invoiced"]},
+                    "description": "only these statuses, all by default; SQL invoices have the status invoiced"
+                },
+                "sources": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": ["hubspot", "salesforce", "sql"]},
+                    "description": "only these sources, all by default"
+                },
+                "group_by": {
+                    "type": "array",
+                    "items": {
+                        "type": "string",
+                        "enum": ["source", "customer", "status", "owner", "year", "quarter", "month"]
+                    }
+                },
+                "date_from": {"type": "string", "description": "first date included, YYYY-MM-DD"},
+                "date_to": {"type": "string", "description": "last date included, YYYY-MM-DD"}
+            },
+            "required": ["metric"],
+        }
+    },
 ]
 
 available_functions = {
     "ask_hubspot_agent": ask_hubspot_agent,
     "ask_db_agent": ask_db_agent,
     "ask_salesforce_agent": ask_salesforce_agent,
+    "get_unified_customers": get_unified_customers,
+    "aggregate_deals": aggregate_deals,
 }
 
 PROMPT_TEMPLATE = """
@@ -124,16 +185,85 @@ PROMPT_TEMPLATE = """
         2. Create a plan with minimal steps and function calls for accuracy.
         3. Present the plan.
         4. Check database, Salesforce and Hubspot, remember that sometimes the data in the sources is not overlapping. 
+           Ask all the agents you need in the same turn - they are queried in parallel.
         5. Execute and resolve.
     Problem: {}
 
 """
 
+# Appended to the prompt when the router found that only some sources are needed.
+ROUTED_PROMPT = """
+    Only {} hold data relevant to this problem - do not query the other sources.
+"""
+
+# Sub-agent querying every source, and how the prompt refers to the source.
+SOURCE_AGENTS = {
+    "hubspot": ("ask_hubspot_agent", "HubSpot"),
+    "salesforce": ("ask_salesforce_agent", "Salesforce"),
+    "sql": ("ask_db_agent", "the SQL database"),
+}
+# Sub-agents keeping their conversation for the follow-up questions of a query.
+CONTEXT_AGENTS = {"ask_hubspot_agent", "ask_salesforce_agent"}
+# Argument limiting the tools reading several sources to the routed ones.
+ROUTED_ARGUMENTS = {"get_unified_customers": "searched_sources", "aggregate_deals": "sources"}
+
+
+PROGRESS_MESSAGES = {
+    "ask_hubspot_agent": "querying HubSpot…",
+    "ask_db_agent": "querying the database…",
+    "ask_salesforce_agent": "querying Salesforce…",
+    "get_unified_customers": "matching customers across sources…",
+    "aggregate_deals": "aggregating deals…",
+}
+
+
+def get_response(query, messages, on_token=None, on_progress=None, on_plan=None):
+    """Answers `query` in the conversation `messages`, a `MessageLog`.
+
+    `on_token` receives the streamed tokens of the answer and `on_progress`
+    a short message whenever a source is queried. Text the LLM writes before
+    querying the sources is streamed too, then passed to `on_plan` once it
+    turns out to be a plan rather than the answer. The sub-agents and the tool
+    results are shared for the whole query.
+    """
+    context = QueryContext()
+    with span("get_response") as response_span:
+        route = route_question(query)
+        skipped = {SOURCE_AGENTS[source][0] for source in SOURCES if source not in route.sources}
+        response_span.set(route=route.method, skipped_agents=len(skipped))
+        prompt = PROMPT_TEMPLATE.format(query)
+        if skipped:
+            prompt += ROUTED_PROMPT.format(" and ".join(SOURCE_AGENTS[source][1] for source in route.sources))
+
+        def on_tool_call(name, arguments):
+            if on_progress:
+                on_progress(PROGRESS_MESSAGES.get(name, f"running {name}…"))
+
+        functions_of_route = {}
+        for name, function in available_functions.items():
+            if name in skipped:
+                continue
+            if name in CONTEXT_AGENTS:
+                function = functools.partial(function, context=context)
+            elif name in ROUTED_ARGUMENTS and skipped:
+                # A default: the LLM may still pass other sources explicitly.
+                function = functools.partial(function, **{ROUTED_ARGUMENTS[name]: list(route.sources)})
+            functions_of_route[name] = function
 
-def get_response(query, messages):
-    prompt = PROMPT_TEMPLATE.format(query)
-    response, token_nums = chat(prompt, messages, available_functions, functions, agent_name="orchestrator")
-    return response, token_nums
+        response, token_nums = chat(
+            prompt,
+            messages,
+            functions_of_route,
+            [function for function in functions if function["name"] not in skipped],
+            agent_name="orchestrator",
+            on_token=on_token,
+            on_plan=on_plan,
+            on_tool_call=on_tool_call,
+            context=context,
+            data_sources=SOURCES,
+        )
+        response_span.set(memoized_tool_calls=context.results.hits)
+        return response, token_nums
 
 
 # if __name__ == "__main__":
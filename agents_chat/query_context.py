@@ -0,0 +1,44 @@
+import json
+import math
+import os
+import threading
+
+from cache_utils import TTLCache
+
+# Distinct tool calls whose results a single user query keeps.
+QUERY_RESULT_CACHE_SIZE = int(os.getenv("QUERY_RESULT_CACHE_SIZE", 256))
+
+
+class QueryContext:
+    """State shared by the orchestrator and the sub-agents while answering a
+    single user query: the results of the tools called so far and the
+    sub-agents asked so far, along with their conversations."""
+
+    def __init__(self):
+        # Results live as long as the query, so they never expire.
+        self.results = TTLCache(maxsize=QUERY_RESULT_CACHE_SIZE, default_ttl=math.inf)
+        self._agents = {}
+        self._lock = threading.Lock()
+
+    def memoize(self, function_name, arguments, call):
+        """Returns the result of `call()` and whether it was already known. Calls
+        of a tool with the same arguments, concurrent ones included, run once."""
+        key = (function_name, json.dumps(arguments, sort_keys=True))
+        called = []
+
+        def load():
+            called.append(True)
+            return call()
+
+        return self.results.get_or_load(key, load), not called
+
+    def ask(self, name, factory, query):
+        """Asks the sub-agent `name`, created by `factory` on the first question
+        of this query, so follow-up questions see the earlier ones. Questions
+        to the same sub-agent are answered one after the other."""
+        with self._lock:
+            if name not in self._agents:
+                self._agents[name] = (factory(), threading.Lock())
+            agent, agent_lock = self._agents[name]
+        with agent_lock:
+            return agent.chat(query, self)
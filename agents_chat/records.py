@@ -0,0 +1,66 @@
+import sys
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """A read-only record with a fixed set of fields, kept in slots instead of
+    a dict of its own. It reads like a dict, so `record["id"]`, `.get()` and
+    `dict(record)` work as with the dicts the records replace."""
+
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+    _shared = frozenset()
+
+    def __init__(self, **values):
+        unknown = values.keys() - self._field_set
+        if unknown:
+            raise TypeError(f"{type(self).__name__} has no fields {', '.join(sorted(unknown))}")
+        for field in self._fields:
+            value = values.get(field)
+            if field in self._shared and isinstance(value, str):
+                value = sys.intern(value)
+            object.__setattr__(self, field, value)
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __reduce__(self):
+        return _restore, (type(self), dict(self))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)})"
+
+
+def _restore(record_type, values):
+    return record_type(**values)
+
+
+def record_type(name, fields, shared=()):
+    """Returns a Record subclass with the given fields. Values of the `shared`
+    fields repeat across records, e.g. stages and owner ids, so they are
+    interned and every record refers to the same string."""
+    fields = tuple(fields)
+    return type(
+        name,
+        (Record,),
+        {
+            "__slots__": fields,
+            "_fields": fields,
+            "_field_set": frozenset(fields),
+            "_shared": frozenset(shared),
+            # Like namedtuple, so the records pickle by the caller's module.
+            "__module__": sys._getframe(1).f_globals.get("__name__", "__main__"),
+        },
+    )
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# The entry points (flask_app, chatbot_app, benchmark) load .env before any
+# other import; this covers the modules imported on their own, e.g. from a
+# notebook, as long as they import this module before their first os.getenv.
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+RESOURCES = {}
+
+
+class ResourceUnavailable(Exception):
+    """Raised when an external client can't be constructed, e.g. because its
+    backend is down. Callers report the source as unavailable and go on."""
+
+
+class Lazy:
+    """Thread-safe accessor of an external client, constructed by `factory` on
+    first use. A failed construction is retried on use, but at most once per
+    `retry_interval` seconds so that a backend that is down doesn't block
+    every request for its connect timeout."""
+
+    def __init__(self, name, factory, retry_interval=30):
+        self.name = name
+        self.factory = factory
+        self.retry_interval = retry_interval
+        self._value = None
+        self._ready = False
+        self._error = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+        RESOURCES[name] = self
+
+    def get(self):
+        if self._ready:
+            return self._value
+        with self._lock:
+            if self._ready:
+                return self._value
+            if self._error is not None and time.monotonic() - self._failed_at < self.retry_interval:
+                raise ResourceUnavailable(f"{self.name} is unavailable: {self._error}")
+            started_at = time.monotonic()
+            try:
+                self._value = self.factory()
+            except Exception as err:
+                self._error = err
+                self._failed_at = time.monotonic()
+                logger.exception(f"Could not initialize {self.name}")
+                raise ResourceUnavailable(f"{self.name} is unavailable: {err}") from err
+            self._ready = True
+            self._error = None
+            logger.info(f"Initialized {self.name} in {time.monotonic() - started_at:.2f}s")
+            return self._value
+
+    def status(self):
+        if self._ready:
+            return "ready"
+        if self._error is not None:
+            return f"failed: {self._error}"
+        return "not initialized"
+
+
+def warm_up(names=None):
+    """Initializes the given resources, or all of them, in a background thread
+    so that the first requests don't pay for it."""
+
+    def run():
+        for name in names or list(RESOURCES):
+            try:
+                RESOURCES[name].get()
+            except ResourceUnavailable:
+                pass
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def resource_status():
+    return {name: resource.status() for name, resource in RESOURCES.items()}
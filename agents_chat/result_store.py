@@ -0,0 +1,449 @@
+import io
+import json
+import os
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict, namedtuple
+from collections.abc import Mapping
+
+import pyarrow.parquet as pq
+
+from cache_utils import TTLCache
+
+# Tool results whose encoding is longer than this are stored under a handle
+# and only previewed to the LLM.
+MAX_INLINE_RESULT_CHARS = int(os.getenv("MAX_INLINE_RESULT_CHARS", 4000))
+PREVIEW_ROWS = 5
+MAX_PAGE_ROWS = 50
+# Largest groups aggregate_result returns; its output is always inlined.
+MAX_AGGREGATE_GROUPS = 100
+
+result_store = TTLCache(
+    maxsize=int(os.getenv("RESULT_STORE_SIZE", 256)),
+    default_ttl=int(os.getenv("RESULT_STORE_TTL", 3600)),
+)
+# Directory of results too large to keep in memory, stored as Parquet files.
+RESULT_FILES_DIR = os.getenv("RESULT_FILES_DIR") or os.path.join(tempfile.gettempdir(), "agent_results")
+
+# A result stored in a Parquet file, read column by column on demand.
+FileResult = namedtuple("FileResult", ["path", "row_count"])
+
+TABLE_DELIMITER = "|"
+# In tables of at least MIN_CODED_ROWS rows, values repeated in columns with
+# at most MAX_CODED_VALUES distinct values, such as stages and owner ids, are
+# replaced by codes like ~1 listed below the rows.
+MIN_CODED_ROWS = 10
+MAX_CODED_VALUES = 50
+CODE_PREFIX = "~"
+
+
+def _flatten_record(record, prefix=""):
+    row = {}
+    for key, value in record.items():
+        if key == "attributes":
+            # Salesforce metadata attached to every record.
+            continue
+        if isinstance(value, Mapping):
+            row.update(_flatten_record(value, f"{prefix}{key}."))
+        else:
+            row[f"{prefix}{key}"] = value
+    return row
+
+
+def to_rows(result):
+    """Returns `result` as a list of flat dicts, or None if it isn't tabular."""
+    if isinstance(result, Mapping):
+        for key in ("records", "searchRecords", "results"):
+            # Salesforce query/search results and Hubspot search results.
+            if isinstance(result.get(key), list):
+                return to_rows(result[key])
+        if result and all(isinstance(value, list) for value in result.values()):
+            # Results grouped by type, e.g. {"tasks": [...], "notes": [...]}.
+            return [
+                {"object_type": group, **_flatten_record(item)}
+                for group, items in result.items()
+                for item in items
+                if isinstance(item, Mapping)
+            ]
+        if result and all(isinstance(value, Mapping) for value in result.values()):
+            # Results keyed by id, e.g. {deal_id: {...}}.
+            return [{"key": key, **_flatten_record(value)} for key, value in result.items()]
+        return None
+    if isinstance(result, list) and all(isinstance(item, Mapping) for item in result):
+        return [_flatten_record(item) for item in result]
+    return None
+
+
+def _schema(rows):
+    schema = {}
+    for row in rows:
+        for column, value in row.items():
+            if schema.get(column) in (None, "null"):
+                schema[column] = "null" if value is None else type(value).__name__
+    return schema
+
+
+def _preview(handle, rows, row_count=None):
+    return {
+        "handle": handle,
+        "row_count": len(rows) if row_count is None else row_count,
+        "schema": _schema(rows),
+        "rows": rows[:PREVIEW_ROWS],
+        "note": "Only the first rows are shown. Use get_result_page, filter_result or aggregate_result "
+        "with this handle to read the rest.",
+    }
+
+
+def _store(name, rows):
+    handle = f"{name}-{uuid.uuid4().hex[:8]}"
+    result_store.set(handle, rows)
+    return handle
+
+
+def _without_nulls(value):
+    if isinstance(value, Mapping):
+        return {key: _without_nulls(item) for key, item in value.items() if item is not None}
+    if isinstance(value, (list, tuple)):
+        return [_without_nulls(item) for item in value]
+    return value
+
+
+def _to_json(value):
+    return json.dumps(_without_nulls(value), separators=(",", ":"), ensure_ascii=False)
+
+
+def _cells(row, prefix=""):
+    """Yields the columns and text cells of a row, nested dicts such as the
+    associations spread over `parent.key` columns and nulls and empty lists
+    left out."""
+    for key, value in row.items():
+        if value is None or (isinstance(value, (list, tuple)) and not value):
+            continue
+        if isinstance(value, Mapping):
+            yield from _cells(value, f"{prefix}{key}.")
+        elif isinstance(value, bool):
+            yield f"{prefix}{key}", "true" if value else "false"
+        elif isinstance(value, (list, tuple)):
+            if all(isinstance(item, (str, int)) and " " not in str(item) for item in value):
+                # Lists of ids, e.g. associated records.
+                yield f"{prefix}{key}", " ".join(map(str, value))
+            else:
+                yield f"{prefix}{key}", _to_json(value)
+        else:
+            yield f"{prefix}{key}", str(value)
+
+
+def _codes(columns, rows):
+    """Returns the codes of the values repeated in low cardinality columns
+    that are shorter with a code than without."""
+    if len(rows) < MIN_CODED_ROWS:
+        return {}
+    counts = Counter()
+    for column in columns:
+        values = [row[column] for row in rows if row.get(column)]
+        distinct = len(set(values))
+        if distinct <= MAX_CODED_VALUES and distinct * 4 <= len(values):
+            counts.update(values)
+    if any(value.startswith(CODE_PREFIX) for row in rows for value in row.values()):
+        # The cells couldn't be told apart from the codes.
+        return {}
+    codes = {}
+    for value, count in counts.most_common():
+        code = f"{CODE_PREFIX}{len(codes) + 1}"
+        # The value is listed once along with its code.
+        if count * len(value) > (count + 1) * len(code) + len(value) + 2:
+            codes[value] = code
+    return codes
+
+
+def _escape(cell):
+    return (
+        cell.replace("\\", "\\\\")
+        .replace(TABLE_DELIMITER, f"\\{TABLE_DELIMITER}")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+        .replace("\r", "\\n")
+    )
+
+
+def _write_row(buffer, cells):
+    buffer.write(TABLE_DELIMITER.join(map(_escape, cells)) + "\n")
+
+
+def encode_table(rows, fields=None):
+    """Encodes rows as a header line and delimited lines, along with the other
+    `fields` of the result. Null cells are left empty, columns without any
+    value are left out and repeated values are replaced by codes."""
+    rows = [dict(_cells(row)) for row in rows]
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    codes = _codes(columns, rows)
+    buffer = io.StringIO()
+    for name, value in (fields or {}).items():
+        if value is not None:
+            buffer.write(f"{name}: {value if isinstance(value, str) else _to_json(value)}\n")
+    buffer.write(
+        f"{len(rows)} rows, cells separated by {TABLE_DELIMITER}, empty cells are null"
+        + (f", {CODE_PREFIX}N cells are codes listed below the rows" if codes else "")
+        + "\n"
+    )
+    _write_row(buffer, columns)
+    for row in rows:
+        cells = [codes.get(row.get(column, ""), row.get(column, "")) for column in columns]
+        while cells and not cells[-1]:
+            cells.pop()
+        _write_row(buffer, cells)
+    if codes:
+        _write_row(buffer, [f"{code}={value}" for value, code in codes.items()])
+    return buffer.getvalue()
+
+
+def _split(result):
+    """Returns the rows of a tabular result along with its other fields, or
+    None rows if it isn't tabular. In a dict the lists of records are the
+    rows, e.g. the deals of {"company": {...}, "deals": [...]}, with the
+    lists of several types told apart by an `object_type` column."""
+    if isinstance(result, Mapping):
+        tables = {
+            key: value
+            for key, value in result.items()
+            if isinstance(value, list) and all(isinstance(item, Mapping) for item in value)
+        }
+        if tables and len(tables) < len(result):
+            fields = {key: value for key, value in result.items() if key not in tables}
+            return to_rows(next(iter(tables.values())) if len(tables) == 1 else tables), fields
+    return to_rows(result), {}
+
+
+def encode_result(function_name, result):
+    """Encodes a tool result for the LLM, tabular ones as compact tables and
+    others as JSON without nulls. Large tabular results are stored under a
+    handle and a preview of them is returned instead."""
+    rows, fields = _split(result)
+    if rows is None:
+        return _to_json(result)
+    content = encode_table(rows, fields)
+    if len(content) <= MAX_INLINE_RESULT_CHARS or function_name in RESULT_FUNCTIONS:
+        return content
+    preview = _preview(_store(function_name, rows), rows)
+    return encode_table(preview.pop("rows"), preview)
+
+
+def new_result_file(name):
+    """Returns a path for a new result file, deleting the files of results
+    that have expired from the store."""
+    os.makedirs(RESULT_FILES_DIR, exist_ok=True)
+    expired_before = time.time() - result_store.default_ttl
+    for entry in os.scandir(RESULT_FILES_DIR):
+        if entry.stat().st_mtime < expired_before:
+            os.remove(entry.path)
+    return os.path.join(RESULT_FILES_DIR, f"{name}-{uuid.uuid4().hex}.parquet")
+
+
+def store_file(name, path, row_count):
+    """Stores the Parquet file at `path` under a handle and returns its preview."""
+    handle = f"{name}-{uuid.uuid4().hex[:8]}"
+    result_store.set(handle, FileResult(path, row_count))
+    batch = next(pq.ParquetFile(path).iter_batches(batch_size=PREVIEW_ROWS), None)
+    return _preview(handle, batch.to_pylist() if batch is not None else [], row_count)
+
+
+def _load(handle):
+    stored = result_store.get(handle)
+    if stored is None:
+        raise KeyError(handle)
+    return stored
+
+
+def _row_count(stored):
+    return stored.row_count if isinstance(stored, FileResult) else len(stored)
+
+
+def _rows(stored, columns=None, offset=0, limit=None):
+    """Returns the rows of a stored result. Of a file only the given columns,
+    all by default, and the requested rows are read."""
+    if not isinstance(stored, FileResult):
+        return stored[offset:None if limit is None else offset + limit]
+    names = pq.read_schema(stored.path).names
+    table = pq.read_table(
+        stored.path, columns=[name for name in names if columns is None or name in columns]
+    )
+    return table.slice(offset, limit).to_pylist()
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _matches(cell, operator, value):
+    if operator == "eq":
+        return str(cell).lower() == str(value).lower()
+    if operator == "ne":
+        return str(cell).lower() != str(value).lower()
+    if operator == "contains":
+        return cell is not None and str(value).lower() in str(cell).lower()
+    if operator == "in":
+        values = value if isinstance(value, list) else [value]
+        return str(cell).lower() in {str(item).lower() for item in values}
+    if operator == "is_null":
+        return cell is None
+    cell_number, value_number = _number(cell), _number(value)
+    if cell_number is not None and value_number is not None:
+        cell, value = cell_number, value_number
+    elif cell is None:
+        return False
+    else:
+        cell, value = str(cell), str(value)
+    return {
+        "gt": cell > value,
+        "gte": cell >= value,
+        "lt": cell < value,
+        "lte": cell <= value,
+    }[operator]
+
+
+def _project(rows, columns):
+    if not columns:
+        return rows
+    return [{column: row.get(column) for column in columns} for row in rows]
+
+
+def get_result_page(handle, offset=0, limit=20, columns=None):
+    try:
+        stored = _load(handle)
+    except KeyError:
+        return f"There is no stored result {handle}, it may have expired."
+    try:
+        offset = max(0, int(offset or 0))
+        limit = max(1, min(int(limit or MAX_PAGE_ROWS), MAX_PAGE_ROWS))
+    except (TypeError, ValueError):
+        return f"offset and limit must be integers, got {offset!r} and {limit!r}."
+    return {
+        "handle": handle,
+        "row_count": _row_count(stored),
+        "offset": offset,
+        "rows": _project(_rows(stored, columns, offset, limit), columns),
+    }
+
+
+def filter_result(handle, column, operator, value=None, columns=None):
+    try:
+        stored = _load(handle)
+    except KeyError:
+        return f"There is no stored result {handle}, it may have expired."
+    rows = _rows(stored, [column, *columns] if columns else None)
+    filtered = _project([row for row in rows if _matches(row.get(column), operator, value)], columns)
+    if len(encode_table(filtered)) <= MAX_INLINE_RESULT_CHARS:
+        return {"row_count": len(filtered), "rows": filtered}
+    return _preview(_store(handle.rsplit("-", 1)[0], filtered), filtered)
+
+
+def aggregate_result(handle, operation, column=None, group_by=None):
+    try:
+        stored = _load(handle)
+    except KeyError:
+        return f"There is no stored result {handle}, it may have expired."
+    rows = _rows(stored, [column, group_by])
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row.get(group_by) if group_by else "all"].append(row)
+
+    def aggregate(group_rows):
+        if operation == "count":
+            return len(group_rows)
+        values = [row.get(column) for row in group_rows if row.get(column) is not None]
+        if operation == "count_distinct":
+            return len(Counter(map(str, values)))
+        numbers = [number for number in map(_number, values) if number is not None]
+        if not numbers:
+            return None
+        return {
+            "sum": sum(numbers),
+            "avg": sum(numbers) / len(numbers),
+            "min": min(numbers),
+            "max": max(numbers),
+        }[operation]
+
+    values = sorted(
+        ((str(key), aggregate(group_rows)) for key, group_rows in groups.items()),
+        key=lambda item: (item[1] is None, -(item[1] or 0)),
+    )
+    return {
+        "operation": operation,
+        "column": column,
+        "group_by": group_by,
+        "group_count": len(values),
+        "result": dict(values[:MAX_AGGREGATE_GROUPS]),
+    }
+
+
+RESULT_FUNCTIONS = {
+    "get_result_page": get_result_page,
+    "filter_result": filter_result,
+    "aggregate_result": aggregate_result,
+}
+
+RESULT_FUNCTION_SCHEMAS = [
+    {
+        "name": "get_result_page",
+        "description": "Returns a page of rows of a large stored result, identified by its handle.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle of the stored result."},
+                "offset": {"type": "integer", "description": "Index of the first row to return."},
+                "limit": {"type": "integer", "description": f"Number of rows, at most {MAX_PAGE_ROWS}."},
+                "columns": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Columns to return, all by default.",
+                },
+            },
+            "required": ["handle"],
+        },
+    },
+    {
+        "name": "filter_result",
+        "description": "Returns the rows of a stored result whose column matches the condition. "
+        "Large outputs are stored under a new handle.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle of the stored result."},
+                "column": {"type": "string", "description": "Column to filter on."},
+                "operator": {
+                    "type": "string",
+                    "enum": ["eq", "ne", "contains", "in", "gt", "gte", "lt", "lte", "is_null"],
+                },
+                "value": {"description": "Value to compare with, a list for the `in` operator."},
+                "columns": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Columns to return, all by default.",
+                },
+            },
+            "required": ["handle", "column", "operator"],
+        },
+    },
+    {
+        "name": "aggregate_result",
+        "description": "Computes count, count_distinct, sum, avg, min or max of a column of a stored "
+        f"result, optionally grouped by another column. Returns the {MAX_AGGREGATE_GROUPS} largest groups.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle of the stored result."},
+                "operation": {
+                    "type": "string",
+                    "enum": ["count", "count_distinct", "sum", "avg", "min", "max"],
+                },
+                "column": {"type": "string", "description": "Column to aggregate, not needed for count."},
+                "group_by": {"type": "string", "description": "Column to group the rows by."},
+            },
+            "required": ["handle", "operation"],
+        },
+    },
+]
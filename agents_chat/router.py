@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, namedtuple
+
+import numpy as np
+import openai
+
+from llm_cache import create_llm_cache
+from resources import Lazy, ResourceUnavailable
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ("hubspot", "salesforce", "sql")
+
+# An explicit mention of a source selects it, whatever else the question says.
+SOURCE_MENTIONS = {
+    "hubspot": re.compile(r"\bhub ?spot\b", re.IGNORECASE),
+    "salesforce": re.compile(r"\bsales ?force\b|\bsfdc\b|\bsoql\b", re.IGNORECASE),
+    "sql": re.compile(r"\bsql\b|\bdatabase\b|\bdb\b", re.IGNORECASE),
+}
+# Records that only live in some of the sources, e.g. invoices in SQL. When no
+# source is named, their sources are added to the ones the classifier or the
+# embeddings select, but never decide a route on their own.
+ENTITY_SOURCES = [
+    (re.compile(r"\bdeals?\b", re.IGNORECASE), ("hubspot", "salesforce")),
+    (re.compile(r"\bopportunit(y|ies)\b", re.IGNORECASE), ("salesforce",)),
+    (re.compile(r"\binvoic(e|es|ed|ing)\b", re.IGNORECASE), ("sql",)),
+    (re.compile(r"\bproducts?\b|\bline items?\b", re.IGNORECASE), ("hubspot",)),
+]
+# Questions that by definition combine all the sources.
+CROSS_SOURCE = re.compile(
+    r"\b(customers?|revenue|forecast|all (the )?sources|combined?|compare|across|unique)\b", re.IGNORECASE
+)
+
+# Labelled questions the classifier is trained on and the embeddings are
+# compared to.
+ROUTING_EXAMPLES = [
+    ("who owns the deal", ("hubspot", "salesforce")),
+    ("list my deals in the pipeline", ("hubspot", "salesforce", "sql")),
+    ("what stage is the deal with Acme in", ("hubspot", "salesforce")),
+    ("which deals close this month", ("hubspot", "salesforce")),
+    ("show the contacts of Acme", ("hubspot", "salesforce")),
+    ("what is the email of John Smith", ("hubspot", "salesforce")),
+    ("what products do we sell and what do they cost", ("hubspot",)),
+    ("what is the price of the product", ("hubspot",)),
+    ("show the line items of the deal", ("hubspot",)),
+    ("what activities, meetings and notes are logged on the deal", ("hubspot",)),
+    ("which emails were sent to the company last week", ("hubspot",)),
+    ("list the deal owners", ("hubspot", "salesforce")),
+    ("show the open opportunities of the account", ("salesforce",)),
+    ("which opportunities are in negotiation", ("salesforce",)),
+    ("list the accounts in the retail industry", ("salesforce",)),
+    ("show the leads created this week", ("salesforce",)),
+    ("what tasks, events and calls are on the opportunity", ("salesforce",)),
+    ("which campaigns generated the most leads", ("salesforce",)),
+    ("show the cases opened by the account", ("salesforce",)),
+    ("show the invoices of Acme", ("sql",)),
+    ("which invoices are unpaid", ("sql",)),
+    ("what was invoiced last quarter", ("sql",)),
+    ("total invoice amount per country", ("sql",)),
+    ("which invoices are overdue and by how many days", ("sql",)),
+    ("what did Acme pay on its last invoice", ("sql",)),
+    ("which companies have past purchases and new opportunities", ("hubspot", "salesforce", "sql")),
+    ("list the companies that bought from us", ("hubspot", "salesforce", "sql")),
+]
+
+# Posterior probability above which, or below one minus which, the classifier
+# is trusted to include or exclude a source.
+CLASSIFIER_CONFIDENCE = float(os.getenv("ROUTING_CLASSIFIER_CONFIDENCE", 0.8))
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Cosine similarity to the closest example above which its sources are used.
+EMBEDDING_MIN_SIMILARITY = float(os.getenv("ROUTING_EMBEDDING_MIN_SIMILARITY", 0.9))
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "true").lower() == "true"
+
+embedding_cache = create_llm_cache(os.getenv("EMBEDDING_CACHE_URL") or "memory://?maxsize=2048&ttl=86400")
+
+Route = namedtuple("Route", ["sources", "method", "confidence"])
+
+
+# Words that say nothing about the source a question needs.
+STOPWORDS = {
+    "a", "all", "and", "are", "by", "do", "for", "from", "give", "how", "in", "is", "it", "its", "list", "me",
+    "my", "of", "on", "our", "show", "tell", "the", "their", "this", "to", "us", "we", "what", "which", "who",
+    "with",
+}
+
+
+def words(text):
+    """Splits a question into lowercase words without plural s and stopwords."""
+    return [
+        word[:-1] if len(word) > 3 and word.endswith("s") else word
+        for word in re.findall(r"[a-z0-9]+", text.lower())
+        if word not in STOPWORDS
+    ]
+
+
+class KeywordClassifier:
+    """One-vs-rest naive Bayes over the words of a question, estimating for
+    every source the probability that the question needs it."""
+
+    def __init__(self, examples):
+        self.priors = {}
+        self.likelihoods = {}
+        vocabulary = {word for question, _ in examples for word in words(question)}
+        for source in SOURCES:
+            counts = {True: Counter(), False: Counter()}
+            labels = Counter()
+            for question, sources in examples:
+                label = source in sources
+                labels[label] += 1
+                counts[label].update(words(question))
+            self.priors[source] = {label: math.log(labels[label] / len(examples)) for label in (True, False)}
+            self.likelihoods[source] = {
+                label: {
+                    word: math.log((counts[label][word] + 1) / (sum(counts[label].values()) + len(vocabulary)))
+                    for word in vocabulary
+                }
+                for label in (True, False)
+            }
+
+    def probabilities(self, question):
+        question_words = [word for word in words(question) if word in self.likelihoods[SOURCES[0]][True]]
+        probabilities = {}
+        for source in SOURCES:
+            scores = {
+                label: self.priors[source][label]
+                + sum(self.likelihoods[source][label][word] for word in question_words)
+                for label in (True, False)
+            }
+            probabilities[source] = 1 / (1 + math.exp(scores[False] - scores[True]))
+        return probabilities, len(question_words)
+
+
+classifier = KeywordClassifier(ROUTING_EXAMPLES)
+
+
+def embed(texts):
+    """Returns the embeddings of `texts`, asking the API only for the ones
+    that aren't cached yet."""
+    keys = [hashlib.sha256(f"{EMBEDDING_MODEL}:{text}".encode()).hexdigest() for text in texts]
+    vectors = [embedding_cache.get(key) if embedding_cache is not None else None for key in keys]
+    missing = [index for index, vector in enumerate(vectors) if vector is None]
+    if missing:
+        response = openai.Embedding.create(model=EMBEDDING_MODEL, input=[texts[index] for index in missing])
+        for index, item in zip(missing, response["data"]):
+            vectors[index] = item["embedding"]
+            if embedding_cache is not None:
+                embedding_cache.set(keys[index], item["embedding"])
+    vectors = np.array(vectors)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+_example_embeddings = Lazy("Routing examples", lambda: embed([question for question, _ in ROUTING_EXAMPLES]))
+
+_stats_lock = threading.Lock()
+_stats = Counter()
+
+
+def _entity_sources(question):
+    """Returns the sources holding the records the question names."""
+    implied = {source for pattern, sources in ENTITY_SOURCES if pattern.search(question) for source in sources}
+    return tuple(source for source in SOURCES if source in implied)
+
+
+def _route(question):
+    mentioned = tuple(source for source in SOURCES if SOURCE_MENTIONS[source].search(question))
+    if mentioned:
+        return Route(mentioned, "mention", 1.0)
+    if CROSS_SOURCE.search(question):
+        return Route(SOURCES, "cross_source", 1.0)
+
+    entities = _entity_sources(question)
+    probabilities, known_words = classifier.probabilities(question)
+    if known_words and all(
+        probability >= CLASSIFIER_CONFIDENCE or probability <= 1 - CLASSIFIER_CONFIDENCE
+        for probability in probabilities.values()
+    ):
+        selected = tuple(
+            source for source in SOURCES if probabilities[source] >= CLASSIFIER_CONFIDENCE or source in entities
+        )
+        if selected:
+            confidence = min(max(probability, 1 - probability) for probability in probabilities.values())
+            return Route(selected, "classifier", confidence)
+
+    try:
+        similarities = _example_embeddings.get() @ embed([question])[0]
+    except (ResourceUnavailable, openai.error.OpenAIError) as err:
+        logger.warning(f"Could not embed the question for routing: {err}")
+        return Route(SOURCES, "fallback", 0.0)
+    best = int(np.argmax(similarities))
+    if similarities[best] >= EMBEDDING_MIN_SIMILARITY:
+        selected = tuple(source for source in SOURCES if source in ROUTING_EXAMPLES[best][1] or source in entities)
+        return Route(selected, "embedding", float(similarities[best]))
+    return Route(SOURCES, "fallback", float(similarities[best]))
+
+
+def route_question(question):
+    """Returns the sources needed to answer `question`, all of them when it's
+    unclear."""
+    route = _route(question) if ROUTING_ENABLED else Route(SOURCES, "disabled", 0.0)
+    skipped = len(SOURCES) - len(route.sources)
+    with _stats_lock:
+        _stats["decisions"] += 1
+        _stats[f"by_{route.method}"] += 1
+        _stats["skipped_agent_runs"] += skipped
+    logger.info(
+        f"Routed question to {', '.join(route.sources)} by {route.method} "
+        f"(confidence {route.confidence:.2f}), skipping {skipped} sub-agents: {question}"
+    )
+    return route
+
+
+def routing_stats():
+    with _stats_lock:
+        return dict(_stats)
@@ -1,9 +1,9 @@
 import os
-from salesforce_utils import execute_soql, execute_sosl
+from salesforce_utils import MAX_SOQL_ROWS, execute_soql, execute_sosl
 import openai
-from dotenv import load_dotenv
 from hubspot_agent import chat
-load_dotenv()
+from message_log import MessageLog
+from result_store import RESULT_FUNCTION_SCHEMAS, RESULT_FUNCTIONS
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
 
@@ -25,6 +25,7 @@ class SalesforceAgent:
         - Notify if the expected output cannot be generated.
         - When predicting forecast revenue, consider only open Opportunities, excluding those with a 'Closed Won' and 'Closed Lost' status.
         - If I ask about activities related to the deals/ opportunities - check tasks, events, calls.
+        - Prefer aggregating in SOQL (COUNT, SUM, GROUP BY) over retrieving all the records.
         
         Problem: {}
         """
@@ -33,6 +34,7 @@ class SalesforceAgent:
         self.available_functions = {
             "execute_sosl": execute_sosl,
             "execute_soql": execute_soql,
+            **RESULT_FUNCTIONS,
         }
         self.functions = [
             {
@@ -52,23 +54,33 @@ class SalesforceAgent:
 
             {
                 "name": "execute_soql",
-                "description": "Executes a SOQL query with the given query string.",
+                "description": "Executes a SOQL query with the given query string. Returns at most max_rows "
+                "records; very large results are extracted to a stored result handle.",
                 "parameters": {
                     "type": "object",
                     "properties": {
                         "query": {
                             "type": "string",
                             "description": "The SOQL query string to be executed."
+                        },
+                        "fields": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Fields to return, e.g. Name or Account.Name, all queried fields by default."
+                        },
+                        "max_rows": {
+                            "type": "integer",
+                            "description": f"Maximum number of records to return, at most {MAX_SOQL_ROWS}."
                         }
                     },
                     "required": ["query"]
                 },
-            }
-
+            },
+            *RESULT_FUNCTION_SCHEMAS,
         ]
-        self.messages = [{"role": "system", "content": self.SYSTEM_PROMPT}]
+        self.messages = MessageLog([{"role": "system", "content": self.SYSTEM_PROMPT}])
 
-    def chat(self, query):
+    def chat(self, query, context=None):
         prompt = self.PROMPT_TEMPLATE.format(query)
         response, _ = chat(
             prompt,
@@ -76,13 +88,17 @@ class SalesforceAgent:
             self.available_functions,
             self.functions,
             agent_name="salesforce_agent",
+            context=context,
+            data_sources=["salesforce"],
         )
         return response
 
 
-def ask_salesforce_agent(query):
+def ask_salesforce_agent(query, context=None):
     print("asking Salesforce Agent")
-    return SalesforceAgent().chat(query)
+    if context is None:
+        return SalesforceAgent().chat(query)
+    return context.ask("salesforce_agent", SalesforceAgent, query)
 
 
 # if __name__ == "__main__":
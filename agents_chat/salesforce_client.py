@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from simple_salesforce import Salesforce
+from simple_salesforce.exceptions import SalesforceExpiredSession
+
+logger = logging.getLogger(__name__)
+
+
+class SalesforcePool:
+    """Pool of logged in Salesforce clients shared by concurrent requests.
+
+    Every client keeps its own keep-alive HTTP session and is used by one
+    thread at a time; at most `size` clients exist, which also bounds the
+    number of concurrent Salesforce calls. Clients are logged in on first
+    use and again when their session expires.
+    """
+
+    def __init__(self, login, size=4, acquire_timeout=120):
+        # login(session) returns a Salesforce client using `session`.
+        self.login = login
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.relogins = 0
+        self.wait_seconds = 0.0
+        self.api_usage = None
+
+    def _new_client(self):
+        client = self.login(requests.Session())
+        with self._lock:
+            self.created += 1
+        return client
+
+    def warm_up(self):
+        """Logs the first client in, so that wrong credentials surface early."""
+        with self.client():
+            pass
+        return self
+
+    def _checkout(self):
+        started_at = time.monotonic()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"No Salesforce client became free within {self.acquire_timeout}s")
+        with self._lock:
+            self.acquired += 1
+            self.in_use += 1
+            self.wait_seconds += time.monotonic() - started_at
+            client = self._idle.pop() if self._idle else None
+        if client is not None:
+            return client
+        try:
+            return self._new_client()
+        except BaseException:
+            self._release()
+            raise
+
+    def _checkin(self, client):
+        with self._lock:
+            if client.api_usage.get("api-usage"):
+                self.api_usage = client.api_usage["api-usage"]
+            self._idle.append(client)
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    @contextmanager
+    def client(self):
+        """Checks a client out of the pool, waiting for a free one if all
+        `size` clients are in use."""
+        client = self._checkout()
+        try:
+            yield client
+        finally:
+            self._checkin(client)
+
+    def call(self, operation):
+        """Returns `operation(client)`, logging the client in again and
+        retrying once if its session has expired."""
+        client = self._checkout()
+        try:
+            try:
+                return operation(client)
+            except SalesforceExpiredSession:
+                logger.info("Salesforce session expired, logging in again")
+                client = self.login(client.session)
+                with self._lock:
+                    self.relogins += 1
+                return operation(client)
+        finally:
+            self._checkin(client)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "acquired": self.acquired,
+                "relogins": self.relogins,
+                "avg_wait_seconds": self.wait_seconds / self.acquired if self.acquired else 0.0,
+                "api_usage": self.api_usage._asdict() if self.api_usage else None,
+            }
+
+
+def create_pool(username, password, security_token, **pool_kwargs):
+    return SalesforcePool(
+        lambda session: Salesforce(
+            username=username, password=password, security_token=security_token, session=session
+        ),
+        **pool_kwargs,
+    )
@@ -1,16 +1,52 @@
+import csv
+import io
+import logging
 import os
+import re
 
-from dotenv import load_dotenv
-from simple_salesforce import Salesforce
-load_dotenv()
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from resources import Lazy, ResourceUnavailable
+from salesforce_client import create_pool
+from result_store import new_result_file, store_file
+from tracing import current_span, traced
+
+logger = logging.getLogger(__name__)
 
 username = os.getenv('SALESFORCE_USERNAME')
 password = os.getenv('SALESFORCE_PASSWORD')
 security_token = os.getenv('SALESFORCE_SECURITY_TOKEN')
 
-sf = Salesforce(username=username, password=password, security_token=security_token)
+# Clients logged in concurrently, which bounds the concurrent Salesforce calls.
+SALESFORCE_POOL_SIZE = int(os.getenv("SALESFORCE_POOL_SIZE", 4))
+_sf_pool = Lazy(
+    "Salesforce",
+    lambda: create_pool(username, password, security_token, size=SALESFORCE_POOL_SIZE).warm_up(),
+)
+
+# Records of a SOQL query returned to the agent. Queries matching more than
+# BULK_THRESHOLD records are extracted with the Bulk API 2.0 instead.
+MAX_SOQL_ROWS = int(os.getenv("MAX_SOQL_ROWS", 2000))
+BULK_THRESHOLD = int(os.getenv("SALESFORCE_BULK_THRESHOLD", 10_000))
+BULK_BATCH_SIZE = 50_000
+# The Bulk API doesn't support aggregate functions and subqueries.
+BULK_UNSUPPORTED = re.compile(
+    r"\bgroup\s+by\b|\b(count|count_distinct|sum|avg|min|max)\s*\(|\(\s*select\b", re.IGNORECASE
+)
+
+
+def get_sf_pool():
+    """Returns the pool of Salesforce clients, logging the first one in on first use."""
+    return _sf_pool.get()
 
 
+def salesforce_stats():
+    return get_sf_pool().stats()
+
+
+@traced("salesforce.execute_sosl")
 def execute_sosl(search: str):
     """Returns the result of a Salesforce search as a dict decoded from
     the Salesforce response JSON payload.
@@ -20,26 +56,114 @@ def execute_sosl(search: str):
     """
     from simple_salesforce import SalesforceError
     try:
-        res = sf.search(search)
+        res = get_sf_pool().call(lambda sf: sf.search(search))
     except SalesforceError as err:
         return f"Error running SOSL query: {err}"
+    except ResourceUnavailable as err:
+        return str(err)
     return dict(res)
 
 
-def execute_soql(query: str):
-    """Returns the full set of results for the `query`. This is a
-    convenience wrapper around `query(...)` and `query_more(...)`.
-    The returned dict is the decoded JSON payload from the final call to
-    Salesforce, but with the `totalSize` field representing the full
-    number of results retrieved and the `records` list representing the
-    full list of records retrieved.
+def _flatten_record(record, prefix=""):
+    row = {}
+    for key, value in record.items():
+        if key == "attributes":
+            continue
+        if isinstance(value, dict) and "records" in value:
+            # Child relationship subquery.
+            row[f"{prefix}{key}"] = [_flatten_record(child) for child in value["records"]]
+        elif isinstance(value, dict):
+            row.update(_flatten_record(value, f"{prefix}{key}."))
+        else:
+            row[f"{prefix}{key}"] = value
+    return row
+
+
+def _project(row, fields):
+    if not fields:
+        return row
+    return {field: row.get(field) for field in fields}
+
+
+@traced("salesforce.execute_soql")
+def execute_soql(query: str, fields=None, max_rows=MAX_SOQL_ROWS):
+    """Returns at most `max_rows` records of the `query`, fetched page by page
+    like `query_all_iter` does, so only one page is held besides the kept
+    records. Records are flattened to `Relationship.Field` keys without the
+    `attributes` metadata, and projected on `fields` if given. Queries matching
+    more than BULK_THRESHOLD records are extracted with the Bulk API 2.0 into
+    a Parquet file instead, which is returned as a stored result handle.
     Arguments:
     * query -- the SOQL query to send to Salesforce, e.g.
                SELECT Id FROM Lead WHERE Email = "waldo@somewhere.com"
+    * fields -- the fields to return, all queried fields by default
+    * max_rows -- the maximum number of records to return
     """
     from simple_salesforce import SalesforceError
+    from simple_salesforce.exceptions import SalesforceOperationError
+    max_rows = max(1, min(int(max_rows), MAX_SOQL_ROWS))
+
+    def run(sf):
+        result = sf.query(query)
+        total_size = result["totalSize"]
+        if total_size > BULK_THRESHOLD and not BULK_UNSUPPORTED.search(query):
+            return extract_soql(sf, query)
+        records = []
+        while True:
+            for record in result["records"][:max_rows - len(records)]:
+                records.append(_project(_flatten_record(record), fields))
+            if result["done"] or len(records) >= max_rows:
+                break
+            result = sf.query_more(result["nextRecordsUrl"], identifier_is_url=True)
+        current_span().set(records=len(records))
+        response = {"totalSize": total_size, "returned": len(records), "records": records}
+        if len(records) < total_size and records:
+            response["note"] = (
+                f"Only the first {len(records)} records are returned. Aggregate in SOQL "
+                "(COUNT, SUM, GROUP BY) or narrow the query down to see the rest."
+            )
+        return response
+
     try:
-        res = sf.query_all(query)
-    except SalesforceError as err:
+        return get_sf_pool().call(run)
+    except (SalesforceError, SalesforceOperationError) as err:
         return f"Error running SOQL query: {err}"
-    return res
+    except ResourceUnavailable as err:
+        return str(err)
+
+
+def _csv_table(batch):
+    """Parses a CSV batch of a Bulk API query, keeping every column a string."""
+    header = next(csv.reader(io.StringIO(batch)))
+    return pa_csv.read_csv(
+        io.BytesIO(batch.encode()),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in header},
+            strings_can_be_null=True,
+        ),
+    )
+
+
+@traced("salesforce.extract_soql")
+def extract_soql(sf, query):
+    """Extracts all records of `query` with the Bulk API 2.0, writing them to
+    a Parquet file batch by batch, and returns the stored result's preview."""
+    object_name = re.search(r"\bfrom\s+(\w+)", query, re.IGNORECASE).group(1)
+    logger.info(f"Extracting {object_name} records with the Bulk API: {query}")
+    path = new_result_file("execute_soql")
+    writer = None
+    row_count = 0
+    try:
+        for batch in getattr(sf.bulk2, object_name).query(query, max_records=BULK_BATCH_SIZE):
+            table = _csv_table(batch)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            row_count += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    current_span().set(records=row_count)
+    if writer is None:
+        return {"totalSize": 0, "returned": 0, "records": []}
+    return store_file("execute_soql", path, row_count)
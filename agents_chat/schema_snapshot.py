@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+
+from langchain import SQLDatabase
+from sqlalchemy import inspect, text
+
+logger = logging.getLogger(__name__)
+
+CATALOG_QUERY = (
+    "SELECT table_name, column_name, data_type FROM information_schema.columns "
+    "WHERE table_schema = current_schema() ORDER BY table_name, ordinal_position"
+)
+SAMPLE_ROWS = 3
+# Tables sent to the LLM for a question, and the columns of wide tables.
+MAX_RELEVANT_TABLES = int(os.getenv("MAX_RELEVANT_TABLES", 5))
+MAX_TABLE_COLUMNS = int(os.getenv("MAX_TABLE_COLUMNS", 25))
+# Leading columns of a wide table that are always kept, usually its keys and names.
+KEY_COLUMNS = 4
+
+
+def keywords(name):
+    """Splits names and questions into lowercase words without plural s."""
+    words = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", name)
+    return {word[:-1] if len(word) > 3 and word.endswith("s") else word for word in map(str.lower, words)}
+
+
+def read_catalog(engine):
+    if engine.dialect.name == "sqlite":
+        # SQLite has no information_schema.
+        inspector = inspect(engine)
+        return [
+            [table, column["name"], str(column["type"]).lower()]
+            for table in sorted(inspector.get_table_names())
+            for column in inspector.get_columns(table)
+        ]
+    with engine.connect() as connection:
+        return [list(row) for row in connection.execute(text(CATALOG_QUERY))]
+
+
+def catalog_hash(catalog):
+    return hashlib.sha256(json.dumps(catalog).encode()).hexdigest()
+
+
+def build_snapshot(engine, catalog):
+    tables = {}
+    for table, column, data_type in catalog:
+        tables.setdefault(table, {"columns": [], "samples": []})["columns"].append([column, data_type])
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.connect() as connection:
+        for table, snapshot in tables.items():
+            try:
+                rows = connection.execute(text(f"SELECT * FROM {quote(table)} LIMIT {SAMPLE_ROWS}"))
+                snapshot["samples"] = [[str(value)[:100] for value in row] for row in rows]
+            except Exception as err:
+                connection.rollback()
+                logger.warning(f"Could not sample rows of {table}: {err}")
+    return {"catalog_hash": catalog_hash(catalog), "built_at": time.time(), "tables": tables}
+
+
+def load_snapshot(path, engine):
+    """Returns the snapshot stored at `path`, rebuilding it if the catalog of
+    the database changed since it was taken."""
+    catalog = read_catalog(engine)
+    current_hash = catalog_hash(catalog)
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+        if snapshot["catalog_hash"] == current_hash:
+            return snapshot
+        logger.info(f"Schema snapshot {path} is outdated, rebuilding it")
+    except FileNotFoundError:
+        logger.info(f"Building schema snapshot {path}")
+    snapshot = build_snapshot(engine, catalog)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+    return snapshot
+
+
+def build_index(snapshot):
+    """Maps the keywords of table and column names to (table, column) pairs,
+    with column None for the keywords of a table name."""
+    index = defaultdict(set)
+    for table, table_snapshot in snapshot["tables"].items():
+        for word in keywords(table):
+            index[word].add((table, None))
+        for column, _ in table_snapshot["columns"]:
+            for word in keywords(column):
+                index[word].add((table, column))
+    return index
+
+
+class SnapshotSQLDatabase(SQLDatabase):
+    """SQLDatabase describing its tables from a persisted schema snapshot
+    instead of reflecting and sampling every table on startup."""
+
+    def __init__(self, engine, snapshot_path, max_string_length=300):
+        # SQLDatabase.__init__ is skipped on purpose, it reflects the schema.
+        self._engine = engine
+        self._schema = None
+        self._max_string_length = max_string_length
+        self._sample_rows_in_table_info = SAMPLE_ROWS
+        self.snapshot_path = snapshot_path
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the snapshot, rebuilding it if the schema changed, and
+        returns the catalog hash it is versioned by."""
+        snapshot = load_snapshot(self.snapshot_path, self._engine)
+        self._snapshot, self._index = snapshot, build_index(snapshot)
+        return snapshot["catalog_hash"]
+
+    @property
+    def engine(self):
+        return self._engine
+
+    def get_usable_table_names(self):
+        return sorted(self._snapshot["tables"])
+
+    def relevant_table_names(self, question):
+        """Returns the tables whose names and columns share the most words with
+        `question`, as `table_names_to_use` for the SQL chain. Wide tables are
+        narrowed down to their key columns and the matching ones, given as
+        `table.column`. Returns None, meaning all tables, if nothing matches."""
+        scores = defaultdict(int)
+        matched_columns = defaultdict(set)
+        for word in keywords(question):
+            for table, column in self._index.get(word, ()):
+                scores[table] += 1 if column else 2
+                if column:
+                    matched_columns[table].add(column)
+        if not scores:
+            return None
+        table_names = []
+        for table in sorted(scores, key=scores.get, reverse=True)[:MAX_RELEVANT_TABLES]:
+            columns = [column for column, _ in self._snapshot["tables"][table]["columns"]]
+            if len(columns) <= MAX_TABLE_COLUMNS:
+                table_names.append(table)
+                continue
+            table_names.extend(
+                f"{table}.{column}"
+                for position, column in enumerate(columns)
+                if position < KEY_COLUMNS or column in matched_columns[table]
+            )
+        return table_names
+
+    def get_table_info(self, table_names=None):
+        """Describes the given tables like SQLDatabase does. Entries of the
+        form `table.column` restrict a table to the listed columns."""
+        selected = defaultdict(set)
+        for name in table_names or self.get_usable_table_names():
+            table, _, column = name.partition(".")
+            if table not in self._snapshot["tables"]:
+                raise ValueError(f"table_names {{'{table}'}} not found in database")
+            if column:
+                selected[table].add(column)
+            else:
+                selected.setdefault(table, set())
+        return "\n\n".join(
+            self._describe_table(table, columns) for table, columns in sorted(selected.items())
+        )
+
+    def _describe_table(self, table, columns):
+        snapshot = self._snapshot["tables"][table]
+        positions = [
+            position
+            for position, (column, _) in enumerate(snapshot["columns"])
+            if not columns or column in columns
+        ]
+        column_lines = ", \n".join(
+            f"\t{snapshot['columns'][position][0]} {snapshot['columns'][position][1].upper()}"
+            for position in positions
+        )
+        names = "\t".join(snapshot["columns"][position][0] for position in positions)
+        samples = "\n".join(
+            "\t".join(row[position] for position in positions) for row in snapshot["samples"]
+        )
+        return (
+            f"CREATE TABLE {table} (\n{column_lines}\n)\n\n/*\n"
+            f"{len(snapshot['samples'])} rows from {table} table:\n{names}\n{samples}\n*/"
+        )
@@ -0,0 +1,232 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(ABC):
+    """Storage of per-session chat state (a JSON-serializable dict).
+
+    `lock(session_id)` serializes the requests of one session: a request
+    loads the state, updates it and saves it back while holding the lock.
+    """
+
+    @abstractmethod
+    def load(self, session_id):
+        """Returns the state of the session, or None if it's unknown or expired."""
+
+    @abstractmethod
+    def save(self, session_id, state):
+        """Stores the state of the session."""
+
+    @abstractmethod
+    def delete(self, session_id):
+        """Forgets the session."""
+
+    @abstractmethod
+    def lock(self, session_id):
+        """Returns a context manager holding the session for one request."""
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local store keeping at most `max_sessions` sessions, evicting
+    the least recently used ones and those idle for longer than `ttl`.
+
+    Session locks are kept apart from the sessions, only while requests hold
+    or wait for them, so evicting a session never drops a lock in use.
+    """
+
+    def __init__(self, max_sessions=1000, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        idle_since = time.monotonic() - self.ttl
+        while self._sessions:
+            session_id, (accessed_at, _) = next(iter(self._sessions.items()))
+            if accessed_at >= idle_since and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def load(self, session_id):
+        with self._lock:
+            self._expire()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            self._sessions[session_id] = (time.monotonic(), entry[1])
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def save(self, session_id, state):
+        with self._lock:
+            self._sessions[session_id] = (time.monotonic(), state)
+            self._sessions.move_to_end(session_id)
+            self._expire()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    @contextmanager
+    def lock(self, session_id):
+        with self._lock:
+            # [lock, number of requests holding or waiting for it]
+            entry = self._locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[session_id]
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store in a SQLite file shared by all worker processes of a host.
+
+    Session locks are leases in the same database, renewed while the request
+    holding them runs, so a crashed worker can only hold a session for
+    `lock_lease` seconds.
+    """
+
+    def __init__(self, path, max_sessions=10_000, ttl=3600, lock_lease=300, lock_timeout=120):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.lock_lease = lock_lease
+        self.lock_timeout = lock_timeout
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_accessed_at ON sessions (accessed_at);
+                CREATE TABLE IF NOT EXISTS session_locks (
+                    session_id TEXT PRIMARY KEY,
+                    token TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self, session_id):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state FROM sessions WHERE session_id = ? AND accessed_at >= ?",
+                (session_id, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE sessions SET accessed_at = ? WHERE session_id = ?", (now, session_id))
+        return json.loads(row[0])
+
+    def save(self, session_id, state):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                (session_id, json.dumps(state), now),
+            )
+            conn.execute("DELETE FROM sessions WHERE accessed_at < ?", (now - self.ttl,))
+            conn.execute(
+                """
+                DELETE FROM sessions WHERE session_id NOT IN (
+                    SELECT session_id FROM sessions ORDER BY accessed_at DESC LIMIT ?
+                )
+                """,
+                (self.max_sessions,),
+            )
+
+    def delete(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    @contextmanager
+    def lock(self, session_id):
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.lock_timeout
+        while True:
+            now = time.time()
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM session_locks WHERE session_id = ? AND expires_at < ?",
+                    (session_id, now),
+                )
+                acquired = conn.execute(
+                    "INSERT OR IGNORE INTO session_locks VALUES (?, ?, ?)",
+                    (session_id, token, now + self.lock_lease),
+                ).rowcount
+            if acquired:
+                break
+            if now > deadline:
+                raise TimeoutError(f"Could not lock session {session_id}")
+            time.sleep(0.1)
+        released = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(session_id, token, released), daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            released.set()
+            renewer.join()
+            with self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM session_locks WHERE session_id = ? AND token = ?",
+                    (session_id, token),
+                )
+
+    def _renew(self, session_id, token, released):
+        """Extends the lease of a held lock until `released` is set."""
+        while not released.wait(self.lock_lease / 3):
+            try:
+                with self._connect() as conn:
+                    renewed = conn.execute(
+                        "UPDATE session_locks SET expires_at = ? WHERE session_id = ? AND token = ?",
+                        (time.time() + self.lock_lease, session_id, token),
+                    ).rowcount
+            except sqlite3.Error as err:
+                logger.warning(f"Could not renew the lock of session {session_id}: {err}")
+                continue
+            if not renewed:
+                logger.warning(f"Lost the lock of session {session_id}, its lease expired")
+                return
+
+
+def create_session_store(url):
+    """Creates a store from a URL such as `memory://?max_sessions=1000&ttl=3600`
+    or `sqlite:///var/lib/chatbot/sessions.sqlite3?ttl=3600`."""
+    parsed = urlparse(url)
+    options = {key: int(values[-1]) for key, values in parse_qs(parsed.query).items()}
+    if parsed.scheme == "memory":
+        return MemorySessionStore(**options)
+    if parsed.scheme == "sqlite":
+        return SQLiteSessionStore(parsed.path, **options)
+    raise ValueError(f"Unsupported session store: {url}")
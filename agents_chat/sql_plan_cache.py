@@ -0,0 +1,175 @@
+import re
+import threading
+from collections import OrderedDict
+
+# String literals and standalone numbers of a generated query.
+SQL_LITERAL = re.compile(r"'((?:[^']|'')*)'|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])")
+READ_ONLY_SQL = re.compile(r"^\s*(select|with)\b[^;]*;?\s*$", re.IGNORECASE | re.DOTALL)
+SLOT_PATTERNS = {"string": r".+?", "number": r"\d+(?:\.\d+)?"}
+# Templates need this many words besides their slots, so that a short
+# question made mostly of entity names can't match unrelated questions.
+MIN_TEMPLATE_WORDS = 3
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().rstrip("?.!").strip()
+
+
+def _find_once(text, value):
+    matches = list(re.finditer(rf"(?<!\w){re.escape(value)}(?!\w)", text, re.IGNORECASE))
+    return matches[0] if len(matches) == 1 else None
+
+
+def _case(value):
+    if value.islower():
+        return "lower"
+    if value.isupper():
+        return "upper"
+    return None
+
+
+def make_plan(question, sql):
+    """Turns a question and the SQL generated for it into a plan: a pattern
+    matching questions that differ only in their entities (the literals of the
+    SQL that are also found in the question) and the SQL with those literals
+    as slots. Returns None for SQL that isn't a single read-only query."""
+    if not READ_ONLY_SQL.match(sql):
+        return None
+    question = normalize_question(question)
+    spans = []
+    slots = []
+    segments = []
+    position = 0
+    for literal in SQL_LITERAL.finditer(sql):
+        if literal.group(1) is not None:
+            kind = "string"
+            value = literal.group(1).replace("''", "'")
+            core = value.strip("%")
+        else:
+            kind = "number"
+            value = core = literal.group(2)
+        match = _find_once(question, core) if len(core) >= 2 else None
+        if match is None:
+            continue
+        span = match.span()
+        if span in spans:
+            slot = spans.index(span)
+        elif any(start < span[1] and span[0] < end for start, end in spans):
+            continue
+        else:
+            slot = len(spans)
+            spans.append(span)
+            slots.append(kind)
+        segments.append(sql[position:literal.start()])
+        segments.append(
+            {
+                "slot": slot,
+                "kind": kind,
+                "prefix": value[: value.index(core)],
+                "suffix": value[value.index(core) + len(core):],
+                "case": _case(core),
+            }
+        )
+        position = literal.end()
+    segments.append(sql[position:])
+
+    pattern = []
+    template = []
+    position = 0
+    for slot, (start, end) in sorted(enumerate(spans), key=lambda item: item[1]):
+        pattern.append(re.escape(question[position:start]))
+        pattern.append(f"(?P<slot{slot}>{SLOT_PATTERNS[slots[slot]]})")
+        template.append(question[position:start])
+        position = end
+    pattern.append(re.escape(question[position:]))
+    template.append(question[position:])
+    if spans and len(re.findall(r"\w+", " ".join(template))) < MIN_TEMPLATE_WORDS:
+        return None
+    return {
+        "template": "{}".join(template).lower(),
+        "pattern": re.compile("".join(pattern), re.IGNORECASE),
+        "slots": len(spans),
+        "segments": segments,
+    }
+
+
+def render_plan(plan, match):
+    """Returns the SQL of `plan` with the entities of the matched question."""
+    sql = []
+    for segment in plan["segments"]:
+        if isinstance(segment, str):
+            sql.append(segment)
+            continue
+        value = match.group(f"slot{segment['slot']}")
+        if segment["case"] == "lower":
+            value = value.lower()
+        elif segment["case"] == "upper":
+            value = value.upper()
+        if segment["kind"] == "number":
+            sql.append(value)
+        else:
+            value = f"{segment['prefix']}{value}{segment['suffix']}"
+            sql.append("'" + value.replace("'", "''") + "'")
+    return "".join(sql)
+
+
+class SQLPlanCache:
+    """LRU cache of SQL that ran successfully for a question, for the schema
+    with the given fingerprint. Entries of other schemas are dropped as soon
+    as a different fingerprint is seen."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.fingerprint = None
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_schema(self, fingerprint):
+        if fingerprint != self.fingerprint:
+            self._plans.clear()
+            self.fingerprint = fingerprint
+
+    def lookup(self, question, fingerprint):
+        """Returns the SQL answering `question`, or None."""
+        question = normalize_question(question)
+        with self._lock:
+            self._check_schema(fingerprint)
+            for template, plan in reversed(self._plans.items()):
+                match = plan["pattern"].fullmatch(question)
+                if match is not None:
+                    self._plans.move_to_end(template)
+                    self.hits += 1
+                    return render_plan(plan, match)
+            self.misses += 1
+            return None
+
+    def store(self, question, sql, fingerprint):
+        plan = make_plan(question, sql)
+        if plan is None:
+            return
+        with self._lock:
+            self._check_schema(fingerprint)
+            self._plans[plan["template"]] = plan
+            self._plans.move_to_end(plan["template"])
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+
+    def discard(self, question):
+        question = normalize_question(question)
+        with self._lock:
+            for template, plan in list(self._plans.items()):
+                if plan["pattern"].fullmatch(question):
+                    del self._plans[template]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._plans),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,155 @@
+import functools
+import json
+import logging
+import os
+
+import tiktoken
+
+from cache_utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Tokenizer of the gpt-4 and gpt-3.5-turbo model families. tiktoken downloads
+# it on first use unless it's cached in TIKTOKEN_CACHE_DIR.
+ENCODING_NAME = "cl100k_base"
+# Characters per token of the estimate used when the tokenizer can't be loaded.
+CHARS_PER_TOKEN = 4
+# Message framing overhead as documented for the chat completion models.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_PRIMING_TOKENS = 3
+
+MODEL_CONTEXT_TOKENS = 128_000
+COMPLETION_TOKENS_RESERVE = 4_096
+PROMPT_TOKEN_BUDGET = min(
+    int(os.getenv("PROMPT_TOKEN_BUDGET", 32_000)),
+    MODEL_CONTEXT_TOKENS - COMPLETION_TOKENS_RESERVE,
+)
+TRUNCATION_NOTE = "... [truncated {} tokens to fit the context]"
+
+_token_counts = TTLCache(maxsize=4096, default_ttl=24 * 3600)
+
+
+class _CharEstimate:
+    """Stands in for the tokenizer with tokens of CHARS_PER_TOKEN characters."""
+
+    def encode(self, text, disallowed_special=()):
+        return [text[start:start + CHARS_PER_TOKEN] for start in range(0, len(text), CHARS_PER_TOKEN)]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    """Loads the tokenizer on the first count, falling back to an estimate of
+    the tokens by the length of the text, e.g. offline without a cache."""
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception as err:
+        logger.warning(f"Could not load the {ENCODING_NAME} tokenizer, estimating token counts: {err}")
+        return _CharEstimate()
+
+
+def count_text_tokens(text):
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def _message_key(message):
+    tool_calls = message.get("tool_calls")
+    return (
+        message.get("role"),
+        message.get("name"),
+        message.get("tool_call_id"),
+        message.get("content"),
+        json.dumps(tool_calls) if tool_calls else None,
+    )
+
+
+def _count_message(message):
+    tokens = TOKENS_PER_MESSAGE + count_text_tokens(message.get("content") or "")
+    if message.get("name"):
+        tokens += TOKENS_PER_NAME + count_text_tokens(message["name"])
+    if message.get("tool_calls"):
+        tokens += count_text_tokens(json.dumps(message["tool_calls"]))
+    return tokens
+
+
+def count_message_tokens(message):
+    key = _message_key(message)
+    return _token_counts.get_or_load(key, lambda: _count_message(message))
+
+
+def count_functions_tokens(functions):
+    """Approximates the tokens the function schemas add to the prompt by the
+    length of their JSON, which is an upper bound of the actual encoding."""
+    if not functions:
+        return 0
+    schemas = json.dumps(functions)
+    return _token_counts.get_or_load(("functions", schemas), lambda: count_text_tokens(schemas))
+
+
+def count_prompt_tokens(messages, functions=None):
+    return (
+        sum(count_message_tokens(message) for message in messages)
+        + count_functions_tokens(functions)
+        + REPLY_PRIMING_TOKENS
+    )
+
+
+def _turn_starts(messages):
+    return [index for index, message in enumerate(messages) if index > 0 and message["role"] == "user"]
+
+
+def drop_oldest_turns(messages, budget, functions=None):
+    """Drops whole turns (a user message and everything up to the next one)
+    after the system message, oldest first, until `messages` fit into
+    `budget`. The latest turn is always kept."""
+    tokens = count_prompt_tokens(messages, functions)
+    while tokens > budget:
+        turn_starts = _turn_starts(messages)
+        if len(turn_starts) < 2:
+            break
+        dropped = messages[turn_starts[0]:turn_starts[1]]
+        del messages[turn_starts[0]:turn_starts[1]]
+        tokens -= sum(count_message_tokens(message) for message in dropped)
+    return tokens
+
+
+def _truncate(message, max_tokens):
+    encoding = get_encoding()
+    tokens = encoding.encode(message["content"], disallowed_special=())
+    note = TRUNCATION_NOTE.format(len(tokens) - max_tokens)
+    keep = max(0, max_tokens - count_text_tokens(note))
+    return {**message, "content": encoding.decode(tokens[:keep]) + note}
+
+
+def fit_to_budget(messages, functions=None, budget=PROMPT_TOKEN_BUDGET):
+    """Trims `messages` in place so that the prompt fits into `budget` tokens.
+
+    Older turns are dropped first. If the latest turn alone is still too long,
+    its largest tool results are truncated. Returns the prompt token count.
+    """
+    tokens = drop_oldest_turns(messages, budget, functions)
+    if tokens <= budget:
+        return tokens
+    turn_start = (_turn_starts(messages) or [0])[-1]
+    tool_results = sorted(
+        (index for index in range(turn_start, len(messages)) if messages[index]["role"] == "tool"),
+        key=lambda index: count_message_tokens(messages[index]),
+        reverse=True,
+    )
+    for index in tool_results:
+        excess = tokens - budget
+        if excess <= 0:
+            break
+        message_tokens = count_message_tokens(messages[index])
+        content_tokens = count_text_tokens(messages[index]["content"])
+        truncated = _truncate(messages[index], max(0, content_tokens - excess))
+        messages[index] = truncated
+        tokens += count_message_tokens(truncated) - message_tokens
+    if tokens > budget:
+        logger.warning(f"Prompt has {tokens} tokens even after trimming, over the budget of {budget}")
+    else:
+        logger.info(f"Trimmed prompt to {tokens} tokens to fit the budget of {budget}")
+    return tokens
@@ -0,0 +1,181 @@
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Finished traces of whole user queries kept for the /traces route.
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", 50))
+# Exports the spans with OpenTelemetry too, configured by the standard
+# OTEL_* variables, e.g. OTEL_EXPORTER_OTLP_ENDPOINT=http://collector:4318.
+TRACING_OTEL = os.getenv("TRACING_OTEL", "false").lower() == "true"
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+def _otel_tracer():
+    if not TRACING_OTEL:
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logger.warning("TRACING_OTEL is set but opentelemetry is not installed, spans are only aggregated")
+        return None
+    try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        # Without the SDK spans go to whatever provider the process configured.
+        pass
+    else:
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+    return trace.get_tracer("agents_chat")
+
+
+_tracer = _otel_tracer()
+
+
+class Span:
+    """A timed step of answering a query, with numeric attributes such as
+    tokens or bytes that are summed per span name in the metrics."""
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.children = []
+        self.error = None
+        self.duration = None
+        self._started_at = time.perf_counter()
+        self._lock = threading.Lock()
+        self._otel = None
+        if _tracer is not None:
+            from opentelemetry import trace
+
+            context = trace.set_span_in_context(parent._otel) if parent is not None and parent._otel else None
+            self._otel = _tracer.start_span(name, context=context)
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def _finish(self, error):
+        self.duration = time.perf_counter() - self._started_at
+        self.error = error
+        if self.parent is not None:
+            with self.parent._lock:
+                self.parent.children.append(self)
+        if self._otel is not None:
+            for name, value in self.attributes.items():
+                if isinstance(value, (bool, int, float, str)):
+                    self._otel.set_attribute(name, value)
+            if error:
+                from opentelemetry.trace import Status, StatusCode
+
+                self._otel.set_status(Status(StatusCode.ERROR, error))
+            self._otel.end()
+
+    def to_dict(self):
+        span = {"name": self.name, "ms": round(self.duration * 1000, 1), **self.attributes}
+        if self.error:
+            span["error"] = self.error
+        if self.children:
+            span["children"] = [child.to_dict() for child in self.children]
+        return span
+
+
+class SpanMetrics:
+    """Counts, durations and summed numeric attributes per span name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = defaultdict(lambda: defaultdict(float))
+
+    def record(self, span):
+        with self._lock:
+            totals = self._spans[span.name]
+            totals["count"] += 1
+            totals["errors"] += span.error is not None
+            totals["seconds_total"] += span.duration
+            totals["seconds_max"] = max(totals["seconds_max"], span.duration)
+            for name, value in span.attributes.items():
+                # Booleans such as cache_hit count the spans they are true for.
+                if isinstance(value, (bool, int, float)):
+                    totals[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            spans = {name: dict(totals) for name, totals in self._spans.items()}
+        for totals in spans.values():
+            totals["seconds_avg"] = totals["seconds_total"] / totals["count"]
+        return {
+            name: {key: int(value) if value.is_integer() else round(value, 4) for key, value in totals.items()}
+            for name, totals in sorted(spans.items())
+        }
+
+
+span_metrics = SpanMetrics()
+_traces = deque(maxlen=TRACE_HISTORY)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the enclosed block as a child of the current span."""
+    current = Span(name, _current.get(), attributes)
+    token = _current.set(current)
+    error = None
+    try:
+        yield current
+    except BaseException as err:
+        error = f"{type(err).__name__}: {err}"
+        raise
+    finally:
+        _current.reset(token)
+        current._finish(error)
+        span_metrics.record(current)
+        if current.parent is None:
+            _traces.append(current)
+
+
+def traced(name):
+    """Runs the decorated function in a span called `name`."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def current_span():
+    return _current.get()
+
+
+def in_current_context(function):
+    """Binds `function` to the current span, for running it in a thread pool.
+    Every submitted call needs its own binding."""
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+def trace_metrics():
+    return span_metrics.snapshot()
+
+
+def recent_traces():
+    return [trace.to_dict() for trace in list(_traces)]
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the app import each other by their bare names.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "agents_chat"))
+
+import token_budget  # noqa: E402
+
+
+@pytest.fixture
+def char_tokens(monkeypatch):
+    """Counts tokens of CHARS_PER_TOKEN characters instead of loading the tokenizer."""
+    monkeypatch.setattr(token_budget, "get_encoding", token_budget._CharEstimate)
+    token_budget._token_counts.invalidate()
+    yield
+    token_budget._token_counts.invalidate()
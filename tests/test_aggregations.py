@@ -0,0 +1,86 @@
+import pytest
+
+import aggregations
+from aggregations import COLUMNS, SEPARATE_NOTE, _frame, _hubspot_customer, aggregate_deals
+
+
+def rows(*records):
+    return _frame({column: list(values) for column, values in zip(COLUMNS, zip(*records))})
+
+
+@pytest.fixture(autouse=True)
+def loaders(monkeypatch):
+    """Serves fixed deals, opportunities and invoices instead of querying the sources."""
+    loaders = {
+        "hubspot": lambda: rows(
+            ("hubspot", "1", "Rollout", "Globex", "won", 1000, "2024-01-15", "Jane"),
+            ("hubspot", "2", "Renewal", "Initech", "open", 500, "2024-04-02", "Jane"),
+        ),
+        "salesforce": lambda: rows(
+            ("salesforce", "a", "Upsell", "Globex", "won", 2000, "2024-02-10", "John"),
+            ("salesforce", "b", "Pilot", "Initrode", "lost", None, "2024-05-20", "John"),
+        ),
+        "sql": lambda: rows(
+            ("sql", "100", None, "Globex", "invoiced", 1000, "2024-01-31", None),
+        ),
+    }
+    monkeypatch.setattr(aggregations, "FRAME_LOADERS", loaders)
+    aggregations.frames.invalidate()
+    yield loaders
+    aggregations.frames.invalidate()
+
+
+def test_won_deals_and_invoices_are_reported_separately():
+    response = aggregate_deals(statuses=["won", "invoiced"])
+    assert response["note"] == SEPARATE_NOTE
+    assert response["deals"]["total"] == 3000
+    assert response["invoices"]["total"] == 1000
+
+
+def test_customers_are_counted_once_across_sources():
+    response = aggregate_deals(metric="count_customers", statuses=["won", "invoiced"])
+    assert "note" not in response
+    assert response["total"] == 1
+
+
+def test_groups_are_sorted_by_value():
+    response = aggregate_deals(metric="count", sources=["hubspot", "salesforce"], group_by=["owner", "quarter"])
+    assert response["group_count"] == 4
+    assert response["rows"][0]["count"] == 1
+    assert {(row["owner"], row["quarter"]) for row in response["rows"]} == {
+        ("Jane", "2024Q1"),
+        ("Jane", "2024Q2"),
+        ("John", "2024Q1"),
+        ("John", "2024Q2"),
+    }
+    assert response["rows_without_amount"] == 1
+
+
+def test_dates_filter_the_rows_inclusively():
+    response = aggregate_deals(sources=["hubspot", "salesforce"], date_from="2024-01-15", date_to="2024-04-02")
+    assert response["total"] == 3500
+    assert response["rows_considered"] == 3
+
+
+def test_invalid_arguments_are_explained():
+    assert aggregate_deals(metric="median").startswith("Unknown metric median")
+    assert aggregate_deals(group_by="region").startswith("Can't group by region")
+    assert aggregate_deals(date_from="2024-13-01") == "Invalid dates '2024-13-01', use YYYY-MM-DD."
+
+
+def test_unavailable_sources_are_reported(loaders):
+    def down():
+        raise ConnectionError("Salesforce is down")
+
+    loaders["salesforce"] = down
+    response = aggregate_deals(sources=["hubspot", "salesforce"])
+    assert response["total"] == 1500
+    assert response["unavailable_sources"] == {"salesforce": "Salesforce is down"}
+
+
+def test_hubspot_customer_falls_back_to_the_company_name():
+    customers = {("hubspot", "7"): "Globex"}
+    company_names = {"7": "Globex Corporation", "8": "Initech LLC"}
+    assert _hubspot_customer(["8", "7"], customers, company_names) == "Globex"
+    assert _hubspot_customer(["9", "8"], customers, company_names) == "Initech LLC"
+    assert _hubspot_customer([], customers, company_names) is None
@@ -0,0 +1,89 @@
+import threading
+import time
+
+from cache_utils import TTLCache
+
+
+def test_get_or_load_stores_the_loaded_value():
+    cache = TTLCache()
+    assert cache.get_or_load("deals", lambda: [1, 2]) == [1, 2]
+    assert cache.get_or_load("deals", lambda: []) == [1, 2]
+    assert cache.stats()["loads"] == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_entries_expire_after_their_ttl():
+    cache = TTLCache(default_ttl=0.01)
+    cache.set("deals", 1)
+    time.sleep(0.02)
+    assert cache.get("deals") is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_concurrent_misses_run_the_loader_once():
+    cache = TTLCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get_or_load("key", load)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.append(cache.get_or_load("key", load)))
+    second.start()
+    release.set()
+    first.join()
+    second.join()
+    assert results == ["value", "value"]
+    assert len(calls) == 1
+
+
+def test_failed_loads_are_not_cached():
+    cache = TTLCache()
+
+    def fail():
+        raise RuntimeError("down")
+
+    try:
+        cache.get_or_load("key", fail)
+    except RuntimeError:
+        pass
+    assert cache.get_or_load("key", lambda: "value") == "value"
+
+
+def test_value_loaded_across_an_invalidation_is_not_stored():
+    cache = TTLCache()
+
+    def load():
+        cache.invalidate()
+        return "stale"
+
+    assert cache.get_or_load("key", load) == "stale"
+    assert cache.get_or_load("key", lambda: "fresh") == "fresh"
+    assert cache.get_or_load("key", lambda: "newer") == "fresh"
+
+
+def test_invalidate_drops_only_the_matching_keys():
+    cache = TTLCache()
+    cache.set(("deals", 1), 1)
+    cache.set(("companies", 1), 2)
+    cache.invalidate(lambda key: key[0] == "deals")
+    assert cache.get(("deals", 1)) is None
+    assert cache.get(("companies", 1)) == 2
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from entity_resolution import CompanyIndex, normalize_domain, normalize_name, trigram_vectors
+
+
+@pytest.mark.parametrize(
+    "name, normalized",
+    [
+        ("Globex Corporation", "globex"),
+        ("The Müller & Söhne GmbH", "muller and sohne"),
+        ("ACME, Inc.", "acme"),
+        ("Inc", "inc"),
+        (None, ""),
+    ],
+)
+def test_normalize_name(name, normalized):
+    assert normalize_name(name) == normalized
+
+
+@pytest.mark.parametrize(
+    "value, domain",
+    [
+        ("https://www.globex.com/about", "globex.com"),
+        ("jane@Globex.com", "globex.com"),
+        ("globex.com:8080", "globex.com"),
+        ("localhost", ""),
+    ],
+)
+def test_normalize_domain(value, domain):
+    assert normalize_domain(value) == domain
+
+
+def test_trigram_vectors_have_unit_length():
+    vectors = trigram_vectors(["globex", "globex dynamics", "initech"])
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1)
+    assert 0.5 < vectors[0] @ vectors[1] < 1
+    assert vectors[0] @ vectors[2] == 0
+
+
+def companies(*records):
+    return lambda watermark: ([dict(zip(("key", "name", "domain"), record)) for record in records], None)
+
+
+def test_companies_are_matched_by_domain_and_by_name():
+    index = CompanyIndex(
+        ":memory:",
+        {
+            "hubspot": companies(("1", "Globex Corporation", "globex.com"), ("2", "Initech", None)),
+            "salesforce": companies(("a", "Globex Corp.", None), ("b", "Initrode", "https://initech.com")),
+            "sql": companies(("x", "Globex Inc", None)),
+        },
+    )
+    index.refresh()
+    entities = index.entities()
+    assert len(entities) == 3
+    globex = next(entity for entity in entities if entity["name"] == "Globex Corporation")
+    assert globex["domain"] == "globex.com"
+    assert globex["ids"] == {"hubspot": ["1"], "salesforce": ["a"], "sql": ["x"]}
+    assert [entity["name"] for entity in index.entities(sources=["hubspot", "salesforce", "sql"])] == [
+        "Globex Corporation"
+    ]
+
+
+def test_records_of_a_later_refresh_match_the_stored_ones():
+    # The new names share the vocabulary of the stored names of their block,
+    # or similar names would get vectors of unrelated trigrams.
+    loaded = {"salesforce": []}
+    index = CompanyIndex(
+        ":memory:",
+        {
+            "hubspot": companies(("1", "Globex Dynamics", None), ("2", "Globe Trotters", None)),
+            "salesforce": lambda watermark: (loaded["salesforce"], None),
+        },
+    )
+    index.refresh()
+    loaded["salesforce"] = [{"key": "a", "name": "Globex Dynamics Ltd", "domain": None}]
+    index.refresh()
+    ids = [entity["ids"] for entity in index.entities()]
+    assert {"hubspot": ["1"], "salesforce": ["a"]} in ids
+    assert {"hubspot": ["2"]} in ids
+
+
+def test_failing_sources_are_reported_and_skipped():
+    def down(watermark):
+        raise ConnectionError("Salesforce is down")
+
+    index = CompanyIndex(":memory:", {"hubspot": companies(("1", "Globex", None)), "salesforce": down})
+    index.refresh()
+    assert index.unavailable == {"salesforce": "Salesforce is down"}
+    assert len(index.entities()) == 1
+
+
+def test_only_the_searched_sources_are_refreshed_and_read():
+    def down(watermark):
+        raise AssertionError("Salesforce must not be queried")
+
+    index = CompanyIndex(
+        ":memory:",
+        {"hubspot": companies(("1", "Globex Corporation", None)), "salesforce": down},
+    )
+    index.refresh(sources=["hubspot"])
+    assert index.unavailable == {}
+    assert index.entities(searched_sources=["hubspot"]) == [
+        {"name": "Globex Corporation", "domain": None, "ids": {"hubspot": ["1"]}}
+    ]
+
+
+def test_searched_sources_leave_out_the_records_of_other_sources():
+    index = CompanyIndex(
+        ":memory:",
+        {
+            "hubspot": companies(("1", "Globex Corporation", "globex.com")),
+            "salesforce": companies(("a", "Globex Corp.", "globex.com"), ("b", "Initrode", None)),
+        },
+    )
+    index.refresh()
+    assert [entity["ids"] for entity in index.entities(searched_sources=["salesforce"])] == [
+        {"salesforce": ["a"]},
+        {"salesforce": ["b"]},
+    ]
+    assert index.entities(searched_sources=["hubspot"])[0]["name"] == "Globex Corporation"
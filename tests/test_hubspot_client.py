@@ -0,0 +1,140 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import hubspot_client
+from hubspot_client import PooledApiFactory, TokenBucket, create_client, hydrate_associations
+
+
+class ApiException(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.headers = headers
+
+
+def flaky(*failures):
+    """Returns a request raising `failures` in turn, then answering "ok"."""
+    calls = []
+
+    def request(method, url, *args, **kwargs):
+        calls.append(url)
+        if len(calls) <= len(failures):
+            raise failures[len(calls) - 1]
+        return "ok"
+
+    return request, calls
+
+
+@pytest.fixture
+def factory():
+    return PooledApiFactory(TokenBucket(rate=1000, capacity=1000), backoff=0.0, host="http://127.0.0.1:1")
+
+
+def test_apis_of_a_package_share_one_api_client(factory):
+    client = create_client("token", factory)
+    basic_api = client.crm.objects.basic_api
+    assert basic_api.api_client is client.crm.objects.search_api.api_client
+    assert basic_api.api_client is client.crm.objects.basic_api.api_client
+    assert basic_api.api_client.configuration.host == "http://127.0.0.1:1"
+
+
+def test_throttled_requests_are_retried(factory):
+    request, calls = flaky(ApiException(429), ApiException(503))
+    assert factory._throttled(request)("GET", "/crm/v3/objects/deals") == "ok"
+    assert len(calls) == 3
+    stats = factory.stats()
+    assert (stats["requests"], stats["throttled"], stats["retries"], stats["failures"]) == (3, 1, 2, 0)
+    assert stats["rate_limiter"]["acquired"] == 3
+
+
+def test_other_errors_are_not_retried(factory):
+    request, calls = flaky(ApiException(404))
+    with pytest.raises(ApiException):
+        factory._throttled(request)("GET", "/crm/v3/objects/deals/1")
+    assert len(calls) == 1
+    assert factory.stats()["failures"] == 1
+
+
+def test_retry_after_is_honoured(factory, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(hubspot_client, "time", SimpleNamespace(monotonic=time.monotonic, sleep=sleeps.append))
+    request, calls = flaky(ApiException(429, {"Retry-After": "2"}))
+    assert factory._throttled(request)("GET", "/crm/v3/objects/deals") == "ok"
+    assert sleeps == [2.0]
+
+
+def test_retries_give_up_after_max_retries(factory):
+    factory.max_retries = 2
+    request, calls = flaky(*[ApiException(429)] * 3)
+    with pytest.raises(ApiException):
+        factory._throttled(request)("GET", "/crm/v3/objects/deals")
+    assert len(calls) == 3
+    stats = factory.stats()
+    assert (stats["throttled"], stats["retries"], stats["failures"]) == (3, 2, 1)
+
+
+def test_searches_also_take_a_search_token():
+    factory = PooledApiFactory(TokenBucket(rate=1000, capacity=1000), TokenBucket(rate=1000, capacity=1000))
+    request, calls = flaky()
+    factory._throttled(request)("POST", "/crm/v3/objects/deals/search")
+    factory._throttled(request)("GET", "/crm/v3/objects/deals")
+    stats = factory.stats()
+    assert (stats["rate_limiter"]["acquired"], stats["search_rate_limiter"]["acquired"]) == (2, 1)
+
+
+def test_token_bucket_waits_for_a_token():
+    bucket = TokenBucket(rate=100, capacity=1)
+    bucket.acquire()
+    bucket.acquire()
+    stats = bucket.stats()
+    assert (stats["acquired"], stats["waits"]) == (2, 1)
+
+
+class AssociationsClient:
+    """Answers batch association requests from `associated`, two associations
+    per page."""
+
+    def __init__(self, associated):
+        self.associated = associated
+        self.requests = []
+        self.crm = SimpleNamespace(
+            associations=SimpleNamespace(v4=SimpleNamespace(batch_api=SimpleNamespace(get_page=self.get_page)))
+        )
+
+    def get_page(self, object_type, to_type, batch_input_public_fetch_associations_batch_request):
+        inputs = batch_input_public_fetch_associations_batch_request.inputs
+        self.requests.append((to_type, [item.id for item in inputs]))
+        results = []
+        for item in inputs:
+            start = int(item.after or 0)
+            to_ids = self.associated[to_type].get(item.id)
+            if not to_ids:
+                # HubSpot leaves out the records without associations.
+                continue
+            after = str(start + 2) if start + 2 < len(to_ids) else None
+            results.append(
+                SimpleNamespace(
+                    _from=SimpleNamespace(id=item.id),
+                    to=[SimpleNamespace(to_object_id=to_id) for to_id in to_ids[start:start + 2]],
+                    paging=SimpleNamespace(next=SimpleNamespace(after=after)) if after else None,
+                )
+            )
+        return SimpleNamespace(results=results)
+
+
+def test_associations_are_hydrated_with_batch_requests():
+    client = AssociationsClient(
+        {
+            "companies": {"1": ["7"]},
+            "contacts": {"1": ["20", "21", "22"], "2": ["23"]},
+        }
+    )
+    records = [SimpleNamespace(id="1"), SimpleNamespace(id="2")]
+    hydrate_associations(client, "deals", records, ["companies", "contacts"])
+
+    assert records[0].associations["companies"].results == [("7", "deal_to_company")]
+    assert [association.id for association in records[0].associations["contacts"].results] == ["20", "21", "22"]
+    assert "companies" not in records[1].associations
+    assert client.requests == [("companies", ["1", "2"]), ("contacts", ["1", "2"]), ("contacts", ["1"])]
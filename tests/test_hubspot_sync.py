@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+import pytest
+
+import hubspot_sync
+from hubspot_client import Association, AssociationList
+from hubspot_sync import HubspotMirror, MirrorRecord
+
+SPECS = {
+    "deals": {
+        "properties": ["dealname", "hs_lastmodifieddate"],
+        "associations": ["companies"],
+        "modified_property": "hs_lastmodifieddate",
+    }
+}
+
+
+def deal(modified_at, name="Big deal"):
+    return MirrorRecord(
+        "1",
+        {"dealname": name, "hs_lastmodifieddate": modified_at},
+        {"companies": AssociationList([Association("7", "deal_to_company")])},
+    )
+
+
+class FakeClient:
+    """Answers the searches and reads of the mirror from `self.deals`."""
+
+    def __init__(self, deals):
+        self.deals = deals
+        self.reads = []
+        self.crm = SimpleNamespace(
+            objects=SimpleNamespace(
+                search_api=SimpleNamespace(do_search=self.do_search),
+                basic_api=SimpleNamespace(get_by_id=self.get_by_id),
+            )
+        )
+
+    def do_search(self, object_type, public_object_search_request):
+        results = [SimpleNamespace(id=deal.id, properties=dict(deal.properties)) for deal in self.deals]
+        return SimpleNamespace(results=results, paging=None)
+
+    def get_by_id(self, object_type, object_id, properties, associations):
+        self.reads.append(object_id)
+        return next(deal for deal in self.deals if deal.id == object_id)
+
+
+@pytest.fixture
+def mirror(monkeypatch):
+    client = FakeClient([deal("2024-01-01T00:00:00Z")])
+    monkeypatch.setattr(hubspot_sync, "get_all_hydrated", lambda client, *args: list(client.deals))
+    changes = []
+    mirror = HubspotMirror(":memory:", client, SPECS, on_change=changes.append)
+    mirror.sync("deals")
+    return mirror, client, changes
+
+
+def test_full_sync_mirrors_records_and_associations(mirror):
+    mirror, client, changes = mirror
+    [record] = mirror.records("deals")
+    assert record.properties["dealname"] == "Big deal"
+    assert mirror.related_ids("companies", "7", "deals") == ["1"]
+    assert mirror.data_version() == {"deals": "2024-01-01T00:00:00Z"}
+    assert changes == ["deals"]
+
+
+def test_sync_reads_modified_records(mirror):
+    mirror, client, changes = mirror
+    client.deals = [deal("2024-02-01T00:00:00Z", name="Bigger deal")]
+    mirror.sync("deals")
+    assert client.reads == ["1"]
+    assert changes == ["deals", "deals"]
+    assert mirror.records("deals")[0].properties["dealname"] == "Bigger deal"
+    assert mirror.data_version() == {"deals": "2024-02-01T00:00:00Z"}
+
+
+def test_recent_sync_is_skipped(mirror):
+    mirror, client, changes = mirror
+    client.deals = [deal("2024-02-01T00:00:00Z")]
+    mirror.sync("deals", max_age=60)
+    assert client.reads == []
+
+
+def test_sync_without_changes_keeps_the_caches(mirror):
+    # The search includes the records modified at the watermark; they must
+    # not count as changes, or every sync would invalidate the caches.
+    mirror, client, changes = mirror
+    mirror.sync("deals")
+    assert client.reads == []
+    assert changes == ["deals"]
@@ -0,0 +1,66 @@
+import pytest
+
+import llm_cache
+from cache_utils import TTLCache
+from llm_cache import SQLiteLLMCache, completion_cache_key, create_llm_cache, data_versions, register_data_version
+
+REQUEST = {"model": "gpt-4", "messages": [{"role": "user", "content": "list my deals"}], "temperature": 0}
+
+
+@pytest.fixture(autouse=True)
+def versions(monkeypatch):
+    """Gives every test its own registry of data versions."""
+    versions = {"hubspot": 1, "sql": 1}
+    monkeypatch.setattr(llm_cache, "_data_versions", {})
+    for source in versions:
+        register_data_version(source, lambda source=source: versions[source])
+    return versions
+
+
+def test_data_versions_need_every_source_registered():
+    assert data_versions(["sql", "hubspot"]) == {"hubspot": 1, "sql": 1}
+    assert data_versions(["hubspot", "salesforce"]) is None
+
+
+def test_cache_key_changes_with_the_data_version(versions):
+    key = completion_cache_key(["hubspot"], **REQUEST)
+    assert key == completion_cache_key(["hubspot"], **REQUEST)
+    assert key != completion_cache_key(["hubspot"], **{**REQUEST, "model": "gpt-3.5-turbo"})
+
+    versions["sql"] = 2
+    assert key == completion_cache_key(["hubspot"], **REQUEST)
+    versions["hubspot"] = 2
+    assert key != completion_cache_key(["hubspot"], **REQUEST)
+
+
+def test_cache_is_bypassed_without_data_versions():
+    def unavailable():
+        raise ConnectionError("mirror is down")
+
+    register_data_version("salesforce", unavailable)
+    assert completion_cache_key(["hubspot", "salesforce"], **REQUEST) is None
+    assert completion_cache_key(["hubspot", "unknown"], **REQUEST) is None
+
+
+def test_sqlite_cache_evicts_expired_and_least_recent_entries(tmp_path):
+    cache = SQLiteLLMCache(str(tmp_path / "llm_cache.sqlite3"), maxsize=2)
+    cache.set("a", {"content": "A"})
+    cache.set("b", {"content": "B"})
+    cache.set("expired", {"content": "X"}, ttl=0)
+    assert cache.get("a") == {"content": "A"}
+    cache.set("c", {"content": "C"})
+
+    assert cache.get("b") is None
+    assert cache.get("expired") is None
+    assert cache.get("c") == {"content": "C"}
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 2, "hit_rate": 0.5}
+
+
+def test_create_llm_cache_from_urls(tmp_path):
+    assert create_llm_cache("none") is None
+    assert isinstance(create_llm_cache("memory://?maxsize=8"), TTLCache)
+    cache = create_llm_cache(f"sqlite://{tmp_path}/llm_cache.sqlite3?ttl=60")
+    assert isinstance(cache, SQLiteLLMCache)
+    assert cache.ttl == 60
+    with pytest.raises(ValueError):
+        create_llm_cache("redis://localhost")
@@ -0,0 +1,49 @@
+import pytest
+
+from message_log import MessageLog
+
+
+def test_a_turn_is_committed_when_it_completes():
+    messages = MessageLog([{"role": "system", "content": "system"}])
+    with messages.turn():
+        messages.append({"role": "user", "content": "question"})
+        assert messages.pending() == [{"role": "user", "content": "question"}]
+    assert messages.pending() == []
+    assert len(messages) == 2
+
+
+def test_a_failed_turn_is_rolled_back():
+    messages = MessageLog([{"role": "system", "content": "system"}])
+    with pytest.raises(RuntimeError):
+        with messages.turn():
+            messages.append({"role": "user", "content": "question"})
+            raise RuntimeError("LLM down")
+    assert messages == [{"role": "system", "content": "system"}]
+
+
+def test_a_new_turn_drops_the_messages_left_by_an_interrupted_one():
+    messages = MessageLog([{"role": "system", "content": "system"}])
+    messages.append({"role": "user", "content": "abandoned"})
+    with messages.turn():
+        messages.append({"role": "user", "content": "question"})
+    assert [message["content"] for message in messages] == ["system", "question"]
+
+
+def test_snapshot_shares_the_messages_without_sharing_the_list():
+    messages = MessageLog([{"role": "system", "content": "system"}])
+    snapshot = messages.snapshot()
+    snapshot.append({"role": "user", "content": "question"})
+    assert len(messages) == 1
+    assert snapshot[0] is messages[0]
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_dropping_old_turns_keeps_the_log_committed():
+    messages = MessageLog([{"role": "system", "content": "system"}])
+    for turn in range(3):
+        with messages.turn():
+            messages.append({"role": "user", "content": f"question {turn} " + "x" * 200})
+            messages.append({"role": "assistant", "content": "answer"})
+    messages.drop_oldest_turns(80)
+    assert [message["content"][:10] for message in messages] == ["system", "question 2", "answer"]
+    assert messages.committed == len(messages)
@@ -0,0 +1,39 @@
+import pickle
+
+import pytest
+
+from records import record_type
+
+Deal = record_type("Deal", ["id", "dealname", "dealstage"], shared=["dealstage"])
+
+
+def test_records_read_like_dicts():
+    deal = Deal(id="1", dealname="Big deal")
+    assert deal["id"] == "1"
+    assert deal.get("dealstage") is None
+    assert deal.get("amount", 0) == 0
+    assert dict(deal) == {"id": "1", "dealname": "Big deal", "dealstage": None}
+    assert deal == {"id": "1", "dealname": "Big deal", "dealstage": None}
+    with pytest.raises(KeyError):
+        deal["amount"]
+
+
+def test_records_are_read_only():
+    deal = Deal(id="1")
+    with pytest.raises(AttributeError):
+        deal.id = "2"
+    with pytest.raises(TypeError):
+        Deal(id="1", amount=5)
+
+
+def test_shared_values_are_interned():
+    first = Deal(id="1", dealstage="".join(["closed", "won"]))
+    second = Deal(id="2", dealstage="".join(["closed", "won"]))
+    assert first["dealstage"] is second["dealstage"]
+
+
+def test_records_pickle():
+    deal = Deal(id="1", dealname="Big deal", dealstage="closedwon")
+    restored = pickle.loads(pickle.dumps(deal))
+    assert type(restored) is Deal
+    assert restored == deal
@@ -0,0 +1,150 @@
+import re
+
+import result_store
+from result_store import (
+    CODE_PREFIX,
+    MAX_AGGREGATE_GROUPS,
+    MAX_PAGE_ROWS,
+    MIN_CODED_ROWS,
+    TABLE_DELIMITER,
+    _cells,
+    aggregate_result,
+    encode_result,
+    encode_table,
+    filter_result,
+    get_result_page,
+)
+
+
+def owned_deals(count, owners=3):
+    return [{"id": str(index), "owner": f"owner {index % owners}", "amount": index} for index in range(count)]
+
+
+def stored(rows):
+    content = encode_result("get_all_deals", rows)
+    return re.search(r"^handle: (\S+)$", content, re.MULTILINE).group(1)
+
+
+def test_large_results_are_stored_and_previewed():
+    rows = owned_deals(1000)
+    content = encode_result("get_all_deals", rows)
+    assert len(content) <= result_store.MAX_INLINE_RESULT_CHARS
+    assert "row_count: 1000" in content
+    assert result_store.result_store.get(stored(rows)) == rows
+
+
+def test_small_results_are_inlined():
+    assert "handle" not in encode_result("get_all_deals", owned_deals(3))
+
+
+def test_pages_are_clamped():
+    handle = stored(owned_deals(1000))
+    page = get_result_page(handle, offset=-5, limit=1000, columns=["id"])
+    assert page["offset"] == 0
+    assert page["rows"] == [{"id": str(index)} for index in range(MAX_PAGE_ROWS)]
+    assert get_result_page(handle, offset="10", limit="2")["rows"][0]["id"] == "10"
+    assert "must be integers" in get_result_page(handle, offset="next")
+    assert "no stored result" in get_result_page("get_all_deals-missing")
+
+
+def test_filter_result_returns_the_matching_rows():
+    handle = stored(owned_deals(1000))
+    result = filter_result(handle, "amount", "gte", 998, columns=["id"])
+    assert result == {"row_count": 2, "rows": [{"id": "998"}, {"id": "999"}]}
+
+
+def test_aggregate_result_groups_rows():
+    handle = stored(owned_deals(1000))
+    result = aggregate_result(handle, "count", group_by="owner")
+    assert result["result"] == {"owner 0": 334, "owner 1": 333, "owner 2": 333}
+    assert aggregate_result(handle, "max", "amount")["result"] == {"all": 999}
+
+
+def test_aggregate_result_returns_only_the_largest_groups():
+    handle = stored(owned_deals(1000, owners=500))
+    result = aggregate_result(handle, "sum", "amount", group_by="owner")
+    assert result["group_count"] == 500
+    assert len(result["result"]) == MAX_AGGREGATE_GROUPS
+    assert list(result["result"].items())[0] == ("owner 499", 499 + 999)
+
+
+def unescape(cell):
+    return re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), cell)
+
+
+def split_row(line):
+    return [unescape(cell) for cell in re.split(rf"(?<!\\)((?:\\\\)*)\{TABLE_DELIMITER}", line)[::2]]
+
+
+def decode_table(content):
+    """Reads back the fields and rows of `encode_table`, with the codes replaced by their values."""
+    lines = content.rstrip("\n").split("\n")
+    fields = {}
+    while not re.match(r"\d+ rows, ", lines[0]):
+        name, value = lines.pop(0).split(": ", 1)
+        fields[name] = value
+    count = int(lines.pop(0).split(" ", 1)[0])
+    columns = split_row(lines.pop(0))
+    codes = {}
+    if len(lines) > count:
+        codes = dict(cell.split("=", 1) for cell in split_row(lines.pop()))
+    rows = []
+    for line in lines:
+        cells = split_row(line) if line else []
+        rows.append({column: codes.get(cell, cell) for column, cell in zip(columns, cells) if cell})
+    return fields, rows
+
+
+def deals(count):
+    return [
+        {
+            "id": str(index),
+            "dealname": f"Deal {index} | renewal\nQ{index % 4}",
+            "dealstage": "closedwon" if index % 3 else "appointmentscheduled",
+            "amount": None if index == 2 else 1000 + index,
+            "path": "C:\\deals",
+            "is_closed": index % 2 == 0,
+            "associations": {"companies": [f"9{index}", "42"], "contacts": []},
+        }
+        for index in range(count)
+    ]
+
+
+def test_encode_table_round_trips_with_codes():
+    rows = deals(MIN_CODED_ROWS + 5)
+    content = encode_table(rows, {"company": "Globex", "total": 15})
+    assert f"{CODE_PREFIX}1" in content
+    fields, decoded = decode_table(content)
+    assert fields == {"company": "Globex", "total": "15"}
+    assert decoded == [dict(_cells(row)) for row in rows]
+
+
+def test_codes_replace_only_repeated_values_shorter_with_a_code():
+    content = encode_table(deals(MIN_CODED_ROWS + 5))
+    legend = split_row(content.rstrip("\n").split("\n")[-1])
+    coded = {cell.split("=", 1)[1] for cell in legend}
+    # Ids and names are distinct; "42" only repeats within the lists of ids.
+    assert coded == {"C:\\deals", "closedwon", "appointmentscheduled", "true", "false"}
+
+
+def test_small_tables_are_not_coded():
+    rows = deals(MIN_CODED_ROWS - 1)
+    content = encode_table(rows)
+    assert "codes" not in content
+    assert decode_table(content)[1] == [dict(_cells(row)) for row in rows]
+
+
+def test_cells_that_look_like_codes_disable_the_codes():
+    rows = [dict(row, dealname=f"{CODE_PREFIX}{row['id']}") for row in deals(MIN_CODED_ROWS + 5)]
+    content = encode_table(rows)
+    assert "codes" not in content
+    assert decode_table(content)[1] == [dict(_cells(row)) for row in rows]
+
+
+def test_nested_records_spread_over_columns():
+    content = encode_table([{"id": "1", "associations": {"companies": ["7", "8"]}}])
+    assert content.split("\n")[1:3] == ["id|associations.companies", "1|7 8"]
+
+
+def test_non_tabular_results_are_compact_json():
+    assert encode_result("get_deal", {"id": "1", "owner": None, "stages": ["a"]}) == '{"id":"1","stages":["a"]}'
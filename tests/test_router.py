@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import router
+from resources import ResourceUnavailable
+from router import ROUTING_EXAMPLES, SOURCES, route_question
+
+
+def unavailable(texts):
+    raise ResourceUnavailable("OpenAI is unavailable")
+
+
+@pytest.fixture
+def undecided(monkeypatch):
+    """Makes the classifier unsure, so that the embeddings decide."""
+    classifier = SimpleNamespace(probabilities=lambda question: (dict.fromkeys(SOURCES, 0.5), 1))
+    monkeypatch.setattr(router, "classifier", classifier)
+
+
+def embedded_like(monkeypatch, example, similarity):
+    """Embeds every question `similarity` close to the example question `example`."""
+    index = next(index for index, (question, _) in enumerate(ROUTING_EXAMPLES) if question == example)
+    vector = np.zeros(len(ROUTING_EXAMPLES))
+    vector[index] = similarity
+    monkeypatch.setattr(router, "_example_embeddings", SimpleNamespace(get=lambda: np.eye(len(ROUTING_EXAMPLES))))
+    monkeypatch.setattr(router, "embed", lambda texts: np.array([vector]))
+
+
+@pytest.mark.parametrize(
+    "question, sources",
+    [
+        ("Which HubSpot customers have unpaid invoices?", ("hubspot",)),
+        ("Who owns the deal with Acme in Salesforce and HubSpot?", ("hubspot", "salesforce")),
+        ("Run this SQL against the database", ("sql",)),
+    ],
+)
+def test_mentioned_sources_are_the_only_ones_queried(question, sources):
+    assert route_question(question) == (sources, "mention", 1.0)
+
+
+def test_cross_source_questions_query_every_source():
+    assert route_question("Compare the revenue across sources").sources == SOURCES
+
+
+def test_confident_classifier_selects_the_sources():
+    route = route_question("show the invoices of Acme")
+    assert (route.sources, route.method) == (("sql",), "classifier")
+
+
+def test_unclear_question_without_embeddings_queries_every_source(monkeypatch):
+    monkeypatch.setattr(router, "embed", unavailable)
+    assert route_question("list my deals") == (SOURCES, "fallback", 0.0)
+
+
+def test_named_records_extend_the_sources_of_the_closest_example(monkeypatch, undecided):
+    embedded_like(monkeypatch, "show the open opportunities of the account", 0.95)
+    route = route_question("open opportunities of Acme and their invoices")
+    assert (route.sources, route.method) == (("salesforce", "sql"), "embedding")
+
+
+def test_distant_examples_fall_back_to_every_source(monkeypatch, undecided):
+    embedded_like(monkeypatch, "which invoices are unpaid", 0.5)
+    assert route_question("anything new about invoices?") == (SOURCES, "fallback", 0.5)
+
+
+def test_routing_stats_count_the_skipped_sub_agents(monkeypatch):
+    before = router.routing_stats()
+    route_question("show the invoices of Acme")
+    monkeypatch.setattr(router, "ROUTING_ENABLED", False)
+    assert route_question("show the invoices of Acme").sources == SOURCES
+
+    stats = router.routing_stats()
+    assert stats["decisions"] - before.get("decisions", 0) == 2
+    assert stats["by_disabled"] - before.get("by_disabled", 0) == 1
+    assert stats["skipped_agent_runs"] - before.get("skipped_agent_runs", 0) == 2
@@ -0,0 +1,91 @@
+import threading
+from collections import namedtuple
+
+import pytest
+from simple_salesforce.exceptions import SalesforceExpiredSession
+
+from salesforce_client import SalesforcePool
+
+Usage = namedtuple("Usage", "used total")
+
+
+class FakeClient:
+    def __init__(self, session, number):
+        self.session = session
+        self.number = number
+        self.api_usage = {}
+
+
+@pytest.fixture
+def logins():
+    return []
+
+
+@pytest.fixture
+def pool(logins):
+    def login(session):
+        logins.append(session)
+        return FakeClient(session, len(logins))
+
+    return SalesforcePool(login, size=2, acquire_timeout=0.1)
+
+
+def test_clients_are_reused(pool, logins):
+    assert pool.call(lambda client: client.number) == 1
+    assert pool.call(lambda client: client.number) == 1
+    with pool.client() as first, pool.client() as second:
+        assert (first.number, second.number) == (1, 2)
+
+    stats = pool.stats()
+    assert (stats["created"], stats["idle"], stats["in_use"], stats["acquired"]) == (2, 2, 0, 4)
+
+
+def test_exhausted_pool_times_out(pool):
+    with pool.client(), pool.client():
+        with pytest.raises(TimeoutError):
+            pool.call(lambda client: client.number)
+    assert pool.stats()["in_use"] == 0
+
+
+def test_waiting_request_gets_the_released_client(pool):
+    pool.acquire_timeout = 5
+    numbers = []
+    with pool.client(), pool.client():
+        waiter = threading.Thread(target=lambda: numbers.append(pool.call(lambda client: client.number)))
+        waiter.start()
+    waiter.join()
+    assert numbers in ([1], [2])
+
+
+def test_expired_session_logs_in_again_and_retries(pool, logins):
+    calls = []
+
+    def operation(client):
+        calls.append(client.number)
+        if len(calls) == 1:
+            raise SalesforceExpiredSession("https://example.my.salesforce.com", 401, "query", "expired")
+        return "ok"
+
+    assert pool.call(operation) == "ok"
+    assert calls == [1, 2]
+    assert logins[0] is logins[1]
+    assert pool.stats()["relogins"] == 1
+
+
+def test_failed_login_frees_the_slot(logins):
+    def login(session):
+        raise ConnectionError("Salesforce is down")
+
+    pool = SalesforcePool(login, size=1, acquire_timeout=0.1)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            pool.call(lambda client: client)
+    assert pool.stats()["in_use"] == 0
+
+
+def test_api_usage_is_reported(pool):
+    def query(client):
+        client.api_usage["api-usage"] = Usage(used=10, total=15000)
+
+    pool.call(query)
+    assert pool.stats()["api_usage"] == {"used": 10, "total": 15000}
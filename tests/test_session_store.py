@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from session_store import MemorySessionStore, SessionStore, SQLiteSessionStore, create_session_store
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_memory_store_evicts_the_least_recently_used_sessions():
+    store = MemorySessionStore(max_sessions=2)
+    store.save("a", {"turns": 1})
+    store.save("b", {"turns": 2})
+    assert store.load("a") == {"turns": 1}
+    store.save("c", {"turns": 3})
+
+    assert store.load("b") is None
+    assert store.load("a") == {"turns": 1}
+    assert store.load("c") == {"turns": 3}
+
+
+def test_memory_store_expires_idle_sessions():
+    store = MemorySessionStore(ttl=0)
+    store.save("a", {"turns": 1})
+    time.sleep(0.01)
+
+    assert store.load("a") is None
+
+
+def test_memory_store_drops_the_locks_nobody_holds():
+    store = MemorySessionStore()
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with store.lock("a"):
+            entered.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    entered.wait()
+    store.save("a", {"turns": 1})
+    store.delete("a")
+    assert "a" in store._locks
+    release.set()
+    holder.join()
+
+    assert store._locks == {}
+
+
+def test_sqlite_store_round_trips_sessions(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    store.save("a", {"messages": [{"role": "user", "content": "hi"}]})
+
+    assert store.load("a") == {"messages": [{"role": "user", "content": "hi"}]}
+    store.delete("a")
+    assert store.load("a") is None
+
+
+def test_sqlite_lock_is_shared_between_stores(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store = SQLiteSessionStore(path, lock_timeout=0.2)
+    other = SQLiteSessionStore(path, lock_timeout=0.2)
+
+    with store.lock("a"):
+        with pytest.raises(TimeoutError):
+            with other.lock("a"):
+                pass
+    with other.lock("a"):
+        pass
+
+
+def test_sqlite_lock_is_renewed_while_held(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    store = SQLiteSessionStore(path, lock_lease=0.3)
+    other = SQLiteSessionStore(path, lock_timeout=0.2)
+
+    with store.lock("a"):
+        time.sleep(0.6)
+        with pytest.raises(TimeoutError):
+            with other.lock("a"):
+                pass
+
+
+def test_create_session_store_from_urls(tmp_path):
+    memory = create_session_store("memory://?max_sessions=5&ttl=60")
+    sqlite = create_session_store(f"sqlite://{tmp_path}/sessions.sqlite3?ttl=60")
+
+    assert isinstance(memory, MemorySessionStore)
+    assert (memory.max_sessions, memory.ttl) == (5, 60)
+    assert isinstance(sqlite, SQLiteSessionStore)
+    assert sqlite.path == f"{tmp_path}/sessions.sqlite3"
+    with pytest.raises(ValueError):
+        create_session_store("redis://localhost")
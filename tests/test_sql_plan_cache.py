@@ -0,0 +1,54 @@
+from sql_plan_cache import SQLPlanCache, make_plan
+
+QUESTION = "Show the invoices of Globex Dynamics above 500"
+SQL = "SELECT * FROM invoices WHERE company ILIKE '%Globex Dynamics%' AND amount > 500"
+
+
+def test_cached_plan_is_filled_with_the_entities_of_a_similar_question():
+    plans = SQLPlanCache()
+    plans.store(QUESTION, SQL, "schema-1")
+    assert plans.lookup("Show the invoices of O'Reilly Media above 1200.5?", "schema-1") == (
+        "SELECT * FROM invoices WHERE company ILIKE '%O''Reilly Media%' AND amount > 1200.5"
+    )
+    assert plans.stats()["hits"] == 1
+
+
+def test_lowercase_literals_stay_lowercase():
+    plans = SQLPlanCache()
+    plans.store(
+        "How many invoices has the status paid",
+        "SELECT count(*) FROM invoices WHERE status = 'paid'",
+        "schema-1",
+    )
+    assert plans.lookup("How many invoices has the status OVERDUE", "schema-1") == (
+        "SELECT count(*) FROM invoices WHERE status = 'overdue'"
+    )
+
+
+def test_other_questions_miss():
+    plans = SQLPlanCache()
+    plans.store(QUESTION, SQL, "schema-1")
+    assert plans.lookup("Show the customers of Globex Dynamics above 500", "schema-1") is None
+
+
+def test_a_schema_change_drops_the_plans():
+    plans = SQLPlanCache()
+    plans.store(QUESTION, SQL, "schema-1")
+    assert plans.lookup(QUESTION, "schema-2") is None
+    assert plans.stats()["size"] == 0
+
+
+def test_discard_drops_the_plan_of_a_question():
+    plans = SQLPlanCache()
+    plans.store(QUESTION, SQL, "schema-1")
+    plans.discard("Show the invoices of Initech above 10")
+    assert plans.lookup(QUESTION, "schema-1") is None
+
+
+def test_only_single_read_only_queries_are_planned():
+    assert make_plan(QUESTION, "DELETE FROM invoices WHERE amount > 500") is None
+    assert make_plan(QUESTION, f"{SQL}; DROP TABLE invoices") is None
+
+
+def test_questions_made_mostly_of_entities_are_not_planned():
+    assert make_plan("Globex Dynamics invoices", "SELECT * FROM invoices WHERE company = 'Globex Dynamics'") is None
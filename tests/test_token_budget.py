@@ -0,0 +1,64 @@
+import pytest
+import tiktoken
+
+import token_budget
+from token_budget import count_prompt_tokens, count_text_tokens, drop_oldest_turns, fit_to_budget
+
+
+def conversation(*turns):
+    messages = [{"role": "system", "content": "You are helpful."}]
+    for question, answer in turns:
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": answer})
+    return messages
+
+
+def test_tokenizer_falls_back_to_an_estimate(monkeypatch):
+    def unavailable(name):
+        raise OSError("offline")
+
+    monkeypatch.setattr(tiktoken, "get_encoding", unavailable)
+    token_budget.get_encoding.cache_clear()
+    try:
+        assert isinstance(token_budget.get_encoding(), token_budget._CharEstimate)
+    finally:
+        token_budget.get_encoding.cache_clear()
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_estimate_counts_chunks_of_characters():
+    assert count_text_tokens("") == 0
+    assert count_text_tokens("abcdefghi") == 3
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_oldest_turns_are_dropped_first():
+    messages = conversation(("a" * 400, "b" * 400), ("c" * 40, "d" * 40), ("latest?", "e" * 40))
+    tokens = drop_oldest_turns(messages, 100)
+    assert tokens <= 100
+    assert [message["content"][0] for message in messages] == ["Y", "c", "d", "l", "e"]
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_the_latest_turn_is_always_kept():
+    messages = conversation(("a" * 400, "b" * 400))
+    assert drop_oldest_turns(messages, 10) > 10
+    assert len(messages) == 3
+
+
+@pytest.mark.usefixtures("char_tokens")
+def test_largest_tool_results_of_the_latest_turn_are_truncated():
+    messages = conversation(("first", "answer"))
+    messages += [
+        {"role": "user", "content": "List the deals"},
+        {"role": "assistant", "content": None, "tool_calls": [{"id": "1"}]},
+        {"role": "tool", "tool_call_id": "1", "content": "x" * 2000},
+        {"role": "tool", "tool_call_id": "2", "content": "y" * 40},
+    ]
+    tokens = fit_to_budget(messages, budget=200)
+    assert tokens <= 200
+    assert messages[1]["content"] == "List the deals"
+    assert messages[3]["content"].startswith("xxxx")
+    assert "truncated" in messages[3]["content"]
+    assert messages[4]["content"] == "y" * 40
+    assert tokens == count_prompt_tokens(messages)